@@ -133,6 +133,17 @@ def has_access_question(question_pk, user):
     question = get_object_or_404(pool, pk=question_pk)
     return question.exam.can_user_access(user)
 
+def get_question_pks_parameter(request):
+    # Optionally limit user-specific data to the questions that were
+    # just loaded (see list_partial_session_questions).
+    question_pks = request.query_params.get('question_pks')
+    if not question_pks:
+        return None
+    try:
+        return [int(pk) for pk in question_pks.split(',')]
+    except ValueError:
+        raise exceptions.ParseError('No valid "question_pks" parameter was provided')
+
 class HasSessionAccess(permissions.BasePermission):
     def has_permission(self, request, view):
         session_pk = request.query_params.get('session_pk')
@@ -175,9 +186,13 @@ class AnswerViewSet(viewsets.ReadOnlyModelViewSet):
 
     def get_queryset(self):
         session_pk = self.request.query_params.get('session_pk')
-        return Answer.objects.select_related('choice')\
-                             .filter(session_id=session_pk,
-                                     session__is_deleted=False)
+        answers = Answer.objects.select_related('choice')\
+                                .filter(session_id=session_pk,
+                                        session__is_deleted=False)
+        question_pks = get_question_pks_parameter(self.request)
+        if question_pks is not None:
+            answers = answers.filter(question__pk__in=question_pks)
+        return answers
 
 class HighlightViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = HighlightSerializer
@@ -185,10 +200,14 @@ class HighlightViewSet(viewsets.ReadOnlyModelViewSet):
 
     def get_queryset(self):
         session_pk = self.request.query_params.get('session_pk')
-        return Highlight.objects.filter(session_id=session_pk,
-                                        session__is_deleted=False)\
-                                .select_related('revision')\
-                                .prefetch_related('stricken_choices')
+        highlights = Highlight.objects.filter(session_id=session_pk,
+                                              session__is_deleted=False)\
+                                      .select_related('revision')\
+                                      .prefetch_related('stricken_choices')
+        question_pks = get_question_pks_parameter(self.request)
+        if question_pks is not None:
+            highlights = highlights.filter(question__pk__in=question_pks)
+        return highlights
 
 class MarkedQuestionViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = QuestionIdSerializer
@@ -201,6 +220,9 @@ class MarkedQuestionViewSet(viewsets.ReadOnlyModelViewSet):
         question_pk = self.request.query_params.get('question_pk')
         if question_pk:
             pool =  Question.objects.filter(pk=question_pk)
+        question_pks = get_question_pks_parameter(self.request)
+        if question_pks is not None:
+            pool = pool.filter(pk__in=question_pks)
 
         return pool.filter(marking_users=self.request.user)\
                    .distinct()
@@ -442,6 +464,37 @@ class ActivityList(views.APIView):
 
         return Response(data)
 
+def get_choices_with_corrections():
+    user_qs = User.objects.select_related('profile')
+    return Choice.objects.select_related('answer_correction',
+                                         'answer_correction__submitter',
+                                         'answer_correction__submitter__profile',
+                                         'question',
+                                         'question__exam')\
+                         .prefetch_related(Prefetch('answer_correction__supporting_users',
+                                                    user_qs,
+                                                    to_attr="supporting_user_list"),
+                                           Prefetch('answer_correction__opposing_users',
+                                                    user_qs,
+                                                    to_attr="opposing_user_list"))\
+                         .filter(answer_correction__isnull=False)
+
+def get_correction_data(choices_with_corrections, exam, user):
+    # To avoid repeating this query to show the 'Delete' button,
+    # we are going to do it once and pass it to the template.
+    can_user_edit_exam = exam.can_user_edit(user)
+
+    data = []
+    template = get_template("exams/partials/show_answer_correction.html")
+    for choice in choices_with_corrections:
+        context = {'choice': choice, 'user': user}
+        html = template.render(context)
+        data.append({'question_id': choice.question.pk,
+                     'choice_id': choice.pk,
+                     'can_user_edit_exam': can_user_edit_exam,
+                     'html': html})
+    return data
+
 class CorrectionList(views.APIView):
     permission_classes = (CanAccessExam,)
 
@@ -455,19 +508,7 @@ class CorrectionList(views.APIView):
         if not session_pk and not question_pk and not question_pks:
             raise exceptions.ParseError('Not enough prarameters were provided.')
 
-        user_qs = User.objects.select_related('profile')
-        choices_with_corrections = Choice.objects.select_related('answer_correction',
-                                                                 'answer_correction__submitter',
-                                                                 'answer_correction__submitter__profile',
-                                                                 'question',
-                                                                 'question__exam')\
-                                                 .prefetch_related(Prefetch('answer_correction__supporting_users',
-                                                                            user_qs,
-                                                                            to_attr="supporting_user_list"),
-                                                                   Prefetch('answer_correction__opposing_users',
-                                                                            user_qs,
-                                                                            to_attr="opposing_user_list"))\
-                                                 .filter(answer_correction__isnull=False)
+        choices_with_corrections = get_choices_with_corrections()
 
         if session_pk:
             choices_with_corrections = choices_with_corrections.filter(question__session__pk=session_pk)
@@ -480,20 +521,9 @@ class CorrectionList(views.APIView):
                 raise exceptions.ParseError('No valid "question_pks" parameter was provided')
             choices_with_corrections = choices_with_corrections.filter(question__pk__in=question_pks)
 
-        # To avoid repeating this query to show the 'Delete' button,
-        # we are going to do it once and pass it to the template.
         exam = Exam.objects.get(pk=exam_pk)
-        can_user_edit_exam = exam.can_user_edit(request.user)
-
-        data = []
-        template = get_template("exams/partials/show_answer_correction.html")
-        for choice in choices_with_corrections:
-            context = {'choice': choice, 'user': request.user}
-            html = template.render(context)
-            data.append({'question_id': choice.question.pk,
-                         'choice_id': choice.pk,
-                         'can_user_edit_exam': can_user_edit_exam,
-                         'html': html})
+        data = get_correction_data(choices_with_corrections, exam,
+                                   request.user)
 
         return Response(data)
 
@@ -0,0 +1,174 @@
+from collections import defaultdict
+from difflib import SequenceMatcher
+import bisect
+import functools
+import hashlib
+import struct
+
+# Near-duplicate detection for catch_duplicates.  Comparing every
+# pair of questions in an exam with SequenceMatcher is quadratic, so
+# we first find candidate pairs with locality-sensitive hashing:
+#
+#  - Every text is reduced to its set of character shingles (runs of
+#    SHINGLE_SIZE characters of the normalized text).
+#
+#  - A MinHash signature of BANDS * ROWS values is computed from the
+#    shingles.  Each value is the minimum of a different hash function
+#    over all shingles, so two signatures agree on a value with a
+#    probability equal to the Jaccard similarity of both shingle sets.
+#
+#  - Signatures are cut into BANDS bands of ROWS values.  Texts that
+#    are identical in at least one band are candidates.
+#
+# Candidates are then confirmed with SequenceMatcher, using the same
+# thresholds as the exhaustive scan, so that the only texts missed are
+# those whose shingles are too different to share a band.  With the
+# values below, a pair with a Jaccard similarity of 0.5 becomes a
+# candidate with a probability of 0.93, and one of 0.6 with a
+# probability of 0.99.
+
+SHINGLE_SIZE = 4
+BANDS = 20
+ROWS = 3
+SIGNATURE_SIZE = BANDS * ROWS
+
+# The default thresholds of SequenceMatcher ratios.  Texts up to
+# DEFAULT_SHORT_LIMIT characters need a higher ratio to be considered
+# duplicates.
+DEFAULT_CUTOFF = 0.85
+DEFAULT_SHORT_LIMIT = 70
+SHORT_CUTOFF = 0.90
+
+# A single SHAKE-128 digest of every shingle provides all hash values
+# at once.  Being seedless, signatures are stable across processes.
+SIGNATURE_STRUCT = struct.Struct('<{}I'.format(SIGNATURE_SIZE))
+
+def normalize_text(text):
+    return " ".join(text.lower().split())
+
+def get_shingles(text):
+    text = normalize_text(text)
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[index:index + SHINGLE_SIZE]
+            for index in range(len(text) - SHINGLE_SIZE + 1)}
+
+# Texts of the same language share most of their shingles, so hashing
+# is memoized.
+@functools.lru_cache(maxsize=2 ** 17)
+def get_shingle_hash_values(shingle):
+    digest = hashlib.shake_128(shingle.encode('utf-8'))\
+                    .digest(SIGNATURE_STRUCT.size)
+    return SIGNATURE_STRUCT.unpack(digest)
+
+def get_signature(text):
+    hash_values = [get_shingle_hash_values(shingle)
+                   for shingle in get_shingles(text)]
+    return tuple(map(min, zip(*hash_values)))
+
+def pack_signature(signature):
+    return SIGNATURE_STRUCT.pack(*signature)
+
+def unpack_signature(value):
+    return SIGNATURE_STRUCT.unpack(bytes(value))
+
+def get_band_values(signature):
+    # Every band is reduced to a signed 64-bit integer, so that bands
+    # can be stored and looked up in the database (see
+    # QuestionFingerprint).
+    band_values = []
+    for band in range(BANDS):
+        rows = signature[band * ROWS:(band + 1) * ROWS]
+        digest = hashlib.blake2b(struct.pack('<H{}I'.format(ROWS), band, *rows),
+                                 digest_size=8).digest()
+        band_values.append(int.from_bytes(digest, 'little', signed=True))
+    return band_values
+
+def get_buckets(band_values):
+    # band_values is a dictionary of keys and their band values.
+    # Return a dictionary of band values and the keys that share them.
+    buckets = defaultdict(list)
+    for key, values in band_values.items():
+        for value in values:
+            buckets[value].append(key)
+    return buckets
+
+def get_candidate_pairs(keys, band_values, buckets):
+    # Return the set of (smaller key, greater key) candidate pairs
+    # that involve any of keys.
+    pairs = set()
+    for key in keys:
+        for value in band_values.get(key, []):
+            for other_key in buckets[value]:
+                if other_key < key:
+                    pairs.add((other_key, key))
+                elif other_key > key:
+                    pairs.add((key, other_key))
+    return pairs
+
+def get_duplicate_ratio(first_text, second_text, cutoff, short_limit):
+    # Return the SequenceMatcher ratio of both texts if they are
+    # duplicates, and None otherwise.  The threshold depends on the
+    # length of the first text.  The cheap upper bounds rule out most
+    # pairs before the full ratio is computed.
+    if len(first_text) <= short_limit:
+        threshold = SHORT_CUTOFF
+    else:
+        threshold = cutoff
+    matcher = SequenceMatcher(None, first_text, second_text)
+    if matcher.real_quick_ratio() < threshold or \
+       matcher.quick_ratio() < threshold:
+        return None
+    ratio = matcher.ratio()
+    if ratio >= threshold:
+        return ratio
+
+def get_confirmed_pairs(keys, texts, band_values, buckets, cutoff,
+                        short_limit, exhaustive=False, with_earlier=False,
+                        step=None):
+    # Return the (smaller key, greater key, ratio) tuples of the
+    # duplicates of keys among texts.  Unless with_earlier is given,
+    # pairs are only returned from the smaller key of the pair, so
+    # that every pair is compared once when keys are cut into shards.
+    # With exhaustive, every pair is compared rather than just the LSH
+    # candidates.  step, if given, is called after every comparison.
+    if exhaustive:
+        sorted_keys = sorted(texts)
+        pairs = [(key, second_key) for key in keys
+                 for second_key in sorted_keys[bisect.bisect_right(sorted_keys, key):]]
+    else:
+        pairs = get_candidate_pairs(keys, band_values, buckets)
+        if not with_earlier:
+            keys = set(keys)
+            pairs = [(key, second_key) for key, second_key in pairs
+                     if key in keys]
+
+    confirmed_pairs = []
+    for key, second_key in sorted(pairs):
+        if key in texts and second_key in texts:
+            ratio = get_duplicate_ratio(texts[key], texts[second_key],
+                                        cutoff, short_limit)
+            if ratio is not None:
+                confirmed_pairs.append((key, second_key, ratio))
+        if step:
+            step()
+    return confirmed_pairs
+
+def group_duplicates(pairs):
+    # pairs is an iterable of confirmed (smaller key, greater key,
+    # ratio) tuples.  Every key that is not a duplicate of a smaller
+    # key is grouped with its greater duplicates.  Return a list of
+    # (key, [(greater key, ratio)]) tuples.
+    duplicates_by_key = defaultdict(list)
+    for key, second_key, ratio in pairs:
+        duplicates_by_key[key].append((second_key, ratio))
+
+    found = set()
+    groups = []
+    for key in sorted(duplicates_by_key):
+        if key in found:
+            continue
+        duplicates = sorted(duplicates_by_key[key])
+        found.update(second_key for second_key, ratio in duplicates)
+        groups.append((key, duplicates))
+    return groups
@@ -13,15 +13,15 @@ import accounts.utils
 
 class MetaChoiceField(forms.ModelMultipleChoiceField):
     def __init__(self, *args, **kwargs):
-        self.exam = kwargs.pop('exam')
-        self.form_type = kwargs.pop('form_type')
+        # `counts` is a dictionary of {meta PK: question count}, as
+        # returned (per meta type) by
+        # utils.get_exam_meta_question_counts(), so that labels do not
+        # need a query each.
+        self.counts = kwargs.pop('counts')
         super().__init__(*args, **kwargs)
 
     def label_from_instance(self, obj):
-        approved_only = self.form_type == 'session'
-        count = utils.get_exam_question_count_per_meta(self.exam,
-                                                       meta=obj,
-                                                       approved_only=approved_only)
+        count = self.counts.get(obj.pk, 0)
         if type(obj) is models.Difficulty:
             return mark_safe(f"<abbr title='{obj.tooltip}'>{str(obj)} ({count})</abbr>")
         else:
@@ -52,13 +52,13 @@ class QuestionForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         exam = self.instance.exam
+        meta_counts = utils.get_exam_meta_question_counts(exam)
 
         # Only include 'subjects' field if the exam has subjects
         subjects = models.Subject.objects.filter(exam=exam)
         if subjects.exists():
             self.fields['subjects'] = MetaChoiceField(required=True,
-                                                      form_type='question',
-                                                      exam=exam,
+                                                      counts=meta_counts['subjects'],
                                                       queryset=subjects,
                                                       widget=select2_widget)
         else:
@@ -67,8 +67,7 @@ class QuestionForm(forms.ModelForm):
         sources = exam.get_sources()
         if sources.exists():
             self.fields['sources'] = MetaChoiceField(required=True,
-                                                     form_type='question',
-                                                     exam=exam,
+                                                     counts=meta_counts['sources'],
                                                      queryset=sources,
                                                      widget=select2_widget)
         else:
@@ -76,8 +75,7 @@ class QuestionForm(forms.ModelForm):
 
         if exam.exam_types.exists():
             self.fields['exam_types'] = MetaChoiceField(required=True,
-                                                        form_type='question',
-                                                        exam=exam,
+                                                        counts=meta_counts['exam_types'],
                                                         queryset=exam.exam_types.all(),
                                                         widget=select2_widget)
         else:
@@ -126,28 +124,33 @@ class GenericRevisionForm(forms.ModelForm):
         new_object = self.save(commit=False)
         if not new_object:
             return
-        new_object.pk = None
-        if not self.instance.pk:
-            new_object.is_first = True
-        else:
-            new_object.is_first = False
-        new_object.is_last = True
-        new_object.is_contribution = not teams.utils.is_editor(user)
-        new_object.submitter = user
-        # We pass question as this 'clone' method might also be used
-        # to create new explanation.
-        new_object.question = question
-        new_object.save()
-
-        if figure_formset:
-            figure_formset.clone(new_object)
 
-        if type(new_object) is models.Revision:
-            if choice_formset:
-                choice_formset.clone(new_object)
-            new_object.is_approved = utils.test_revision_approval(new_object)
+        # A new revision is saved more than once (before and after
+        # its choices are added), so the question is only recomputed
+        # once, at the end.
+        with utils.defer_revision_updates():
+            new_object.pk = None
+            if not self.instance.pk:
+                new_object.is_first = True
+            else:
+                new_object.is_first = False
+            new_object.is_last = True
+            new_object.is_contribution = not teams.utils.is_editor(user)
+            new_object.submitter = user
+            # We pass question as this 'clone' method might also be used
+            # to create new explanation.
+            new_object.question = question
             new_object.save()
 
+            if figure_formset:
+                figure_formset.clone(new_object)
+
+            if type(new_object) is models.Revision:
+                if choice_formset:
+                    choice_formset.clone(new_object)
+                new_object.is_approved = utils.test_revision_approval(new_object)
+                new_object.save()
+
         return new_object
 
 class RevisionForm(GenericRevisionForm):
@@ -317,6 +320,16 @@ class SessionForm(forms.ModelForm):
             self.fields['number_of_questions'].widget.attrs['style'] = 'width: 5em;'
             self.fields['number_of_questions'].widget.attrs['placeholder'] = ''
 
+        # Option counts of all meta fields come from one grouped
+        # query per meta type (or the cache).  Labels are never shown
+        # for automatically-created sessions.
+        if self.is_automatic:
+            meta_counts = {field_name: {}
+                           for field_name in utils.META_COUNT_FIELDS}
+        else:
+            meta_counts = utils.get_exam_meta_question_counts(self.exam,
+                                                              approved_only=True)
+
         # Limit subjects and exams per exam
         subjects = models.Subject.objects.filter(exam=self.exam)\
                                          .with_approved_questions()\
@@ -324,9 +337,8 @@ class SessionForm(forms.ModelForm):
                                          .order_by('name')
         if subjects.exists():
             self.fields['all_subjects'] = forms.BooleanField(label="All", required=False)
-            self.fields['subjects'] = MetaChoiceField(exam=self.exam,
-                                                      required=False,
-                                                      form_type='session',
+            self.fields['subjects'] = MetaChoiceField(required=False,
+                                                      counts=meta_counts['subjects'],
                                                       queryset=subjects,
                                                       widget=forms.CheckboxSelectMultiple)
         else:
@@ -338,9 +350,8 @@ class SessionForm(forms.ModelForm):
                                          .order_by('name')
         if sources.exists():
             self.fields['all_sources'] = forms.BooleanField(label="All", required=False)
-            self.fields['sources'] = MetaChoiceField(exam=self.exam,
-                                                     required=False,
-                                                     form_type='session',
+            self.fields['sources'] = MetaChoiceField(required=False,
+                                                     counts=meta_counts['sources'],
                                                      queryset=sources,
                                                      widget=forms.CheckboxSelectMultiple)
         else:
@@ -351,8 +362,7 @@ class SessionForm(forms.ModelForm):
         if exam_types.exists():
             self.fields['all_exam_types'] = forms.BooleanField(label="All", required=False)
             self.fields['exam_types'] = MetaChoiceField(required=not self.is_automatic,
-                                                        form_type='session',
-                                                        exam=self.exam,
+                                                        counts=meta_counts['exam_types'],
                                                         queryset=exam_types,
                                                         widget=forms.CheckboxSelectMultiple)
         else:
@@ -364,8 +374,7 @@ class SessionForm(forms.ModelForm):
         if difficulties.exists():
             self.fields['all_difficulties'] = forms.BooleanField(label="All", required=False)
             self.fields['difficulties'] = MetaChoiceField(required=not self.is_automatic,
-                                                          form_type='session',
-                                                          exam=self.exam,
+                                                          counts=meta_counts['difficulty'],
                                                           queryset=difficulties,
                                                           widget=forms.CheckboxSelectMultiple)
         else:
@@ -428,56 +437,32 @@ class SessionForm(forms.ModelForm):
         # specify a given number of questions
 
         if number_of_questions:
-            # Ideally, randomization should be a database thing, but
-            # Django is buggy when it comes to slicing a randomzied query
-            # with many filters.  For this reason, we apply the filers,
-            # then get only the PKs of included quessions, shuffle them,
-            # and then slice the number we need.  Finally, we get the
-            # question objects per the shuffled PKs.
-            pool_pks = list(question_pool.values_list('pk', flat=True))
-            random.shuffle(pool_pks)
-            sliced_pks = pool_pks[:number_of_questions]
-
-            selected_pool = models.Question.objects.filter(pk__in=sliced_pks)
-            questions_to_find_tree = selected_pool.filter(parent_question__isnull=False) | \
-                                     selected_pool.filter(child_question__isnull=False)
-
-            pks = []
-            for question in questions_to_find_tree.distinct():
-                tree = question.get_tree()
-                new_pks = [q.pk for q in tree if not q.pk in pks]
-                pks += new_pks
-            self.questions_with_tree = models.Question.objects\
-                                                      .filter(pk__in=pks)
-
-            if question_filter != 'INCOMPLETE':
-                self.questions_with_tree = self.questions_with_tree.approved()
-
-            self.final_questions = list(self.questions_with_tree)
-            remaining_count = number_of_questions - self.questions_with_tree.count()
-            if remaining_count > 0:
-                orphan_questions = selected_pool.filter(parent_question__isnull=True,
-                                                        child_question__isnull=True)
-                self.orphan_pool = models.Question.objects.filter(pk__in=orphan_questions[:remaining_count])
-                self.final_questions += list(self.orphan_pool)
+            # Only PKs are needed to allocate session questions.
+            approved_only = question_filter != 'INCOMPLETE'
+            self.final_question_pks = utils.allocate_session_question_pks(question_pool,
+                                                                          number_of_questions,
+                                                                          approved_only)
         else:
-            self.final_questions = question_pool
+            # This can be the whole pool of an exam (e.g. 'ALL'
+            # automatic sessions), so only PKs are fetched.  They are
+            # fetched now, so that the session gets the pool that was
+            # validated rather than whatever it is at save time.
+            self.final_question_pks = list(question_pool.values_list('pk', flat=True))
 
         return cleaned_data
 
     def save(self, *args, **kwargs):
         session = super().save(*args, **kwargs)
-        session.questions.add(*self.final_questions)
+        # Here we try to account for cases when the requested number
+        # of questions is not completely available.
+        actual_question_count = utils.add_session_questions(session,
+                                                            self.final_question_pks)
 
         if not session.parent_session:
             chars = string.ascii_lowercase + string.digits
             secret_key = "".join([random.choice(chars) for i in range(10)])
             session.secret_key = secret_key
 
-        # Here we try to account for cases when the requested number
-        # of questions is not completely available.
-        actual_question_count = len(self.final_questions)
-
         if self.is_automatic:
             session.is_automatic = True
             session.number_of_questions = actual_question_count
@@ -485,6 +470,7 @@ class SessionForm(forms.ModelForm):
         # Initially, the value of unused_question_count equals the
         # number of questions in the sessions.
         session.unused_question_count = actual_question_count
+        session.update_question_order(commit=False)
 
         if self.original_session:
             session.examinee_name = self.original_session.examinee_name
@@ -0,0 +1,140 @@
+from django.core.management.base import BaseCommand
+from exams import duplicates, sharding
+import itertools
+import random
+import time
+
+# This command compares the LSH candidate search of catch_duplicates
+# against the exhaustive all-pairs scan on a synthetic exam.  Like
+# catch_duplicates, questions are matched in shards with
+# duplicates.get_confirmed_pairs() and grouped with
+# duplicates.group_duplicates().  It runs entirely in memory, so it
+# does not touch the database.
+#
+# Recall is measured over question pairs that pass the catch_duplicates
+# thresholds.  For exams of up to --exhaustive-limit questions, these
+# pairs are found by comparing every pair.  Beyond that, the exhaustive
+# scan would take hours, so its time is extrapolated from a random
+# sample of pairs, and the planted near-duplicates are taken as the
+# pairs to recall.
+
+def get_vocabulary(size):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return ["".join(random.choice(letters) for i in range(random.randint(2, 10)))
+            for j in range(size)]
+
+def get_mutated_text(text, vocabulary, rate):
+    words = text.split()
+    for index in range(len(words)):
+        if random.random() < rate:
+            change = random.random()
+            if change < 0.5:
+                words[index] = random.choice(vocabulary)
+            elif change < 0.75:
+                # A typo
+                words[index] = words[index][:-1]
+            else:
+                words.insert(index, random.choice(vocabulary))
+    return " ".join(words)
+
+def create_texts(size, duplicate_ratio):
+    # Return a dictionary of primary keys and texts, and a dictionary
+    # of primary keys and the primary key of the original question of
+    # which they are near-duplicates.
+    vocabulary = get_vocabulary(5000)
+    texts = {}
+    originals = {}
+    for pk in range(1, size + 1):
+        if texts and random.random() < duplicate_ratio:
+            original_pk = random.randint(1, pk - 1)
+            rate = random.choice([0, 0.02, 0.05, 0.1, 0.15, 0.2])
+            texts[pk] = get_mutated_text(texts[original_pk], vocabulary, rate)
+            originals[pk] = originals.get(original_pk, original_pk)
+        else:
+            texts[pk] = " ".join(random.choice(vocabulary)
+                                 for i in range(random.randint(8, 40)))
+    return texts, originals
+
+def get_duplicate_pairs(texts, pairs, cutoff, short_limit):
+    return {(first_pk, second_pk) for first_pk, second_pk in pairs
+            if duplicates.get_duplicate_ratio(texts[first_pk], texts[second_pk],
+                                              cutoff, short_limit) is not None}
+
+def get_planted_pairs(originals):
+    clusters = {}
+    for pk, original_pk in originals.items():
+        clusters.setdefault(original_pk, [original_pk]).append(pk)
+    pairs = set()
+    for pks in clusters.values():
+        pairs.update(itertools.combinations(sorted(pks), 2))
+    return pairs
+
+class Command(BaseCommand):
+    help = "Benchmark LSH duplicate detection against the exhaustive scan on a synthetic exam."
+    def add_arguments(self, parser):
+        parser.add_argument('--size', default=20000, type=int)
+        parser.add_argument('--duplicate-ratio', default=0.05, type=float)
+        parser.add_argument('--cutoff', default=0.85, type=float)
+        parser.add_argument('--short-limit', default=70, type=int)
+        parser.add_argument('--exhaustive-limit', default=2000, type=int)
+        parser.add_argument('--sample-pairs', default=20000, type=int)
+        parser.add_argument('--shard-size', default=500, type=int)
+        parser.add_argument('--seed', default=0, type=int)
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        cutoff = options['cutoff']
+        short_limit = options['short_limit']
+        texts, originals = create_texts(options['size'], options['duplicate_ratio'])
+        pks = sorted(texts)
+        pair_count = len(pks) * (len(pks) - 1) // 2
+
+        shards = sharding.get_shards(((0, pk) for pk in pks),
+                                     options['shard_size'])
+
+        def match(exhaustive, band_values=None, buckets=None):
+            pairs = []
+            for exam_pk, shard_pks in shards:
+                pairs += duplicates.get_confirmed_pairs(shard_pks, texts,
+                                                        band_values, buckets,
+                                                        cutoff, short_limit,
+                                                        exhaustive)
+            duplicates.group_duplicates(pairs)
+            return {(first_pk, second_pk) for first_pk, second_pk, ratio in pairs}
+
+        duplicates.get_shingle_hash_values.cache_clear()
+        start_time = time.perf_counter()
+        band_values = {pk: duplicates.get_band_values(duplicates.get_signature(text))
+                       for pk, text in texts.items()}
+        signature_time = time.perf_counter() - start_time
+        buckets = duplicates.get_buckets(band_values)
+        found_pairs = match(False, band_values, buckets)
+        lsh_time = time.perf_counter() - start_time
+        candidate_pairs = duplicates.get_candidate_pairs(pks, band_values, buckets)
+
+        if len(pks) <= options['exhaustive_limit']:
+            start_time = time.perf_counter()
+            expected_pairs = match(True)
+            exhaustive_time = time.perf_counter() - start_time
+            source = "exhaustive"
+        else:
+            sample = [tuple(sorted(random.sample(pks, 2)))
+                      for i in range(options['sample_pairs'])]
+            start_time = time.perf_counter()
+            get_duplicate_pairs(texts, sample, cutoff, short_limit)
+            exhaustive_time = (time.perf_counter() - start_time) / len(sample) * pair_count
+            expected_pairs = get_duplicate_pairs(texts, get_planted_pairs(originals),
+                                                 cutoff, short_limit)
+            source = "planted, exhaustive time extrapolated"
+
+        recalled_pairs = found_pairs & expected_pairs
+        print("Questions: {}, pairs: {}".format(len(pks), pair_count))
+        print("Candidate pairs: {} ({:.4%} of all pairs)".format(len(candidate_pairs),
+                                                                 len(candidate_pairs) / max(pair_count, 1)))
+        print("Candidate precision: {:.4f} ({} confirmed)".format(len(found_pairs) / max(len(candidate_pairs), 1),
+                                                                  len(found_pairs)))
+        print("Recall: {:.4f} ({} of {} duplicate pairs; {})".format(len(recalled_pairs) / max(len(expected_pairs), 1),
+                                                                     len(recalled_pairs),
+                                                                     len(expected_pairs), source))
+        print("LSH: {:.2f}s ({:.2f}s of signatures)".format(lsh_time, signature_time))
+        print("Exhaustive: {:.2f}s".format(exhaustive_time))
@@ -0,0 +1,111 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from exams.models import Exam, Question
+from exams import utils
+import random
+import time
+
+# This command compares the session question allocation of SessionForm
+# before and after database-side sampling.  It builds a synthetic exam
+# inside a transaction that is always rolled back, so it is safe to
+# run against any database.
+
+def allocate_legacy(question_pool, number_of_questions):
+    pool_pks = list(question_pool.values_list('pk', flat=True))
+    random.shuffle(pool_pks)
+    sliced_pks = pool_pks[:number_of_questions]
+
+    selected_pool = Question.objects.filter(pk__in=sliced_pks)
+    questions_to_find_tree = selected_pool.filter(parent_question__isnull=False) | \
+                             selected_pool.filter(child_question__isnull=False)
+
+    pks = []
+    for question in questions_to_find_tree.distinct():
+        tree = question.get_tree()
+        new_pks = [q.pk for q in tree if not q.pk in pks]
+        pks += new_pks
+    questions_with_tree = Question.objects.filter(pk__in=pks).approved()
+
+    final_questions = list(questions_with_tree)
+    remaining_count = number_of_questions - questions_with_tree.count()
+    if remaining_count > 0:
+        orphan_questions = selected_pool.filter(parent_question__isnull=True,
+                                                child_question__isnull=True)
+        orphan_pool = Question.objects.filter(pk__in=orphan_questions[:remaining_count])
+        final_questions += list(orphan_pool)
+    return final_questions
+
+def allocate_sampled(question_pool, number_of_questions):
+    # This is what SessionForm runs.
+    return utils.allocate_session_question_pks(question_pool,
+                                               number_of_questions)
+
+class Rollback(Exception):
+    pass
+
+class Command(BaseCommand):
+    help = "Benchmark random question allocation of sessions against synthetic exams."
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000,10000,100000')
+        parser.add_argument('--number-of-questions', default=100, type=int)
+        parser.add_argument('--tree-ratio', default=0.1, type=float)
+        parser.add_argument('--repeat', default=3, type=int)
+
+    def create_exam(self, size, tree_ratio):
+        exam = Exam.objects.create(name="Sampling benchmark ({})".format(size))
+        Question.objects.bulk_create([Question(exam=exam, is_approved=True)
+                                      for i in range(size)],
+                                     batch_size=1000)
+        pks = list(exam.question_set.order_by('pk').values_list('pk', flat=True))
+
+        # Link questions into trees of two or three questions.
+        children = []
+        index = 0
+        while index < len(pks) - 2:
+            if random.random() < tree_ratio:
+                tree_size = random.choice([2, 3])
+                for position in range(1, tree_size):
+                    children.append(Question(pk=pks[index + position],
+                                             parent_question_id=pks[index + position - 1]))
+                index += tree_size
+            else:
+                index += 1
+        Question.objects.bulk_update(children, ['parent_question'],
+                                     batch_size=1000)
+        # bulk_update() does not fire signals.
+        utils.update_question_trees(pks)
+        return exam
+
+    def measure(self, function, question_pool, number_of_questions, repeat):
+        durations = []
+        query_counts = []
+        for i in range(repeat):
+            with CaptureQueriesContext(connection) as context:
+                start_time = time.perf_counter()
+                function(question_pool, number_of_questions)
+                durations.append(time.perf_counter() - start_time)
+            query_counts.append(len(context.captured_queries))
+        return min(durations), max(query_counts)
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        print("{:>8} {:>14} {:>10} {:>14} {:>10}".format("pool", "legacy (s)", "queries",
+                                                           "sampled (s)", "queries"))
+        for size in sizes:
+            try:
+                with transaction.atomic():
+                    exam = self.create_exam(size, options['tree_ratio'])
+                    question_pool = exam.question_set.approved()
+                    legacy = self.measure(allocate_legacy, question_pool,
+                                          options['number_of_questions'],
+                                          options['repeat'])
+                    sampled = self.measure(allocate_sampled, question_pool,
+                                           options['number_of_questions'],
+                                           options['repeat'])
+                    print("{:>8} {:>14.4f} {:>10} {:>14.4f} {:>10}".format(size,
+                                                                           legacy[0], legacy[1],
+                                                                           sampled[0], sampled[1]))
+                    raise Rollback
+            except Rollback:
+                pass
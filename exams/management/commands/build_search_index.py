@@ -0,0 +1,74 @@
+from django.apps import apps
+from django.db import connections
+from haystack import connections as haystack_connections
+from haystack.exceptions import NotHandled
+from haystack.management.commands import update_index
+from haystack.utils import get_model_ct
+from haystack.utils.app_loading import haystack_get_models
+from exams.search_backends import InvertedIndexSearchBackend
+import multiprocessing
+
+# This command takes the same options as haystack's update_index.  For
+# the inverted index backend (see exams/search_backends.py), every
+# batch of objects is written into its own segment by a worker process
+# (as many as --workers), and the segments are then made visible at
+# once.  Other backends are updated by update_index itself.
+
+def build_segment(args):
+    model_label, pks, using = args
+    model = apps.get_model(model_label)
+    index = haystack_connections[using].get_unified_index().get_index(model)
+    backend = haystack_connections[using].get_backend()
+    objects = index.index_queryset(using=using).filter(pk__in=pks)
+    return backend.write_documents(index, objects)
+
+class Command(update_index.Command):
+    help = "Builds the search index in parallel worker processes.  Takes the same options as update_index."
+
+    def update_backend(self, label, using):
+        backend = haystack_connections[using].get_backend()
+        if not isinstance(backend, InvertedIndexSearchBackend):
+            return super().update_backend(label, using)
+
+        unified_index = haystack_connections[using].get_unified_index()
+        for model in haystack_get_models(label):
+            try:
+                index = unified_index.get_index(model)
+            except NotHandled:
+                if self.verbosity >= 2:
+                    self.stdout.write("Skipping '%s' - no index." % model)
+                continue
+
+            qs = index.build_queryset(using=using, start_date=self.start_date,
+                                      end_date=self.end_date)
+            pks = list(qs.values_list('pk', flat=True))
+            if self.verbosity >= 1:
+                self.stdout.write("Indexing %d %s" % (len(pks), model._meta.verbose_name_plural))
+
+            batch_size = self.batchsize or backend.batch_size
+            tasks = [(model._meta.label, pks[start:start + batch_size], using)
+                     for start in range(0, len(pks), batch_size)]
+            if self.workers > 0:
+                # Forked workers must not share the database
+                # connections of this process, so they are closed
+                # before forking.  Closing them in the workers would
+                # terminate the sessions of this process as well.
+                connections.close_all()
+                pool = multiprocessing.Pool(self.workers)
+                segment_names = pool.map(build_segment, tasks)
+                pool.close()
+                pool.join()
+            else:
+                segment_names = [build_segment(task) for task in tasks]
+
+            # Without a date range, all documents of the model are
+            # rebuilt, so the ones that were not rebuilt are stale.
+            if self.start_date is None and self.end_date is None:
+                backend.install_segments(segment_names,
+                                         replaced_cts=[get_model_ct(model)])
+            else:
+                backend.install_segments(segment_names)
+                if self.remove:
+                    backend.remove_missing(model,
+                                           index.index_queryset(using=using)\
+                                                .values_list('pk', flat=True))
@@ -1,9 +1,61 @@
-from difflib import SequenceMatcher
 from django.core.management.base import BaseCommand
-from django.db.models import Count
+from django.db import transaction
+from django.db.models import Count, F, Q
+from exams import duplicates, sharding
 from exams.models import *
+from exams import utils
 import datetime
-import time
+import itertools
+
+# Both the fingerprinting and the matching of questions are cut into
+# shards of question primary key ranges within an exam (see
+# exams/sharding.py).  Workers only compute; this process stores the
+# fingerprints and the duplicate containers in batches.
+
+def fingerprint_shard(task):
+    exam_pk, pks, budget = task
+    fingerprints = []
+    for pk, revision_pk, text in Question.objects.filter(pk__in=pks)\
+                                                 .values_list('pk', 'best_revision',
+                                                              'best_revision__text'):
+        fingerprints.append((pk, exam_pk, revision_pk,
+                             duplicates.get_signature(text)))
+        budget.step()
+    return fingerprints
+
+# Workers usually get several shards of the same exam in a row, so
+# they keep the texts and LSH buckets of the last exam.  Dry runs
+# store nothing, so they pass the band values of the exam along
+# instead of reading the stored fingerprints.
+_exam_cache = {}
+
+def get_exam_data(exam_pk, band_values=None):
+    if not exam_pk in _exam_cache:
+        _exam_cache.clear()
+        texts = dict(Question.objects.filter(exam=exam_pk,
+                                             best_revision__isnull=False)\
+                                     .undeleted()\
+                                     .values_list('pk', 'best_revision__text'))
+        if band_values is None:
+            fingerprints = QuestionFingerprint.objects.filter(question__exam=exam_pk,
+                                                              question__is_deleted=False,
+                                                              revision=F('question__best_revision'))\
+                                                      .values_list('question', 'signature')
+            band_values = {pk: duplicates.get_band_values(duplicates.unpack_signature(signature))
+                           for pk, signature in fingerprints}
+        _exam_cache[exam_pk] = texts, band_values, duplicates.get_buckets(band_values)
+    return _exam_cache[exam_pk]
+
+def match_shard(task):
+    # Return the exam and the confirmed duplicate pairs of the
+    # questions of the shard (see duplicates.get_confirmed_pairs()).
+    exam_pk, pks, budget, cutoff, short_limit, exhaustive, with_earlier, band_values = task
+    texts, band_values, buckets = get_exam_data(exam_pk, band_values)
+    confirmed_pairs = duplicates.get_confirmed_pairs(pks, texts, band_values,
+                                                     buckets, cutoff,
+                                                     short_limit, exhaustive,
+                                                     with_earlier, budget.step)
+    return exam_pk, confirmed_pairs
 
 class Command(BaseCommand):
     help = "Clean-up tasks for the exam app"
@@ -12,20 +64,33 @@ class Command(BaseCommand):
                             default=False)
         parser.add_argument('--dry', action='store_true',
                             default=False)
-        parser.add_argument('--cutoff', default=0.85,
+        parser.add_argument('--cutoff', default=duplicates.DEFAULT_CUTOFF,
                             type=float)
-        parser.add_argument('--short-limit', default=70,
+        parser.add_argument('--short-limit', default=duplicates.DEFAULT_SHORT_LIMIT,
                             type=int)
         parser.add_argument('--fast', action='store_true',
-                            default=False)
+                            default=False,
+                            help="Run at full speed, same as --budget 1.")
+        parser.add_argument('--budget', default=0.1, type=float,
+                            help="The fraction of time every worker spends working, rather than sleeping.")
+        parser.add_argument('--workers', default=0, type=int,
+                            help="The number of worker processes.  By default, everything runs in this process.")
+        parser.add_argument('--shard-size', default=500, type=int)
+        parser.add_argument('--batch-size', default=100, type=int)
         parser.add_argument('--exam-pk', default=None, type=int)
+        parser.add_argument('--exhaustive', action='store_true',
+                            default=False,
+                            help="Compare every pair of questions rather than LSH candidates.")
+        parser.add_argument('--rescan', action='store_true',
+                            default=False,
+                            help="Re-fingerprint and rescan all questions, e.g. after changing the thresholds.")
 
     def handle(self, *args, **options):
-        if not options['fast']:
-            question_count = Question.objects.undeleted().count()
-            # Run over 20 hours
-            total_seconds = 60 * 60 * 20
-            sleep_time = question_count / total_seconds
+        if options['fast']:
+            budget = sharding.Budget(1)
+        else:
+            budget = sharding.Budget(options['budget'])
+        _exam_cache.clear()
 
         # Clean up duplicate containers with no undeleted questions
         obsolete_containers =  DuplicateContainer.objects.filter(status='PENDING')\
@@ -39,111 +104,126 @@ class Command(BaseCommand):
             print("Found {} obsolute containers.  Deleting...".format(obsolete_containers.count()))
         obsolete_containers.delete()
 
+        pool = Question.objects.filter(best_revision__isnull=False)\
+                               .undeleted()
         if options['exam_pk']:
-            exams = Exam.objects.filter(pk=options['exam_pk'])
-        else:
-            exams = Exam.objects.order_by('pk')
+            pool = pool.filter(exam=options['exam_pk'])
 
-        for exam in exams:
-            if options['verbose']:
-                print("Scanning {}...".format(exam.name))
-            pool = list(Question.objects.select_related('best_revision')\
-                                        .filter(exam=exam,
-                                                best_revision__isnull=False)\
-                                        .undeleted()\
-                                        .order_by('pk'))
+        # Questions are matched against the stored fingerprints of
+        # their exam whenever their best revision changes (see
+        # utils.update_question_fingerprints()), so only questions
+        # with a missing or outdated fingerprint need to be matched
+        # here.  A full scan is only needed when the thresholds
+        # change.  Dry runs always scan.
+        is_full_scan = options['rescan'] or options['exhaustive'] or \
+                       options['dry']
+        if is_full_scan:
+            questions_to_match = pool
+        else:
+            questions_to_match = pool.filter(Q(fingerprint__isnull=True) | \
+                                             ~Q(fingerprint__revision=F('best_revision')))
+        shards = sharding.get_shards(questions_to_match.values_list('exam', 'pk'),
+                                     options['shard_size'])
+        if options['verbose']:
+            print("Matching {} questions in {} shards...".format(sum(len(pks) for exam_pk, pks in shards),
+                                                                len(shards)))
 
-            # We keep a list of revisions that have already been found to
-            # be duplicate so we do not re-scan them.
-            found = []
-            for first_question in pool:
-                duplicates = []
-                # If the revision has been reported to be a duplicate,
-                # skip it.
-                if first_question.pk in found:
+        # A dry run must not write, so its fingerprints are kept in
+        # memory and handed to the matching shards.  Dry runs are
+        # always full scans, so these cover every question of the
+        # exam.
+        dry_band_values = {}
+        if not options['exhaustive']:
+            start_time = datetime.datetime.now()
+            tasks = [(exam_pk, pks, budget) for exam_pk, pks in shards]
+            fingerprints = []
+            for shard_fingerprints in sharding.run_shards(fingerprint_shard, tasks,
+                                                          options['workers']):
+                if options['dry']:
+                    for question_pk, exam_pk, revision_pk, signature in shard_fingerprints:
+                        dry_band_values.setdefault(exam_pk, {})[question_pk] = duplicates.get_band_values(signature)
                     continue
-                if options['verbose']:
-                    start_time = datetime.datetime.now()
-                for second_question in pool:
-                    # As a general rule: the duplicate container
-                    # primary question is always the question with the
-                    # smaller primary key.  If the primary key of the
-                    # first question is higher than that of the second
-                    # question, skip the scan, as it must have been
-                    # done before.
-                    if first_question.pk >= second_question.pk:
-                        continue
-
-                    matcher = SequenceMatcher(None, first_question.best_revision.text,
-                                              second_question.best_revision.text)
-                    ratio = matcher.ratio()
-
-                    # If the revision is too short, we use a higher
-                    # cutt off.
-                    is_short = len(first_question.best_revision.text) <= options['short_limit']
-
-                    if is_short and ratio >= 0.90 or \
-                       not is_short and ratio >= options['cutoff']:
-                        found.append(second_question.pk)
-                        duplicates.append((second_question, ratio))
-                        if options['verbose']:
-                            print("1st:", first_question.best_revision.text)
-                            print("2nd:", second_question.best_revision.text)
-                            print(second_question.pk, second_question.pk, ratio)
-                if not options['dry'] and duplicates:
-                    # If an identical previous container has been
-                    # declined, do not re-create it.
-                    declined_container = DuplicateContainer.objects.filter(primary_question=first_question,
-                                                                           status="DECLINED")
-                    for question, ratio in duplicates:
-                        declined_container = declined_container.filter(duplicate__question=question)
-                    if declined_container.exists():
-                        print("Question #{}: An identical previous container was declined. Skip this one.".format(first_question.pk))
-                        continue
+                fingerprints += shard_fingerprints
+                if len(fingerprints) >= options['batch_size']:
+                    with transaction.atomic():
+                        utils.store_question_fingerprints(fingerprints)
+                    fingerprints = []
+            if fingerprints:
+                with transaction.atomic():
+                    utils.store_question_fingerprints(fingerprints)
+            if options['verbose']:
+                end_time = datetime.datetime.now()
+                print("Fingerprinting took: {}".format(end_time - start_time))
 
-                    # If a previous container is pending, get it, so
-                    # we can add to it,
-                    container, was_created = DuplicateContainer.objects.get_or_create(
-                        status="PENDING",
-                        primary_question=first_question)
-                    for question, ratio in duplicates:
-                        Duplicate.objects.get_or_create(container=container,
-                                                        question=question,
-                                                        defaults={'ratio':ratio})
-                if options['verbose']:
-                    end_time = datetime.datetime.now()
-                    print("Question #{}: It took: {}".format(first_question.pk, end_time - start_time))
-                if not options['fast']:
-                    if options['verbose']:
-                        print("Sleeping for {}...".format(sleep_time))
-                    time.sleep(sleep_time)
+        # As a general rule: the duplicate container primary question
+        # is always the question with the smaller primary key.
+        # Questions that have been found to be duplicates are not
+        # primary questions (see duplicates.group_duplicates()).
+        # Unless --exhaustive is given, only the candidate pairs of
+        # the LSH index are compared.
+        start_time = datetime.datetime.now()
+        tasks = [(exam_pk, pks, budget, options['cutoff'],
+                  options['short_limit'], options['exhaustive'],
+                  not is_full_scan, dry_band_values.get(exam_pk))
+                 for exam_pk, pks in shards]
+        results = sharding.run_shards(match_shard, tasks, options['workers'])
+        for exam_pk, exam_results in itertools.groupby(results, key=lambda result: result[0]):
+            pairs = set()
+            for exam_pk, confirmed_pairs in exam_results:
+                pairs.update(confirmed_pairs)
+            # Incremental runs only see the pairs of stale questions,
+            # so groups are adjusted to the existing containers.
+            groups = utils.resolve_duplicate_groups(duplicates.group_duplicates(pairs))
+            if options['verbose']:
+                for primary_pk, duplicate_pairs in groups:
+                    for question_pk, ratio in duplicate_pairs:
+                        print("Exam #{}: Q#{} duplicates Q#{} ({})".format(exam_pk, question_pk,
+                                                                           primary_pk, ratio))
+            if options['dry']:
+                continue
+            for start in range(0, len(groups), options['batch_size']):
+                with transaction.atomic():
+                    declined_pks = utils.add_duplicates_in_bulk(groups[start:start + options['batch_size']])
+                for primary_pk in declined_pks:
+                    print("Question #{}: An identical previous container was declined. Skip this one.".format(primary_pk))
+        if options['verbose']:
+            end_time = datetime.datetime.now()
+            print("Matching took: {}".format(end_time - start_time))
 
         # Some duplicates can be solved automatically: if the ratio is
         # 100% and the question pks are subsequent, this indicates
         # that the duplication is the result of a double creation
         # click.  We can keep the primary question and remoe others.
-        for container in DuplicateContainer.objects.select_related('primary_question',
-                                                                   'primary_question__best_revision')\
-                                           .filter(status="PENDING",
-                                                   duplicate__ratio=1)\
-                                           .exclude(duplicate__ratio__lt=1)\
-                                           .order_by('primary_question')\
-                                           .distinct():
-            consistant = False
-            expected_pk = container.primary_question.pk + 1
-            question_ids = container.duplicate_set.values_list('question', flat=True)\
-                                                  .order_by('question')
-            for question_id in question_ids:
-                if expected_pk == question_id:
-                    consistant = True
-                    expected_pk += 1
-                else:
-                    consistant = False
-                    break
-            if consistant:
-                if options['verbose']:
-                    question_id_str = ", ".join(question_ids)
-                    print("Keeping {}, and deleting {}...".format(container.primary_question.pk, question_id_str))
-                container.keep(container.primary_question)
-                container.status = 'KEPT'
-                container.save()
+        # Questions are recomputed once, after all merges.
+        with utils.defer_revision_updates():
+            for container in DuplicateContainer.objects.select_related('primary_question',
+                                                                       'primary_question__best_revision')\
+                                               .filter(status="PENDING",
+                                                       duplicate__ratio=1)\
+                                               .exclude(duplicate__ratio__lt=1)\
+                                               .order_by('primary_question')\
+                                               .distinct():
+                consistant = False
+                expected_pk = container.primary_question.pk + 1
+                question_ids = container.duplicate_set.values_list('question', flat=True)\
+                                                      .order_by('question')
+                for question_id in question_ids:
+                    if expected_pk == question_id:
+                        consistant = True
+                        expected_pk += 1
+                    else:
+                        consistant = False
+                        break
+                if consistant:
+                    if options['verbose']:
+                        question_id_str = ", ".join(map(str, question_ids))
+                        print("Keeping {}, and deleting {}...".format(container.primary_question.pk, question_id_str))
+                    report = container.keep(container.primary_question)
+                    if options['verbose']:
+                        print("Merged in {seconds}s: {moved_answers} answers, "
+                              "{moved_corrections} corrections, "
+                              "{added_session_questions} sessions added and "
+                              "{removed_session_questions} session questions removed, "
+                              "{changed_session_counters} session counters changed.".format(**report))
+                    container.status = 'KEPT'
+                    container.save()
@@ -1,9 +1,18 @@
 from django.core.management.base import BaseCommand
-from django.db.models import Q, Count
+from django.db import transaction
+from django.db.models import Count, F, Max, Min, Q
 from exams.models import Session, Question
+from exams import utils
 
 class Command(BaseCommand):
     help = "Clean-up tasks for the exam app"
+    def add_arguments(self, parser):
+        parser.add_argument('--verbose', action='store_true',
+                            default=False)
+        parser.add_argument('--incremental', action='store_true',
+                            default=False,
+                            help="Only renumber from the first tree with new or re-parented questions onward.")
+        parser.add_argument('--chunk-size', default=1000, type=int)
 
     def handle(self, *args, **options):
         # This script does three things:
@@ -32,22 +41,94 @@ class Command(BaseCommand):
                         .filter(revision_count=0)\
                         .update(is_deleted=True)
 
-        sorted_questions = []
-        count = 1
-        # To give global sequence more stability, we won't exclude
-        # deleted question here.
-        for question in Question.objects.select_related('parent_question',
-                                                        'child_question')\
-                                        .order_by('pk'):
-            # Update the global sequence of questions.
-            if question.pk in sorted_questions:
-                continue
-
-            tree = question.get_tree()
-
-            for tree_question in tree:
-                if tree_question.global_sequence != count:
-                    tree_question.global_sequence = count
-                    tree_question.save()
+        # 3) Update the global sequence of questions.
+        changed_count = self.update_global_sequences(options['incremental'],
+                                                     options['chunk_size'])
+        if options['verbose']:
+            print("Updated the global sequence of {} questions.".format(changed_count))
+
+    def get_first_affected_pk(self):
+        # Trees are numbered in the order of their smallest PK.  A tree
+        # needs renumbering if any of its questions was never
+        # sequenced (i.e. newly added), or if its sequences no longer
+        # follow the tree positions (i.e. questions were re-parented
+        # into it).
+        sequence_offset = F('global_sequence') - F('tree_position')
+        return Question.objects.values('tree_root')\
+                               .annotate(first_pk=Min('pk'),
+                                         unsequenced_count=Count('pk', filter=Q(global_sequence__isnull=True)),
+                                         lowest_offset=Min(sequence_offset),
+                                         highest_offset=Max(sequence_offset))\
+                               .filter(Q(unsequenced_count__gt=0) |
+                                       ~Q(lowest_offset=F('highest_offset')))\
+                               .order_by()\
+                               .aggregate(first_affected_pk=Min('first_pk'))['first_affected_pk']
+
+    def update_global_sequences(self, incremental, chunk_size):
+        if incremental:
+            # Questions saved through the ORM are indexed by a signal,
+            # so only index what might have been missed.
+            unindexed_pks = list(Question.objects.filter(tree_root__isnull=True)\
+                                                 .values_list('pk', flat=True))
+            if unindexed_pks:
+                utils.update_question_trees(unindexed_pks)
+            first_affected_pk = self.get_first_affected_pk()
+            if first_affected_pk is None:
+                return 0
+            questions = Question.objects.filter(pk__gte=first_affected_pk)\
+                                        .with_trees()
+        else:
+            # The question tree index is rebuilt first (which also
+            # fixes any drift).
+            utils.update_question_trees()
+            first_affected_pk = None
+            # To give global sequence more stability, we won't exclude
+            # deleted question here.
+            questions = Question.objects.all()
+
+        # One ordered pass: since questions are ordered by PK, trees
+        # are inserted in the order of their smallest PK.
+        trees = {}
+        current_sequences = {}
+        for pk, tree_root_pk, tree_position, global_sequence in \
+            questions.order_by('pk')\
+                     .values_list('pk', 'tree_root', 'tree_position',
+                                  'global_sequence')\
+                     .iterator():
+            trees.setdefault(tree_root_pk, []).append((tree_position, pk))
+            current_sequences[pk] = global_sequence
+
+        if incremental:
+            # Trees that start before the first affected one keep
+            # their sequences, and we continue right after the
+            # highest of them.  Deleted or re-parented questions leave
+            # gaps, so we cannot just count the kept questions.
+            kept_sequences = [Question.objects.exclude(pk__in=questions.values('pk'))\
+                                              .aggregate(highest_sequence=Max('global_sequence'))['highest_sequence']]
+            for tree_root_pk, tree in list(trees.items()):
+                if min(pk for tree_position, pk in tree) < first_affected_pk:
+                    kept_sequences += [current_sequences[pk]
+                                       for tree_position, pk in tree]
+                    del trees[tree_root_pk]
+            count = max([sequence for sequence in kept_sequences
+                         if sequence is not None], default=0) + 1
+        else:
+            count = 1
+
+        changed_questions = []
+        for tree in trees.values():
+            for tree_position, pk in sorted(tree):
+                if current_sequences[pk] != count:
+                    changed_questions.append(Question(pk=pk,
+                                                      global_sequence=count))
                 count += 1
-                sorted_questions.append(tree_question.pk)
+
+        # bulk_update() does not fire model signals, which are not
+        # needed for the global sequence.  Session question orders
+        # follow the global sequence, though.
+        for start in range(0, len(changed_questions), chunk_size):
+            chunk = changed_questions[start:start + chunk_size]
+            with transaction.atomic():
+                Question.objects.bulk_update(chunk, ['global_sequence'])
+                utils.reset_session_question_orders([question.pk for question in chunk])
+        return len(changed_questions)
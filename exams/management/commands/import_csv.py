@@ -7,6 +7,7 @@ import os
 import urllib.parse
 
 from exams.models import *
+from exams import utils
 
 
 # We use subject/source/exam_type pools with a somewhat
@@ -43,6 +44,24 @@ class Command(BaseCommand):
         parser.add_argument('--submitter-email', default=None)
 
     def handle(self, *args, **options):
+        added_pks = self.import_questions(*args, **options)
+
+        # Imported questions are approved regardless of what
+        # update_questions_from_revisions() derives for them (e.g.
+        # without a right answer), so this comes after the deferred
+        # recomputation.
+        if not options['is_disapproved']:
+            Question.objects.filter(pk__in=added_pks).update(is_approved=True)
+            Revision.objects.filter(question_id__in=added_pks).update(is_approved=True)
+            # update() does not fire the signals that keep these
+            # current.
+            utils.update_question_search_index(added_pks)
+            utils.invalidate_exam_question_caches([options['exam_pk']])
+
+    # Revisions are saved one by one, so question fields derived from
+    # them are recomputed once, after the whole import.
+    @utils.defer_revision_updates()
+    def import_questions(self, *args, **options):
         csv_file = open(options['question_csv'])
         question_reader = csv.reader(csv_file)
         exam = Exam.objects.get(pk=options['exam_pk'])
@@ -290,8 +309,6 @@ class Command(BaseCommand):
                     choice.question = question
                     choice.save()
                 revision.choices.add(*choices)
-                question.best_revision = revision
-                question.save()
                 print("sequence", sequence)
 
                 if options['figure_csv'] and sequence in figures:
@@ -320,6 +337,4 @@ class Command(BaseCommand):
 
                 added_pks.append(question.pk)
                 
-        if not options['is_disapproved']:
-            Question.objects.filter(pk__in=added_pks).update(is_approved=True)
-            Revision.objects.filter(question_id__in=added_pks).update(is_approved=True)
+        return added_pks
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from exams.models import Question
+from exams import text_search, utils
+
+# The text search indexes are maintained by the revision signal.  This
+# command rebuilds them from scratch (e.g. after they are created, or
+# after bulk changes that bypass signals), a chunk of questions at a
+# time.
+
+class Command(BaseCommand):
+    help = "Rebuild the question text search indexes"
+    def add_arguments(self, parser):
+        parser.add_argument('--verbose', action='store_true',
+                            default=False)
+        parser.add_argument('--chunk-size', default=1000, type=int)
+
+    def handle(self, *args, **options):
+        if not text_search.is_supported():
+            print("Text search indexes are not supported on this database.")
+            return
+
+        # 1) The autocomplete index
+        question_pks = list(Question.objects.undeleted()\
+                                            .filter(preview_revision__isnull=False)\
+                                            .order_by('pk')\
+                                            .values_list('pk', flat=True))
+        with transaction.atomic():
+            text_search.clear_autocomplete_index()
+            for start in range(0, len(question_pks), options['chunk_size']):
+                chunk_pks = question_pks[start:start + options['chunk_size']]
+                question_texts = Question.objects.filter(pk__in=chunk_pks)\
+                                                 .values_list('pk', 'exam_id',
+                                                              'preview_revision__text')
+                text_search.index_autocomplete_texts(list(question_texts))
+                if options['verbose']:
+                    print("Indexed {} of {} questions for autocomplete.".format(start + len(chunk_pks),
+                                                                               len(question_pks)))
+
+        # 2) The search index
+        question_pks = list(Question.objects.filter(best_revision__isnull=False)\
+                                            .order_by('pk')\
+                                            .values_list('pk', flat=True))
+        with transaction.atomic():
+            text_search.clear_search_index()
+            for start in range(0, len(question_pks), options['chunk_size']):
+                chunk_pks = question_pks[start:start + options['chunk_size']]
+                utils.update_question_search_index(chunk_pks)
+                if options['verbose']:
+                    print("Indexed {} of {} questions for search.".format(start + len(chunk_pks),
+                                                                         len(question_pks)))
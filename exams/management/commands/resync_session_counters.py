@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from exams.models import Session
+from exams import utils
+
+class Command(BaseCommand):
+    help = "Recompute the stored answer and question counts of sessions to repair drift."
+    def add_arguments(self, parser):
+        parser.add_argument('--verbose', action='store_true',
+                            default=False)
+        parser.add_argument('--exam-pk', default=None, type=int)
+        parser.add_argument('--session-pk', default=None, type=int)
+        parser.add_argument('--chunk-size', default=1000, type=int)
+
+    def handle(self, *args, **options):
+        sessions = Session.objects.order_by('pk')
+        if options['exam_pk']:
+            sessions = sessions.filter(exam__pk=options['exam_pk'])
+        if options['session_pk']:
+            sessions = sessions.filter(pk=options['session_pk'])
+
+        session_pks = list(sessions.values_list('pk', flat=True))
+        changed_count = 0
+        for start in range(0, len(session_pks), options['chunk_size']):
+            chunk = session_pks[start:start + options['chunk_size']]
+            changed_count += utils.update_session_counters(chunk)
+            if options['verbose']:
+                print("Checked {} of {} sessions...".format(start + len(chunk),
+                                                            len(session_pks)))
+
+        if options['verbose']:
+            print("Fixed the counters of {} sessions.".format(changed_count))
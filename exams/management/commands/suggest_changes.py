@@ -1,10 +1,65 @@
 from django.core.management.base import BaseCommand
+from django.db import transaction
 from django.db.models import Count
-from exams.forms import RevisionForm 
+from django.utils import timezone
+from exams import sharding, utils
 from exams.models import *
+from exams.rule_scanner import RuleScanner
 import datetime
-import re
-import time
+import functools
+import json
+
+# Revisions are scanned in shards of question primary key ranges
+# within an exam (see exams/sharding.py).  Workers only compute; this
+# process stores the suggested changes in batches.
+
+@functools.lru_cache(maxsize=4)
+def get_scanners(rules):
+    # rules is a tuple of (rule primary key, regex pattern, scope)
+    # tuples.  Return the scanners of revision texts and of choices.
+    text_scanner = RuleScanner([(rule_pk, regex_pattern)
+                                for rule_pk, regex_pattern, scope in rules
+                                if scope in ['ALL', 'REVISIONS']])
+    choice_scanner = RuleScanner([(rule_pk, regex_pattern)
+                                  for rule_pk, regex_pattern, scope in rules
+                                  if scope in ['ALL', 'CHOICES']])
+    return text_scanner, choice_scanner
+
+def scan_shard(task):
+    # Return a list of (revision primary key, [rule primary keys])
+    # tuples of the latest revisions of the questions of the shard.
+    # Revisions submitted before `since` (if given) are only scanned
+    # with the changed rules.
+    exam_pk, pks, budget, rules, since, changed_rule_pks = task
+    revisions = Revision.objects.filter(question__in=pks,
+                                        is_last=True)\
+                                .undeleted()
+    if since and not changed_rule_pks:
+        revisions = revisions.filter(submission_date__gte=since)
+    revisions = list(revisions.order_by('question__pk')\
+                              .values_list('pk', 'text', 'submission_date'))
+    choice_texts = {}
+    for revision_pk, choice_text in Revision.choices.through.objects\
+                                                    .filter(revision__in=[revision[0] for revision in revisions])\
+                                                    .values_list('revision', 'choice__text'):
+        choice_texts.setdefault(revision_pk, []).append(choice_text)
+
+    all_scanners = get_scanners(rules)
+    changed_scanners = get_scanners(tuple(rule for rule in rules
+                                          if rule[0] in changed_rule_pks))
+    revision_rules = []
+    for revision_pk, text, submission_date in revisions:
+        if since is None or submission_date >= since:
+            text_scanner, choice_scanner = all_scanners
+        else:
+            text_scanner, choice_scanner = changed_scanners
+        rule_pks = text_scanner.scan(text)
+        for choice_text in choice_texts.get(revision_pk, []):
+            rule_pks |= choice_scanner.scan(choice_text)
+        if rule_pks:
+            revision_rules.append((revision_pk, sorted(rule_pks)))
+        budget.step()
+    return revision_rules
 
 class Command(BaseCommand):
     help = "Clean-up tasks for the exam app"
@@ -14,21 +69,39 @@ class Command(BaseCommand):
         parser.add_argument('--dry', action='store_true',
                             default=False)
         parser.add_argument('--fast', action='store_true',
-                            default=False)
+                            default=False,
+                            help="Run at full speed, same as --budget 1.")
+        parser.add_argument('--budget', default=0.1, type=float,
+                            help="The fraction of time every worker spends working, rather than sleeping.")
+        parser.add_argument('--workers', default=0, type=int,
+                            help="The number of worker processes.  By default, everything runs in this process.")
+        parser.add_argument('--shard-size', default=500, type=int)
+        parser.add_argument('--batch-size', default=100, type=int)
         parser.add_argument('--exam-pk', default=None, type=int)
+        parser.add_argument('--incremental', action='store_true',
+                            default=False,
+                            help="Only scan revisions submitted since the last scan, and older ones with the rules that changed since.")
 
     def handle(self, *args, **options):
-        if not options['fast']:
-            question_count = Question.objects.undeleted().count()
-            # Run over 10 hours
-            total_seconds = 60 * 60 * 10
-            sleep_time = question_count / total_seconds
-        rules = list(Rule.objects.filter(is_disabled=False))
-
-        # Providing initial compiled regexes speeds things up.
-        compiled_rules = {}
-        for rule in rules:
-            compiled_rules[rule.pk] = re.compile(rule.regex_pattern)
+        if options['fast']:
+            budget = sharding.Budget(1)
+        else:
+            budget = sharding.Budget(options['budget'])
+        start_date = timezone.now()
+        rules = tuple(Rule.objects.filter(is_disabled=False)\
+                                  .order_by('pk')\
+                                  .values_list('pk', 'regex_pattern', 'scope'))
+        since = None
+        changed_rule_pks = frozenset()
+        if options['incremental']:
+            last_scan = RuleScan.objects.order_by('-start_date').first()
+            if last_scan:
+                since = last_scan.start_date
+                last_rules = last_scan.get_rules()
+                changed_rule_pks = frozenset(rule_pk for rule_pk, regex_pattern, scope in rules
+                                             if last_rules.get(rule_pk) != (regex_pattern, scope))
+                if options['verbose']:
+                    print("Scanning revisions since {}, and older ones with {} changed rules.".format(since, len(changed_rule_pks)))
 
         # Clean up suggested edits that are no longer related to best revision
         without_rules = SuggestedChange.objects.annotate(rule_count=Count('rules'))\
@@ -43,50 +116,50 @@ class Command(BaseCommand):
         without_rules.delete()
         with_deleted_questions.delete()
 
+        revision_filters = {'revision__is_last': True,
+                            'revision__is_deleted': False}
+        if since and not changed_rule_pks:
+            revision_filters['revision__submission_date__gte'] = since
+        pool = Question.objects.filter(**revision_filters)
         if options['exam_pk']:
-            exams = Exam.objects.filter(pk=options['exam_pk'])
-        else:
-            exams = Exam.objects.order_by('pk')
+            pool = pool.filter(exam=options['exam_pk'])
+        shards = sharding.get_shards(pool.values_list('exam', 'pk').distinct(),
+                                     options['shard_size'])
+        if options['verbose']:
+            print("Scanning {} shards...".format(len(shards)))
 
-        for exam in exams:
+        start_time = datetime.datetime.now()
+        tasks = [(exam_pk, pks, budget, rules, since, changed_rule_pks)
+                 for exam_pk, pks in shards]
+        revision_rules = []
+        for shard_revision_rules in sharding.run_shards(scan_shard, tasks,
+                                                        options['workers']):
             if options['verbose']:
-                print("Scanning {}...".format(exam.name))
-            pool = list(Revision.objects.select_related('question')\
-                                        .filter(question__exam=exam,
-                                                is_last=True)\
-                                        .undeleted()\
-                                        .order_by('question__pk'))
+                for revision_pk, rule_pks in shard_revision_rules:
+                    print("We found {} rules for revision #{}".format(len(rule_pks), revision_pk))
+            if options['dry']:
+                continue
+            revision_rules += shard_revision_rules
+            if len(revision_rules) >= options['batch_size']:
+                self.add_suggested_changes(revision_rules, options)
+                revision_rules = []
+        self.add_suggested_changes(revision_rules, options)
+        if options['verbose']:
+            end_time = datetime.datetime.now()
+            print("Scanning took: {}".format(end_time - start_time))
+
+        # Only complete scans are a starting point for incremental
+        # ones.
+        if not options['dry'] and not options['exam_pk']:
+            RuleScan.objects.create(start_date=start_date,
+                                    rules=json.dumps({rule_pk: [regex_pattern, scope]
+                                                      for rule_pk, regex_pattern, scope in rules}))
 
-            for revision in pool:
-                applied_rules = []
-                for rule in rules:
-                    compiled_regex = compiled_rules[rule.pk]
-                    if rule.scope in ['ALL', 'REVISIONS']:
-                        match = re.search(compiled_regex,
-                                          revision.text)
-                        if match:
-                            applied_rules.append(rule)
-                    if rule.scope in ['ALL', 'CHOICES']:
-                        for choice in revision.choices.all():
-                            match = re.search(compiled_regex,
-                                              choice.text)
-                            if match:
-                                applied_rules.append(rule)
-                if applied_rules:
-                    if not options['dry']:
-                        declined_suggestions = SuggestedChange.objects.filter(revision=revision,
-                                                                              status="DECLINED")
-                        for rule in applied_rules:
-                            declined_suggestions = declined_suggestions.filter(rules__pk=rule.pk)
-                        if declined_suggestions.exists():
-                            if options['verbose']:
-                                print("Revision #{}: An identical previous container was declined. Skip this one.".format(revision.pk))
-                            continue
-                        suggestion, was_created = SuggestedChange.objects.get_or_create(status="PENDING", revision=revision)
-                        suggestion.rules.add(*applied_rules)
-                    if options['verbose']:
-                        print("We found {} rules for Q#{} in {}".format(len(applied_rules), revision.question.pk, exam.name))
-                if not options['fast']:
-                    if options['verbose']:
-                        print("Sleeping for {}...".format(sleep_time))
-                    time.sleep(sleep_time)
+    def add_suggested_changes(self, revision_rules, options):
+        if not revision_rules:
+            return
+        with transaction.atomic():
+            declined_pks = utils.add_suggested_changes_in_bulk(revision_rules)
+        if options['verbose']:
+            for revision_pk in declined_pks:
+                print("Revision #{}: An identical previous container was declined. Skip this one.".format(revision_pk))
@@ -16,8 +16,10 @@ class Command(BaseCommand):
             cursor.execute('SET statement_timeout=0;')
 
             # Updating total_user_count and correct_first_timer_count
-            cursor.execute("UPDATE exams_question SET total_user_count=(SELECT COUNT(exams_answer.id) FROM exams_answer INNER JOIN exams_choice ON exams_answer.choice_id=exams_choice.id INNER JOIN exams_session ON exams_answer.session_id=exams_session.id WHERE exams_answer.question_id=exams_question.id AND is_first=TRUE AND exams_answer.choice_id IS NOT NULL);")
-            cursor.execute("UPDATE exams_question SET correct_first_timer_count=(SELECT COUNT(exams_answer.id) FROM exams_answer INNER JOIN exams_choice ON exams_answer.choice_id=exams_choice.id WHERE exams_answer.question_id=exams_question.id AND is_first=TRUE AND is_right=TRUE);")
+            # from the compact FirstAnswer table rather than the whole
+            # answer history.
+            cursor.execute("UPDATE exams_question SET total_user_count=(SELECT COUNT(exams_firstanswer.id) FROM exams_firstanswer WHERE exams_firstanswer.question_id=exams_question.id);")
+            cursor.execute("UPDATE exams_question SET correct_first_timer_count=(SELECT COUNT(exams_firstanswer.id) FROM exams_firstanswer INNER JOIN exams_answer ON exams_firstanswer.answer_id=exams_answer.id INNER JOIN exams_choice ON exams_answer.choice_id=exams_choice.id WHERE exams_firstanswer.question_id=exams_question.id AND exams_choice.is_right=TRUE);")
 
             for difficulty in Difficulty.objects.all():
                 if options['verbose']:
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from django.db.models import OuterRef, Subquery
+from exams.models import Question, Revision
+from exams import utils
+
+# Question previews are maintained by the revision signal.  This
+# command fills them for existing questions (or repairs them), a chunk
+# of questions at a time, without firing any signals.
+
+class Command(BaseCommand):
+    help = "Populate the cached text preview of questions"
+    def add_arguments(self, parser):
+        parser.add_argument('--verbose', action='store_true',
+                            default=False)
+        parser.add_argument('--chunk-size', default=1000, type=int)
+
+    def handle(self, *args, **options):
+        latest_revisions = Revision.objects.filter(question=OuterRef('pk'),
+                                                   is_deleted=False)\
+                                           .order_by('-submission_date', '-pk')
+        question_pks = list(Question.objects.order_by('pk')\
+                                            .values_list('pk', flat=True))
+        updated_count = 0
+        for start in range(0, len(question_pks), options['chunk_size']):
+            chunk_pks = question_pks[start:start + options['chunk_size']]
+            questions = Question.objects.filter(pk__in=chunk_pks)\
+                                        .annotate(latest_revision_pk=Subquery(latest_revisions.values('pk')[:1]))\
+                                        .only('pk', 'preview_revision')
+            stale_questions = [question for question in questions
+                               if question.latest_revision_pk and \
+                                  question.latest_revision_pk != question.preview_revision_id]
+            revision_texts = dict(Revision.objects\
+                                          .filter(pk__in=[question.latest_revision_pk
+                                                          for question in stale_questions])\
+                                          .values_list('pk', 'text'))
+            for question in stale_questions:
+                question.preview_revision_id = question.latest_revision_pk
+                question.preview_text = utils.get_text_preview(revision_texts[question.latest_revision_pk])
+            Question.objects.bulk_update(stale_questions,
+                                         ['preview_revision',
+                                          'preview_text'])
+            # Cached question bundles hold the old previews.
+            utils.bump_question_bundle_versions([question.pk for question in stale_questions])
+            updated_count += len(stale_questions)
+            if options['verbose']:
+                print("Handled {} of {} questions.".format(start + len(chunk_pks),
+                                                          len(question_pks)))
+
+        if options['verbose']:
+            print("Updated the preview of {} questions.".format(updated_count))
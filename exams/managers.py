@@ -11,66 +11,41 @@ class QuestionQuerySet(models.QuerySet):
                    .exclude(best_revision__is_approved=True)\
                    .distinct()
 
+    # The following *_by_user methods resolve through
+    # UserQuestionState, which has one row per user and question, so
+    # no .distinct() is needed.  Deleted sessions are already
+    # accounted for in that table.
+
     def used_by_user(self, user, exclude_skipped=True):
-        kwargs = {'answer__session__submitter': user,
-                  'answer__session__is_deleted': False}
+        kwargs = {'user_states__user': user}
         if exclude_skipped:
-            kwargs['answer__choice__isnull'] = False
-        return self.filter(**kwargs)\
-                   .distinct()
+            kwargs['user_states__best_result__in'] = ['CORRECT', 'INCORRECT']
+        return self.filter(**kwargs)
 
     def unused_by_user(self, user, exclude_skipped=True):
-
-        kwargs = {'answer__session__submitter': user,
-                  'answer__session__is_deleted': False}
+        from .models import UserQuestionState
+        used_states = UserQuestionState.objects.filter(user=user)
         if exclude_skipped:
-            kwargs['answer__choice__isnull'] = False
-
-        # We have to do this funny queryset to account for
-        # session.is_deleted.  Otherwise, it won't be considered.
-        excluded_pks = self.filter(**kwargs).values_list('pk')
-
-        return self.exclude(pk__in=excluded_pks)\
-                   .distinct()
+            used_states = used_states.filter(best_result__in=['CORRECT', 'INCORRECT'])
+        return self.exclude(pk__in=used_states.values('question'))
 
     def correct_by_user(self, user):
         # As a general rule, we will show statistics that are in favor
         # of the user.  For example, if a question has one correct
         # answer, then the user got it (regardless of whether it has
         # other incorrect/skipped answers).
-        return self.filter(answer__choice__is_right=True,
-                           answer__session__is_deleted=False,
-                           answer__session__submitter=user)\
-                   .distinct()
+        return self.filter(user_states__user=user,
+                           user_states__best_result='CORRECT')
 
     def incorrect_by_user(self, user):
         # See the note in 'self.correct_by_user()'
-        excluded_pks = self.filter(answer__choice__is_right=True,
-                                   answer__session__is_deleted=False,
-                                   answer__session__submitter=user)\
-                       .values_list('pk')
-
-        return self.exclude(pk__in=excluded_pks)\
-                   .filter(answer__choice__is_right=False,
-                           answer__session__is_deleted=False,
-                           answer__session__submitter=user)\
-                   .distinct()
+        return self.filter(user_states__user=user,
+                           user_states__best_result='INCORRECT')
 
     def skipped_by_user(self, user):
         # See the note in 'self.correct_by_user()'
-        excluded_pks = (self.filter(answer__choice__is_right=True,
-                                    answer__session__is_deleted=False,
-                                    answer__session__submitter=user) |
-                        self.filter(answer__choice__is_right=False,
-                                    answer__session__is_deleted=False,
-                                    answer__session__submitter=user))\
-                       .values_list('pk')
-
-        return self.exclude(pk__in=excluded_pks)\
-                   .filter(answer__choice__isnull=True,
-                           answer__session__is_deleted=False,
-                           answer__session__submitter=user)\
-                   .distinct()
+        return self.filter(user_states__user=user,
+                           user_states__best_result='SKIPPED')
 
     def approved(self):
         return self.undeleted().filter(is_approved=True).distinct()
@@ -128,6 +103,16 @@ class QuestionQuerySet(models.QuerySet):
                            revision__is_approved=False)\
                    .distinct()
 
+    def with_trees(self):
+        # Expand the questions to their whole question trees in a
+        # single query, using the question tree index (see
+        # utils.update_question_trees()).
+        from .models import Question
+        tree_roots = self.filter(tree_root__isnull=False)\
+                         .values('tree_root')
+        return Question.objects.filter(Q(pk__in=self.values('pk')) |
+                                       Q(tree_root__in=tree_roots))
+
     def order_global_sequence(self):
         return self.order_by('global_sequence')
 
@@ -324,6 +309,16 @@ class AnswerQuerySet(models.QuerySet):
                    .prefetch_related(Prefetch('question__subjects',
                                               to_attr='subject_list'))
 
+class UserQuestionStateQuerySet(models.QuerySet):
+    def correct(self):
+        return self.filter(best_result='CORRECT')
+
+    def incorrect(self):
+        return self.filter(best_result='INCORRECT')
+
+    def skipped(self):
+        return self.filter(best_result='SKIPPED')
+
 class MnemonicQuerySet(models.QuerySet):
     def undeleted(self):
         return self.filter(is_deleted=False)
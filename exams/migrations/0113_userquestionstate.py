@@ -0,0 +1,31 @@
+# Generated by Django 2.2.5 on 2019-11-02 13:04
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('exams', '0112_trigger_session_mode'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserQuestionState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('best_result', models.CharField(choices=[('CORRECT', 'Correct'), ('INCORRECT', 'Incorrect'), ('SKIPPED', 'Skipped')], max_length=10)),
+                ('last_answer_date', models.DateTimeField(blank=True, null=True)),
+                ('first_answer', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='exams.Answer')),
+                ('question', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='user_states', to='exams.Question')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='question_states', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'question')},
+                'index_together': {('user', 'best_result')},
+            },
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 2.2.5 on 2019-11-02 13:10
+
+from django.db import migrations
+from django.db.models import Count, Max, Min, Q
+
+def fill_user_question_states(apps, schema_editor):
+    Answer = apps.get_model('exams', 'Answer')
+    UserQuestionState = apps.get_model('exams', 'UserQuestionState')
+
+    rows = Answer.objects.filter(session__is_deleted=False)\
+                         .values('session__submitter', 'question')\
+                         .annotate(correct_count=Count('pk', filter=Q(choice__is_right=True)),
+                                   incorrect_count=Count('pk', filter=Q(choice__is_right=False)),
+                                   first_answer=Min('pk'),
+                                   last_answer_date=Max('submission_date'))\
+                         .order_by()
+
+    states = []
+    for row in rows.iterator():
+        if row['correct_count']:
+            best_result = 'CORRECT'
+        elif row['incorrect_count']:
+            best_result = 'INCORRECT'
+        else:
+            best_result = 'SKIPPED'
+        states.append(UserQuestionState(user_id=row['session__submitter'],
+                                        question_id=row['question'],
+                                        best_result=best_result,
+                                        first_answer_id=row['first_answer'],
+                                        last_answer_date=row['last_answer_date']))
+        if len(states) >= 5000:
+            UserQuestionState.objects.bulk_create(states)
+            states = []
+    UserQuestionState.objects.bulk_create(states)
+
+def empty_user_question_states(apps, schema_editor):
+    UserQuestionState = apps.get_model('exams', 'UserQuestionState')
+    UserQuestionState.objects.all().delete()
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exams', '0113_userquestionstate'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_user_question_states,
+                             reverse_code=empty_user_question_states)
+    ]
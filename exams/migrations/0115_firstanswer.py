@@ -0,0 +1,32 @@
+# Generated by Django 2.2.5 on 2019-11-03 10:21
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('exams', '0114_fill_user_question_states'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FirstAnswer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('answer', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='first_of', to='exams.Answer')),
+                ('question', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='first_answers', to='exams.Question')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='first_answers', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'question')},
+            },
+        ),
+        migrations.RunSQL("INSERT INTO exams_firstanswer (user_id, question_id, answer_id) SELECT exams_session.submitter_id, exams_answer.question_id, MIN(exams_answer.id) FROM exams_answer INNER JOIN exams_session ON exams_answer.session_id=exams_session.id WHERE exams_answer.choice_id IS NOT NULL GROUP BY exams_session.submitter_id, exams_answer.question_id;",
+                          "DELETE FROM exams_firstanswer;"),
+        migrations.RunSQL("UPDATE exams_answer SET is_first=(id IN (SELECT answer_id FROM exams_firstanswer));",
+                          migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 2.2.5 on 2019-11-04 09:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+def fill_question_trees(apps, schema_editor):
+    Question = apps.get_model('exams', 'Question')
+
+    parents = dict(Question.objects.values_list('pk', 'parent_question')\
+                                   .iterator())
+    children = {parent_pk: pk for pk, parent_pk in parents.items()
+                if parent_pk}
+
+    questions = []
+    indexed_pks = set()
+    for pk, parent_pk in parents.items():
+        if parent_pk:
+            continue
+        tree = [pk]
+        while tree[-1] in children:
+            tree.append(children[tree[-1]])
+        for tree_position, tree_pk in enumerate(tree):
+            indexed_pks.add(tree_pk)
+            questions.append(Question(pk=tree_pk, tree_root_id=pk,
+                                      tree_position=tree_position,
+                                      tree_size=len(tree)))
+
+    # Questions in a parent_question cycle have no root.
+    for pk in set(parents) - indexed_pks:
+        questions.append(Question(pk=pk, tree_root_id=pk))
+
+    Question.objects.bulk_update(questions, ['tree_root', 'tree_position',
+                                             'tree_size'],
+                                 batch_size=5000)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exams', '0115_firstanswer'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='question',
+            name='tree_position',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='question',
+            name='tree_root',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='tree_members', to='exams.Question'),
+        ),
+        migrations.AddField(
+            model_name='question',
+            name='tree_size',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.RunPython(fill_question_trees,
+                             reverse_code=migrations.RunPython.noop),
+    ]
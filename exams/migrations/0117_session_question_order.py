@@ -0,0 +1,18 @@
+# Generated by Django 2.2.5 on 2019-11-05 11:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exams', '0116_question_tree_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='session',
+            name='question_order',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.2.5 on 2019-11-06 10:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exams', '0117_session_question_order'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='question',
+            name='preview_revision',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='exams.Revision'),
+        ),
+        migrations.AddField(
+            model_name='question',
+            name='preview_text',
+            field=models.CharField(blank=True, default='', max_length=70),
+        ),
+    ]
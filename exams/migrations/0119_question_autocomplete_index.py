@@ -0,0 +1,34 @@
+# Generated by Django 2.2.5 on 2019-11-06 14:03
+
+from django.db import migrations
+
+# The DDL is kept here rather than imported from exams.text_search,
+# so that later changes to that module do not change this migration.
+
+def create_autocomplete_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute("CREATE VIRTUAL TABLE exams_question_autocomplete USING fts5(text, exam_id UNINDEXED, "
+                              "tokenize='unicode61', prefix='2 3 4')")
+    elif vendor == 'postgresql':
+        schema_editor.execute("CREATE TABLE exams_question_autocomplete (question_id integer PRIMARY KEY, "
+                              "exam_id integer NOT NULL, "
+                              "document tsvector NOT NULL)")
+        schema_editor.execute("CREATE INDEX exams_question_autocomplete_exam_id ON exams_question_autocomplete (exam_id)")
+        schema_editor.execute("CREATE INDEX exams_question_autocomplete_document ON exams_question_autocomplete USING gin (document)")
+
+def drop_autocomplete_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ['sqlite', 'postgresql']:
+        schema_editor.execute("DROP TABLE IF EXISTS exams_question_autocomplete")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exams', '0118_question_preview'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_autocomplete_index,
+                             drop_autocomplete_index),
+    ]
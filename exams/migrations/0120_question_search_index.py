@@ -0,0 +1,37 @@
+# Generated by Django 2.2.5 on 2019-11-07 09:15
+
+from django.db import migrations
+
+# The DDL is kept here rather than imported from exams.text_search,
+# so that later changes to that module do not change this migration.
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute("CREATE VIRTUAL TABLE exams_question_search USING fts5(text, choices, explanation, "
+                              "exam_id UNINDEXED, is_approved UNINDEXED, is_deleted UNINDEXED, "
+                              "tokenize='porter unicode61')")
+    elif vendor == 'postgresql':
+        schema_editor.execute("CREATE TABLE exams_question_search (question_id integer PRIMARY KEY, "
+                              "exam_id integer NOT NULL, "
+                              "is_approved boolean NOT NULL, "
+                              "is_deleted boolean NOT NULL, "
+                              "document tsvector NOT NULL)")
+        schema_editor.execute("CREATE INDEX exams_question_search_exam_id ON exams_question_search (exam_id)")
+        schema_editor.execute("CREATE INDEX exams_question_search_document ON exams_question_search USING gin (document)")
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ['sqlite', 'postgresql']:
+        schema_editor.execute("DROP TABLE IF EXISTS exams_question_search")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exams', '0119_question_autocomplete_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index,
+                             drop_search_index),
+    ]
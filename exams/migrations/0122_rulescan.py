@@ -0,0 +1,22 @@
+# Generated by Django 2.2.5 on 2019-11-10 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exams', '0121_question_fingerprints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RuleScan',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_date', models.DateTimeField()),
+                ('finish_date', models.DateTimeField(auto_now_add=True)),
+                ('rules', models.TextField()),
+            ],
+        ),
+    ]
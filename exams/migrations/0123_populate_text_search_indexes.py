@@ -0,0 +1,82 @@
+# Generated by Django 2.2.5 on 2019-11-12 10:20
+
+from django.db import migrations
+
+# The text search tables were created empty (0119 and 0120), so
+# autocomplete and search found nothing until rebuild_text_search_indexes
+# was run.  This fills them the same way that command does, in one
+# INSERT ... SELECT per table.  Like 0119 and 0120, it does not import
+# exams.text_search.
+
+# The autocomplete index holds the text of the latest undeleted
+# revision of undeleted questions.
+LATEST_REVISION_JOIN = """
+    FROM exams_question question
+    JOIN exams_revision revision ON revision.id = (
+        SELECT latest_revision.id FROM exams_revision latest_revision
+        WHERE latest_revision.question_id = question.id
+        AND latest_revision.is_deleted = {false}
+        ORDER BY latest_revision.submission_date DESC, latest_revision.id DESC
+        LIMIT 1)
+    WHERE question.is_deleted = {false}"""
+
+# The search index holds the best revision text, its choices and the
+# latest explanation of every question with a best revision.
+BEST_REVISION_JOIN = """
+    FROM exams_question question
+    JOIN exams_revision revision ON revision.id = question.best_revision_id
+    LEFT JOIN exams_explanationrevision explanation
+    ON explanation.id = question.latest_explanation_revision_id"""
+
+SQLITE_CHOICES = """
+    (SELECT group_concat(text, char(10)) FROM (
+        SELECT choice.text FROM exams_revision_choices revision_choice
+        JOIN exams_choice choice ON choice.id = revision_choice.choice_id
+        WHERE revision_choice.revision_id = revision.id
+        ORDER BY choice.id))"""
+
+POSTGRESQL_CHOICES = """
+    (SELECT string_agg(choice.text, E'\\n' ORDER BY choice.id)
+     FROM exams_revision_choices revision_choice
+     JOIN exams_choice choice ON choice.id = revision_choice.choice_id
+     WHERE revision_choice.revision_id = revision.id)"""
+
+def populate_text_search_indexes(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute("INSERT INTO exams_question_autocomplete (rowid, exam_id, text) "
+                              "SELECT question.id, question.exam_id, revision.text" +
+                              LATEST_REVISION_JOIN.format(false=0))
+        schema_editor.execute("INSERT INTO exams_question_search (rowid, exam_id, is_approved, is_deleted, "
+                              "text, choices, explanation) "
+                              "SELECT question.id, question.exam_id, question.is_approved, question.is_deleted, "
+                              "revision.text, COALESCE(" + SQLITE_CHOICES + ", ''), "
+                              "COALESCE(explanation.explanation_text, '')" +
+                              BEST_REVISION_JOIN)
+    elif vendor == 'postgresql':
+        schema_editor.execute("INSERT INTO exams_question_autocomplete (question_id, exam_id, document) "
+                              "SELECT question.id, question.exam_id, to_tsvector('simple', revision.text)" +
+                              LATEST_REVISION_JOIN.format(false='FALSE'))
+        schema_editor.execute("INSERT INTO exams_question_search (question_id, exam_id, is_approved, is_deleted, document) "
+                              "SELECT question.id, question.exam_id, question.is_approved, question.is_deleted, "
+                              "setweight(to_tsvector('english', revision.text), 'A') || "
+                              "setweight(to_tsvector('english', COALESCE(" + POSTGRESQL_CHOICES + ", '')), 'B') || "
+                              "setweight(to_tsvector('english', COALESCE(explanation.explanation_text, '')), 'C')" +
+                              BEST_REVISION_JOIN)
+
+def clear_text_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor in ['sqlite', 'postgresql']:
+        schema_editor.execute("DELETE FROM exams_question_autocomplete")
+        schema_editor.execute("DELETE FROM exams_question_search")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exams', '0122_rulescan'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_text_search_indexes,
+                             clear_text_search_indexes),
+    ]
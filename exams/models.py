@@ -1,14 +1,17 @@
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.fields import GenericRelation
 from django.core.cache import cache
-from django.core.exceptions import MultipleObjectsReturned, ValidationError
+from django.core.exceptions import ValidationError
 from django.urls import reverse
-from django.db import models
-from django.shortcuts import get_object_or_404
+from django.db import models, transaction
+from django.db.models import Case, F, Min, Value, When
+from django.http import Http404
 from django.utils import timezone
 import datetime
+import json
 import textwrap
 import re
+import time
 
 from . import managers
 from ckeditor_uploader.fields import RichTextUploadingField
@@ -296,6 +299,15 @@ class Question(models.Model):
                                            related_name="child_question",
                                            on_delete=models.SET_NULL,
                                            default=None)
+    # The question tree index.  Every question points to the first
+    # question of its tree (itself if it has no parent or child),
+    # along with its position in, and the size of, that tree.  It is
+    # kept up-to-date by utils.update_question_trees().
+    tree_root = models.ForeignKey('self', null=True, blank=True,
+                                  related_name="tree_members",
+                                  on_delete=models.SET_NULL)
+    tree_position = models.PositiveIntegerField(default=0)
+    tree_size = models.PositiveIntegerField(default=1)
     best_revision = models.OneToOneField('Revision', null=True, blank=True,
                                          on_delete=models.SET_NULL,
                                          related_name="best_of")
@@ -304,6 +316,12 @@ class Question(models.Model):
                                                        blank=True,
                                                        on_delete=models.SET_NULL,
                                                        related_name="latst_of")
+    # A shortened text of the latest revision, used for __str__().
+    # It is kept up-to-date by utils.update_questions_from_revisions().
+    preview_revision = models.ForeignKey('Revision', null=True, blank=True,
+                                         on_delete=models.SET_NULL,
+                                         related_name="+")
+    preview_text = models.CharField(max_length=70, blank=True, default="")
     assigned_editor = models.ForeignKey(User, null=True, blank=True,
                                         on_delete=models.SET_NULL,
                                         related_name="assigned_questions")
@@ -314,12 +332,32 @@ class Question(models.Model):
     total_user_count = models.PositiveIntegerField(null=True)
     correct_first_timer_count = models.PositiveIntegerField(null=True)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the loaded values of fields that derived data (the
+        # question tree index and session question orders) depend on,
+        # so that it is only updated when they change.
+        instance._loaded_values = {field_name: instance.__dict__.get(field_name)
+                                   for field_name in ['parent_question_id',
+                                                      'is_approved',
+                                                      'is_deleted']}
+        # Likewise for the fields that the question search index
+        # depends on (see utils.update_question_search_index()).
+        instance._indexed_values = (instance.__dict__.get('best_revision_id'),
+                                    instance.__dict__.get('is_approved'),
+                                    instance.__dict__.get('is_deleted'))
+        # And for those that the question fingerprint depends on (see
+        # utils.update_question_fingerprints()).
+        instance._fingerprinted_values = (instance.__dict__.get('best_revision_id'),
+                                          instance.__dict__.get('exam_id'),
+                                          instance.__dict__.get('is_deleted'))
+        return instance
+
     def __str__(self):
-        latest_revision = self.get_latest_revision()
-        if not latest_revision:
+        if not self.preview_revision_id:
             return str(self.pk)
-        return textwrap.shorten(latest_revision.text, 70,
-                                placeholder='...')
+        return self.preview_text
 
     def get_absolute_url(self):
         return reverse("exams:show_single_question",
@@ -401,6 +439,13 @@ class Question(models.Model):
 
     def get_tree(self):
         """Get a sorted list of question parents and children."""
+        if self.tree_root_id:
+            if self.tree_size == 1:
+                return [self]
+            return list(Question.objects.filter(tree_root=self.tree_root_id)\
+                                        .order_by('tree_position'))
+
+        # Questions that are not indexed yet
         tree = []
 
         parent_question = self.parent_question
@@ -570,6 +615,11 @@ class Session(models.Model):
     correct_answer_count = models.PositiveIntegerField(default=0)
     incorrect_answer_count = models.PositiveIntegerField(default=0)
     skipped_answer_count = models.PositiveIntegerField(default=0)
+    # Comma-separated PKs of get_questions(), in global_sequence
+    # order, so that question sequences and the next question do not
+    # need COUNT queries.  An empty value means that it has to be
+    # recomputed (see get_question_order()).
+    question_order = models.TextField(default="", blank=True)
 
     objects = managers.SessionQuerySet.as_manager()
 
@@ -608,17 +658,43 @@ class Session(models.Model):
 
         return not self.unused_question_count
 
-    def get_question_sequence(self, question):
+    def update_question_order(self, commit=True):
         # global_sequence may not be set for freshly created
-        # questions.  For these, use pk to calculate sequence.
-        if not question.global_sequence:
-            return self.get_questions()\
-                       .filter(pk__lte=question.pk)\
-                       .count()
-        else:
-            return self.get_questions()\
-                       .filter(global_sequence__lte=question.global_sequence)\
-                       .count()
+        # questions.  These go last, in PK order.
+        question_pks = list(self.get_questions()\
+                                .order_by(F('global_sequence').asc(nulls_last=True), 'pk')\
+                                .values_list('pk', flat=True))
+        self.question_order = ",".join([str(pk) for pk in question_pks])
+        if commit:
+            Session.objects.filter(pk=self.pk)\
+                           .update(question_order=self.question_order)
+        self._question_order = question_pks
+        self._question_positions = {pk: position
+                                    for position, pk in enumerate(question_pks, 1)}
+        return question_pks
+
+    def get_question_order(self):
+        if not hasattr(self, '_question_order'):
+            if self.question_order:
+                self._question_order = [int(pk) for pk in self.question_order.split(',')]
+                self._question_positions = {pk: position
+                                            for position, pk in enumerate(self._question_order, 1)}
+            else:
+                self.update_question_order()
+        return self._question_order
+
+    def get_question_positions(self):
+        self.get_question_order()
+        return self._question_positions
+
+    def get_question_sequence(self, question):
+        return self.get_question_positions().get(question.pk)
+
+    def get_next_unused_question_pk(self):
+        answered_pks = set(self.answer_set.values_list('question', flat=True))
+        for question_pk in self.get_question_order():
+            if not question_pk in answered_pks:
+                return question_pk
 
     def get_unused_questions(self):
         return self.get_questions()\
@@ -635,21 +711,22 @@ class Session(models.Model):
         # If a question PK is given, show it.  Otheriwse show the
         # first session unused question.  If all questions were
         # answered, show the first session question.
+        from . import utils
+        question_order = self.get_question_order()
         if question_pk:
-            qs = self.get_questions()
-        elif self.unused_question_count:
-            qs = self.get_unused_questions()
+            current_question_pk = int(question_pk)
+            if not current_question_pk in self.get_question_positions():
+                raise Http404
         else:
-            qs = self.get_questions().order_by('global_sequence')
+            current_question_pk = None
+            if self.unused_question_count:
+                current_question_pk = self.get_next_unused_question_pk()
+            if current_question_pk is None and question_order:
+                current_question_pk = question_order[0]
 
-        qs = qs.select_for_show_session()
-
-        if question_pk:
-            current_question = get_object_or_404(qs, pk=question_pk)
-        else:
-            current_question = qs.first()
-
-        return current_question
+        if current_question_pk is None:
+            return None
+        return utils.get_question_bundle(current_question_pk)
 
     def can_user_access(self, user):
         return self.submitter == user or user.is_superuser
@@ -680,6 +757,61 @@ class Answer(models.Model):
         return "Answer of Q#{} in S#{}".format(self.question.pk,
                                                self.session.pk)
 
+class FirstAnswer(models.Model):
+    # The first non-skipped answer of a user to a question.  It is
+    # written once when that answer is submitted, and Answer.is_first
+    # is derived from it.  It is what difficulty calculation is based
+    # on.
+    user = models.ForeignKey(User, on_delete=models.CASCADE,
+                             related_name="first_answers")
+    question = models.ForeignKey(Question, on_delete=models.CASCADE,
+                                 related_name="first_answers")
+    answer = models.OneToOneField(Answer, on_delete=models.CASCADE,
+                                  related_name="first_of")
+
+    class Meta:
+        unique_together = ("user", "question")
+
+    def __str__(self):
+        return "First answer of Q#{} by {}".format(self.question_id,
+                                                   self.user_id)
+
+result_choices = (
+    ('CORRECT', 'Correct'),
+    ('INCORRECT', 'Incorrect'),
+    ('SKIPPED', 'Skipped'),
+)
+
+class UserQuestionState(models.Model):
+    # This is a per-user index of answers that spares us from
+    # scanning the whole Answer table every time we need to know
+    # whether a question was correctly answered, incorrectly
+    # answered, skipped or unused by a given user.  Only answers in
+    # undeleted sessions are considered.  It is maintained by
+    # utils.update_user_question_states().
+    user = models.ForeignKey(User, on_delete=models.CASCADE,
+                             related_name="question_states")
+    question = models.ForeignKey(Question, on_delete=models.CASCADE,
+                                 related_name="user_states")
+    # As a general rule, we will show statistics that are in favor
+    # of the user.  If the question has one correct answer, the best
+    # result is 'CORRECT', regardless of other answers.
+    best_result = models.CharField(max_length=10, choices=result_choices)
+    first_answer = models.ForeignKey(Answer, null=True, blank=True,
+                                     on_delete=models.SET_NULL,
+                                     related_name="+")
+    last_answer_date = models.DateTimeField(null=True, blank=True)
+
+    objects = managers.UserQuestionStateQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ("user", "question")
+        index_together = ("user", "best_result")
+
+    def __str__(self):
+        return "State of Q#{} for {}".format(self.question_id,
+                                             self.user_id)
+
 class Highlight(models.Model):
     session = models.ForeignKey(Session, on_delete=models.CASCADE)
     question = models.ForeignKey(Question, null=True,
@@ -861,71 +993,129 @@ class DuplicateContainer(models.Model):
         return self.get_questions().filter(is_deleted=False).first()
 
     def keep(self, question_to_keep):
+        # Merge the other questions of the container into
+        # question_to_keep and delete them.  Everything is done in a
+        # handful of set-based statements, in one transaction.  Return
+        # a report of the affected row counts and the time it took.
+        from . import utils
+        start_time = time.perf_counter()
+        SessionQuestion = Session.questions.through
         questions_to_delete = self.get_questions().exclude(pk=question_to_keep.pk)
-        best_revision = question_to_keep.best_revision
-
-        # Merge corrections
-        corrections_to_delete = AnswerCorrection.objects\
-                                                .filter(choice__question__in=questions_to_delete)\
-                                                .select_related('choice')
-
-        for correction in corrections_to_delete:
-            choice_text = correction.choice.text
-            try:
-                choice_to_keep = best_revision.choices.get(text__iexact=choice_text,
-                                                           answer_correction__isnull=True)
-            except (Choice.DoesNotExist, MultipleObjectsReturned):
-                pass
-            else:
-                correction.choice = choice_to_keep
-
-        # MERGE SESSIONS AND ANSWERS
-        # Get all sessions with the question to delete
-
-        # 1) We replace the question field of all skipped answers.
-        # 2) We get the alternative choice, replace the choice
-        #    field, and replace the question field of all
-        #    non-skipped answers.
-
-        # OPTIMIZE: We unpack the primary keys in
-        # questions_to_delete_pks and question_to_keep_session_pks
-        # before passing them to the QuerySet.  Otherwise, the SQL
-        # statement will fail before compilation.  Idealy, there
-        # should be a better, SQL-native way to do this.
         questions_to_delete_pks = list(questions_to_delete.values_list('pk', flat=True))
-        sessions = Session.objects.filter(questions__in=questions_to_delete_pks).distinct()
-
-        # We will skip changing answers that happen to be in the same
-        # session as question_to_keep as this would violate the
-        # unique_together constrain in the Answer model.
-        question_to_keep_session_pks = list(question_to_keep.session_set.values_list('pk', flat=True))
-        obsolete_answers = Answer.objects.filter(question__in=questions_to_delete_pks)\
-                                         .exclude(session__in=question_to_keep_session_pks)
-        obsolete_answers.update(question=question_to_keep)
-        for choice in best_revision.choices.all():
-            obsolete_answers.filter(choice__text=choice.text).update(choice=choice)
-
-        for session in sessions:
-            session.questions.add(question_to_keep)
-            session.questions.remove(*questions_to_delete)
-
-        # MERGE SOURCES
-        sources = Source.objects.filter(question__in=questions_to_delete_pks).distinct()
-        question_to_keep.sources.add(*sources)
-
-        # MERGE SUBJECTS
-        subjects = Subject.objects.filter(question__in=questions_to_delete_pks).distinct()
-        question_to_keep.subjects.add(*subjects)
-
-        # MERGE EXAM TYPES
-        exam_types = ExamType.objects.filter(question__in=questions_to_delete_pks).distinct()
-        question_to_keep.exam_types.add(*exam_types)
-
-        # MERGE MARKING USERS
-        marking_users = User.objects.filter(marked_questions__in=questions_to_delete_pks).distinct()
-        question_to_keep.marking_users.add(*marking_users)
+        best_revision = question_to_keep.best_revision
 
-        questions_to_delete.update(is_deleted=True)
+        with transaction.atomic():
+            # MERGE CORRECTIONS
+            # A correction of a choice of a deleted question moves to
+            # the choice of the best revision with the same text,
+            # unless there is no such choice, more than one, or it has
+            # a correction of its own.
+            kept_choice_pks = {}
+            for choice_pk, choice_text in best_revision.choices.filter(answer_correction__isnull=True)\
+                                                               .values_list('pk', 'text'):
+                kept_choice_pks.setdefault(choice_text.lower(), []).append(choice_pk)
+            moved_corrections = []
+            for correction in AnswerCorrection.objects\
+                                              .filter(choice__revision_set__question__in=questions_to_delete_pks)\
+                                              .select_related('choice')\
+                                              .distinct():
+                choice_text = correction.choice.text.lower()
+                if len(kept_choice_pks.get(choice_text, [])) == 1:
+                    correction.choice_id = kept_choice_pks[choice_text][0]
+                    moved_corrections.append(correction)
+                    # A choice can only have one correction.
+                    kept_choice_pks[choice_text] = []
+            AnswerCorrection.objects.bulk_update(moved_corrections, ['choice'])
+            if moved_corrections:
+                # bulk_update() does not fire the signal that does
+                # this.
+                utils.bump_question_bundle_versions([question_to_keep.pk])
+
+            # MERGE ANSWERS
+            # Answers of the deleted questions move to
+            # question_to_keep, and to the choice of the best revision
+            # with the same text.  Answers in sessions that already
+            # have question_to_keep are left alone, and so are all but
+            # the first in sessions with several deleted questions, as
+            # there can only be one answer per question in a session.
+            kept_session_pks = SessionQuestion.objects.filter(question=question_to_keep)\
+                                                      .values('session')
+            kept_answer_session_pks = Answer.objects.filter(question=question_to_keep)\
+                                                    .values('session')
+            answer_pks_to_move = Answer.objects.filter(question__in=questions_to_delete_pks)\
+                                               .exclude(session__in=kept_session_pks)\
+                                               .exclude(session__in=kept_answer_session_pks)\
+                                               .values('session')\
+                                               .annotate(first_answer=Min('pk'))\
+                                               .order_by()\
+                                               .values('first_answer')
+            choice_pks_by_text = dict(best_revision.choices.values_list('text', 'pk'))
+            choice_remap = {}
+            for choice_pk, choice_text in Choice.objects.filter(answer__in=answer_pks_to_move)\
+                                                        .values_list('pk', 'text')\
+                                                        .distinct():
+                if choice_text in choice_pks_by_text:
+                    choice_remap.setdefault(choice_pks_by_text[choice_text], []).append(choice_pk)
+            answer_changes = {'question': question_to_keep}
+            if choice_remap:
+                answer_changes['choice'] = Case(*[When(choice__in=choice_pks, then=Value(kept_choice_pk))
+                                                  for kept_choice_pk, choice_pks in choice_remap.items()],
+                                                default=F('choice'),
+                                                output_field=models.IntegerField())
+            moved_answer_count = Answer.objects.filter(pk__in=answer_pks_to_move)\
+                                               .update(**answer_changes)
+
+            # MERGE SESSIONS
+            affected_session_pks = list(SessionQuestion.objects.filter(question__in=questions_to_delete_pks)\
+                                                               .values_list('session', flat=True)\
+                                                               .distinct())
+            added_session_question_count = utils.copy_session_questions(questions_to_delete_pks,
+                                                                        question_to_keep.pk)
+            removed_session_question_count, deleted_rows = SessionQuestion.objects\
+                                                                          .filter(question__in=questions_to_delete_pks)\
+                                                                          .delete()
+
+            # MERGE SOURCES
+            sources = Source.objects.filter(question__in=questions_to_delete_pks).distinct()
+            question_to_keep.sources.add(*sources)
+
+            # MERGE SUBJECTS
+            subjects = Subject.objects.filter(question__in=questions_to_delete_pks).distinct()
+            question_to_keep.subjects.add(*subjects)
+
+            # MERGE EXAM TYPES
+            exam_types = ExamType.objects.filter(question__in=questions_to_delete_pks).distinct()
+            question_to_keep.exam_types.add(*exam_types)
+
+            # MERGE MARKING USERS
+            marking_users = User.objects.filter(marked_questions__in=questions_to_delete_pks).distinct()
+            question_to_keep.marking_users.add(*marking_users)
+
+            questions_to_delete.update(is_deleted=True)
+            # update() bypasses the revision signal, so let the deleted
+            # questions lose their approval status.
+            utils.update_questions_from_revisions(questions_to_delete_pks)
+
+            # Answers and session questions were changed using
+            # update(), delete() and raw SQL, which do not fire
+            # signals, so we have to refresh the derived data
+            # ourselves.
+            affected_question_pks = questions_to_delete_pks + [question_to_keep.pk]
+            utils.update_user_question_states(question_pks=affected_question_pks)
+            utils.update_first_answers(question_pks=affected_question_pks)
+            reset_session_order_count = utils.reset_session_question_orders([question_to_keep.pk])
+            changed_session_count = 0
+            for start in range(0, len(affected_session_pks), 500):
+                changed_session_count += utils.update_session_counters(affected_session_pks[start:start + 500])
+
+        return {'deleted_questions': len(questions_to_delete_pks),
+                'moved_corrections': len(moved_corrections),
+                'moved_answers': moved_answer_count,
+                'added_session_questions': added_session_question_count,
+                'removed_session_questions': removed_session_question_count,
+                'reset_session_orders': reset_session_order_count,
+                'changed_session_counters': changed_session_count,
+                'seconds': round(time.perf_counter() - start_time, 3)}
 
     def __str__(self):
         return "Duplicate container of Q#{} ({} duplicates)".format(self.primary_question.pk,
@@ -949,6 +1139,32 @@ class Duplicate(models.Model):
         ordering = ('question',)
         unique_together = ("container", "question")
 
+class QuestionFingerprint(models.Model):
+    # The MinHash signature of the best revision text of a question
+    # and its LSH band values (see exams/duplicates.py), which new
+    # questions are matched against.  It is kept up-to-date by
+    # utils.update_question_fingerprints().
+    question = models.OneToOneField(Question, primary_key=True,
+                                    on_delete=models.CASCADE,
+                                    related_name="fingerprint")
+    revision = models.ForeignKey(Revision, on_delete=models.CASCADE,
+                                 related_name="+")
+    signature = models.BinaryField()
+
+    def __str__(self):
+        return "Fingerprint of Q#{}".format(self.question_id)
+
+class FingerprintBand(models.Model):
+    fingerprint = models.ForeignKey(QuestionFingerprint,
+                                    on_delete=models.CASCADE,
+                                    related_name="bands")
+    exam = models.ForeignKey(Exam, on_delete=models.CASCADE,
+                             related_name="+")
+    value = models.BigIntegerField()
+
+    class Meta:
+        index_together = ("exam", "value")
+
 def validate_regex(value):
     try:
         re.compile(value)
@@ -1005,6 +1221,22 @@ class SuggestedChange(models.Model):
     def __str__(self):
         return "Suggested change for Q#%s" % self.revision.question.pk
 
+class RuleScan(models.Model):
+    # A completed run of suggest_changes over all exams, along with the
+    # patterns and scopes of the rules it used.  Incremental runs only
+    # scan the revisions submitted since the last scan started, and
+    # only scan older revisions with the rules that changed since.
+    start_date = models.DateTimeField()
+    finish_date = models.DateTimeField(auto_now_add=True)
+    rules = models.TextField()
+
+    def get_rules(self):
+        return {int(rule_pk): tuple(rule)
+                for rule_pk, rule in json.loads(self.rules).items()}
+
+    def __str__(self):
+        return "Rule scan of {}".format(self.start_date)
+
 class SessionTheme(models.Model):
     name = models.CharField(max_length=50)
 
@@ -0,0 +1,72 @@
+import re
+
+# Scans texts for the patterns of many Rules at once (see
+# suggest_changes).  The patterns are combined into a single
+# alternation of named groups, `(?P<rule_1>...)|(?P<rule_2>...)`, so
+# that a text that matches no rule, which is the common case, is
+# rejected in a single pass.
+#
+# An alternation only reports the first alternative that matches at a
+# given position, and its matches do not overlap, so when the combined
+# pattern does match, the rules it did not report are checked one by
+# one.  Patterns that cannot be combined (those with backreferences,
+# named groups or inline flags) are always checked one by one.
+
+BACKREFERENCE_PATTERN = re.compile(r'\\\d|\(\?P=')
+# Global inline flags, e.g. (?i), would apply to all patterns.
+INLINE_FLAGS_PATTERN = re.compile(r'\(\?[aiLmsux]+\)')
+
+def is_combinable(pattern):
+    if BACKREFERENCE_PATTERN.search(pattern) or \
+       INLINE_FLAGS_PATTERN.search(pattern):
+        return False
+    try:
+        compiled_pattern = re.compile(pattern)
+        re.compile("(?P<rule_0>{})".format(pattern))
+    except re.error:
+        return False
+    return not compiled_pattern.groupindex
+
+class RuleScanner:
+    def __init__(self, rules):
+        # rules is a list of (rule primary key, regex pattern) tuples.
+        self.compiled_rules = {}
+        self.combined_rule_pks = []
+        self.separate_rule_pks = []
+        combined_patterns = []
+        for rule_pk, pattern in rules:
+            self.compiled_rules[rule_pk] = re.compile(pattern)
+            if is_combinable(pattern):
+                self.combined_rule_pks.append(rule_pk)
+                combined_patterns.append("(?P<rule_{}>{})".format(rule_pk, pattern))
+            else:
+                self.separate_rule_pks.append(rule_pk)
+
+        if combined_patterns:
+            self.combined_pattern = re.compile("|".join(combined_patterns))
+        else:
+            self.combined_pattern = None
+
+    def get_rule_pk(self, match):
+        group_name = match.lastgroup
+        if not group_name:
+            group_name = [name for name, value in match.groupdict().items()
+                          if value is not None][0]
+        return int(group_name[len('rule_'):])
+
+    def scan(self, text):
+        # Return the set of primary keys of the rules that match the
+        # text.
+        rule_pks = set()
+        if self.combined_pattern:
+            for match in self.combined_pattern.finditer(text):
+                rule_pks.add(self.get_rule_pk(match))
+            if rule_pks:
+                for rule_pk in self.combined_rule_pks:
+                    if not rule_pk in rule_pks and \
+                       self.compiled_rules[rule_pk].search(text):
+                        rule_pks.add(rule_pk)
+        for rule_pk in self.separate_rule_pks:
+            if self.compiled_rules[rule_pk].search(text):
+                rule_pks.add(rule_pk)
+        return rule_pks
@@ -0,0 +1,550 @@
+from array import array
+from collections import Counter
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.db.models.signals import post_save, post_delete
+from haystack.backends import BaseEngine, BaseSearchBackend, log_query
+from haystack.backends.simple_backend import SimpleSearchQuery
+from haystack.constants import DJANGO_CT, DJANGO_ID, ID
+from haystack.exceptions import NotHandled, SkipDocument
+from haystack.models import SearchResult
+from haystack.signals import BaseSignalProcessor
+from haystack.utils import get_identifier, get_model_ct
+from exams.text_search import get_terms
+import atexit
+import contextlib
+import fcntl
+import json
+import logging
+import math
+import mmap
+import os
+import queue
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# A self-contained Haystack backend that keeps an inverted index on
+# disk, so that search works without an external service.  It is
+# configured as:
+#
+#     HAYSTACK_CONNECTIONS = {
+#         'default': {
+#             'ENGINE': 'exams.search_backends.InvertedIndexEngine',
+#             'PATH': '/path/to/index/directory',
+#         },
+#     }
+#
+# The index is made of immutable segments.  Each segment has three
+# files:
+#
+#  - <name>.docs: a JSON list of [id, django_ct, django_id,
+#    stored fields, length] documents, in document number order.
+#  - <name>.terms: a JSON object of term => [offset, count].
+#  - <name>.postings: (document number, term frequency) pairs of
+#    unsigned integers, grouped by term.  It is memory-mapped.
+#
+# manifest.json lists the live segments, along with the numbers of
+# their deleted documents, and the number and total length of their
+# live documents (which BM25 needs for every query).  Updates write a new segment, then mark the
+# replaced documents as deleted and swap the manifest under a file
+# lock.  Once there are more than MAX_SEGMENTS segments, they are
+# merged into one.
+#
+# Queries match documents that contain all of the terms, ranked by
+# BM25.
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+def get_segment_file_path(path, name, extension):
+    return os.path.join(path, "{}.{}".format(name, extension))
+
+def write_segment(path, documents):
+    # documents is a list of (id, django_ct, django_id, stored
+    # fields, term frequencies) tuples.  Returns the segment name.
+    name = "segment_{}".format(uuid.uuid4().hex)
+    term_postings = {}
+    document_rows = []
+    for document_number, (document_id, django_ct, django_id, stored_fields, term_frequencies) in enumerate(documents):
+        document_rows.append([document_id, django_ct, django_id,
+                              stored_fields, sum(term_frequencies.values())])
+        for term, frequency in term_frequencies.items():
+            term_postings.setdefault(term, []).append((document_number, frequency))
+
+    terms = {}
+    postings = array('I')
+    for term in sorted(term_postings):
+        terms[term] = [len(postings) // 2, len(term_postings[term])]
+        for document_number, frequency in term_postings[term]:
+            postings.append(document_number)
+            postings.append(frequency)
+
+    # The manifest is what makes a segment visible, so the segment
+    # files themselves do not need to be written atomically.
+    os.makedirs(path, exist_ok=True)
+    with open(get_segment_file_path(path, name, 'docs'), 'w') as docs_file:
+        json.dump(document_rows, docs_file, cls=DjangoJSONEncoder)
+    with open(get_segment_file_path(path, name, 'terms'), 'w') as terms_file:
+        json.dump(terms, terms_file)
+    with open(get_segment_file_path(path, name, 'postings'), 'wb') as postings_file:
+        postings.tofile(postings_file)
+    return name
+
+class Segment:
+    def __init__(self, path, name):
+        self.name = name
+        with open(get_segment_file_path(path, name, 'docs')) as docs_file:
+            self.documents = json.load(docs_file)
+        with open(get_segment_file_path(path, name, 'terms')) as terms_file:
+            self.terms = json.load(terms_file)
+        with open(get_segment_file_path(path, name, 'postings'), 'rb') as postings_file:
+            if os.fstat(postings_file.fileno()).st_size:
+                self.mmap = mmap.mmap(postings_file.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+                self.postings = memoryview(self.mmap).cast('I')
+            else:
+                self.postings = memoryview(array('I'))
+        self.document_numbers = {document[0]: document_number
+                                 for document_number, document in enumerate(self.documents)}
+
+    def get_postings(self, term):
+        if not term in self.terms:
+            return []
+        offset, count = self.terms[term]
+        postings = self.postings[offset * 2:(offset + count) * 2]
+        return zip(postings[0::2], postings[1::2])
+
+# Segments never change once written, so they are shared by all
+# backend instances of the process.
+_segments = {}
+_segments_lock = threading.Lock()
+
+def get_segment(path, name):
+    key = (path, name)
+    with _segments_lock:
+        if not key in _segments:
+            _segments[key] = Segment(path, name)
+        return _segments[key]
+
+def get_manifest_entry(segment):
+    return {'name': segment.name,
+            'deleted': [],
+            'document_count': len(segment.documents),
+            'total_length': sum(document[4] for document in segment.documents)}
+
+def mark_deleted(segment, entry, document_numbers):
+    # Add document_numbers to the deleted documents of the manifest
+    # entry, and keep its statistics in step.
+    deleted = set(entry['deleted'])
+    new_numbers = set(document_numbers) - deleted
+    if not new_numbers:
+        return
+    entry['deleted'] = sorted(deleted | new_numbers)
+    entry['document_count'] -= len(new_numbers)
+    entry['total_length'] -= sum(segment.documents[document_number][4]
+                                 for document_number in new_numbers)
+
+def merge_segments(path, entries):
+    # Write the live documents of the given manifest entries into a
+    # single segment.  Term frequencies are recovered from the
+    # postings, so the original text is not needed.
+    documents = []
+    for entry in entries:
+        segment = get_segment(path, entry['name'])
+        deleted = set(entry['deleted'])
+        new_numbers = {}
+        for document_number, document in enumerate(segment.documents):
+            if document_number in deleted:
+                continue
+            new_numbers[document_number] = len(documents)
+            documents.append((document[0], document[1], document[2],
+                              document[3], {}))
+        for term in segment.terms:
+            for document_number, frequency in segment.get_postings(term):
+                if document_number in new_numbers:
+                    documents[new_numbers[document_number]][4][term] = frequency
+    return write_segment(path, documents)
+
+class InvertedIndexSearchBackend(BaseSearchBackend):
+    def __init__(self, connection_alias, **connection_options):
+        super().__init__(connection_alias, **connection_options)
+        if not 'PATH' in connection_options:
+            raise ImproperlyConfigured("You must specify a 'PATH' in your settings for connection '%s'." % connection_alias)
+        self.path = connection_options['PATH']
+        self.max_segments = connection_options.get('MAX_SEGMENTS', 10)
+
+    def get_manifest_path(self):
+        return os.path.join(self.path, 'manifest.json')
+
+    def read_manifest(self):
+        try:
+            with open(self.get_manifest_path()) as manifest_file:
+                return json.load(manifest_file)
+        except FileNotFoundError:
+            return {'segments': []}
+
+    def write_manifest(self, manifest):
+        temporary_path = self.get_manifest_path() + '.tmp'
+        with open(temporary_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.replace(temporary_path, self.get_manifest_path())
+
+    @contextlib.contextmanager
+    def lock(self):
+        # Serialize manifest changes across processes.
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, 'lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def change_manifest(self, change):
+        # Apply change(manifest) under the lock, merge segments if
+        # there are too many, and remove the files of segments that
+        # are no longer used.
+        with self.lock():
+            manifest = self.read_manifest()
+            old_names = set(entry['name'] for entry in manifest['segments'])
+            change(manifest)
+            manifest['segments'] = [entry for entry in manifest['segments']
+                                    if len(entry['deleted']) < len(get_segment(self.path, entry['name']).documents)]
+            if len(manifest['segments']) > self.max_segments:
+                name = merge_segments(self.path, manifest['segments'])
+                manifest['segments'] = [get_manifest_entry(get_segment(self.path, name))]
+            self.write_manifest(manifest)
+
+            new_names = set(entry['name'] for entry in manifest['segments'])
+            for name in old_names - new_names:
+                for extension in ['docs', 'terms', 'postings']:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(get_segment_file_path(self.path, name, extension))
+                with _segments_lock:
+                    _segments.pop((self.path, name), None)
+
+    def delete_documents(self, manifest, test):
+        # Mark all documents for which test(segment, document_number)
+        # is true as deleted.
+        for entry in manifest['segments']:
+            segment = get_segment(self.path, entry['name'])
+            deleted = set(entry['deleted'])
+            mark_deleted(segment, entry,
+                         [document_number
+                          for document_number in range(len(segment.documents))
+                          if not document_number in deleted and \
+                             test(segment, document_number)])
+
+    def delete_ids(self, manifest, document_ids):
+        for entry in manifest['segments']:
+            segment = get_segment(self.path, entry['name'])
+            document_numbers = [segment.document_numbers.get(document_id)
+                                for document_id in document_ids]
+            mark_deleted(segment, entry,
+                         [document_number for document_number in document_numbers
+                          if document_number is not None])
+
+    def prepare_documents(self, index, iterable):
+        content_field = index.get_content_field()
+        documents = []
+        for obj in iterable:
+            try:
+                prepared = index.full_prepare(obj)
+            except SkipDocument:
+                continue
+            text = prepared.pop(content_field, None) or ""
+            documents.append((prepared.pop(ID),
+                              prepared.pop(DJANGO_CT),
+                              str(prepared.pop(DJANGO_ID)),
+                              prepared,
+                              Counter(get_terms(text))))
+        return documents
+
+    def write_documents(self, index, iterable):
+        # Write the documents into a new segment, without making it
+        # visible.  Returns the segment name, or None if there was
+        # nothing to write.
+        documents = self.prepare_documents(index, iterable)
+        if not documents:
+            return
+        return write_segment(self.path, documents)
+
+    def install_segments(self, names, replaced_cts=None):
+        # Make written segments visible.  Older versions of their
+        # documents are deleted, as well as all other documents of
+        # replaced_cts (i.e. when a model is fully rebuilt).
+        names = [name for name in names if name]
+        if not names and not replaced_cts:
+            return
+        document_ids = set()
+        for name in names:
+            document_ids.update(get_segment(self.path, name).document_numbers)
+
+        def change(manifest):
+            self.delete_ids(manifest, document_ids)
+            if replaced_cts:
+                self.delete_documents(manifest,
+                                      lambda segment, document_number: segment.documents[document_number][1] in replaced_cts)
+            manifest['segments'] += [get_manifest_entry(get_segment(self.path, name))
+                                     for name in names]
+        self.change_manifest(change)
+
+    def update(self, index, iterable, commit=True):
+        self.install_segments([self.write_documents(index, iterable)])
+
+    def remove(self, obj_or_string, commit=True):
+        self.remove_ids([get_identifier(obj_or_string)])
+
+    def remove_ids(self, document_ids):
+        if not document_ids:
+            return
+        self.change_manifest(lambda manifest: self.delete_ids(manifest, document_ids))
+
+    def remove_missing(self, model, pks):
+        # Remove the documents of the model whose objects are not in pks.
+        django_ct = get_model_ct(model)
+        pks = set(str(pk) for pk in pks)
+        def is_missing(segment, document_number):
+            document = segment.documents[document_number]
+            return document[1] == django_ct and not document[2] in pks
+        self.change_manifest(lambda manifest: self.delete_documents(manifest, is_missing))
+
+    def clear(self, models=None, commit=True):
+        if not models:
+            def change(manifest):
+                manifest['segments'] = []
+        else:
+            cts = set(get_model_ct(model) for model in models)
+            def change(manifest):
+                self.delete_documents(manifest,
+                                      lambda segment, document_number: segment.documents[document_number][1] in cts)
+        self.change_manifest(change)
+
+    def get_live_segments(self):
+        # Return a list of (segment, deleted document numbers, live
+        # document count, live total length) tuples.  A concurrent
+        # merge might remove the files of a manifest we have just
+        # read, in which case we read the new one.
+        for attempt in range(3):
+            manifest = self.read_manifest()
+            try:
+                live_segments = []
+                for entry in manifest['segments']:
+                    live_segments.append((get_segment(self.path, entry['name']),
+                                          set(entry['deleted']),
+                                          entry['document_count'],
+                                          entry['total_length']))
+                return live_segments
+            except FileNotFoundError:
+                continue
+        return []
+
+    @log_query
+    def search(self, query_string, start_offset=0, end_offset=None,
+               models=None, limit_to_registered_models=True,
+               result_class=None, **kwargs):
+        if not query_string:
+            return {'results': [], 'hits': 0}
+        result_class = result_class or SearchResult
+
+        if models:
+            cts = set(get_model_ct(model) for model in models)
+        elif limit_to_registered_models:
+            cts = set(self.build_models_list())
+        else:
+            cts = None
+
+        segments = self.get_live_segments()
+        terms = set(get_terms(query_string))
+        matches = []
+        if query_string == '*' or not terms:
+            for segment, deleted, segment_count, segment_length in segments:
+                for document_number, document in enumerate(segment.documents):
+                    if not document_number in deleted and \
+                       (cts is None or document[1] in cts):
+                        matches.append((0, document))
+        else:
+            # Collection statistics for BM25.  Document counts and
+            # lengths come from the manifest, so only the postings of
+            # the query terms are read.
+            document_count = 0
+            total_length = 0
+            document_frequencies = Counter()
+            segment_postings = []
+            for segment, deleted, segment_count, segment_length in segments:
+                document_count += segment_count
+                total_length += segment_length
+                postings = {}
+                for term in terms:
+                    postings[term] = {document_number: frequency
+                                      for document_number, frequency in segment.get_postings(term)
+                                      if not document_number in deleted}
+                    document_frequencies[term] += len(postings[term])
+                segment_postings.append((segment, postings))
+            average_length = total_length / document_count if document_count else 0
+
+            for segment, postings in segment_postings:
+                document_numbers = set.intersection(*[set(term_postings)
+                                                      for term_postings in postings.values()])
+                for document_number in document_numbers:
+                    document = segment.documents[document_number]
+                    if cts is not None and not document[1] in cts:
+                        continue
+                    score = 0
+                    for term, term_postings in postings.items():
+                        frequency = term_postings[document_number]
+                        inverse_frequency = math.log(1 + (document_count - document_frequencies[term] + 0.5) / \
+                                                         (document_frequencies[term] + 0.5))
+                        normalization = 1 - BM25_B + BM25_B * document[4] / average_length
+                        score += inverse_frequency * frequency * (BM25_K1 + 1) / \
+                                 (frequency + BM25_K1 * normalization)
+                    matches.append((score, document))
+            matches.sort(key=lambda match: match[0], reverse=True)
+
+        results = []
+        for score, document in matches[start_offset:end_offset]:
+            app_label, model_name = document[1].split('.')
+            results.append(result_class(app_label, model_name, document[2],
+                                        score, **document[3]))
+        return {'results': results,
+                'hits': len(matches)}
+
+    def prep_value(self, db_field, value):
+        return value
+
+    def more_like_this(self, model_instance, additional_query_string=None,
+                       start_offset=0, end_offset=None,
+                       limit_to_registered_models=None, result_class=None, **kwargs):
+        return {'results': [],
+                'hits': 0}
+
+class InvertedIndexEngine(BaseEngine):
+    backend = InvertedIndexSearchBackend
+    query = SimpleSearchQuery
+
+class QueuedSignalProcessor(BaseSignalProcessor):
+    # Like haystack's RealtimeSignalProcessor, but instead of
+    # re-indexing objects synchronously on every save or delete, the
+    # changes are queued once their transaction is committed, and a
+    # background thread applies them in batches.  Whatever is still
+    # queued when the process exits normally (including on SIGTERM
+    # from gunicorn or uwsgi, which exit through sys.exit()) is
+    # applied then.  The queue only lives in memory, though, so if
+    # the process is killed outright, queued changes are lost, and
+    # build_search_index has to be run again to catch up.
+    batch_size = 200
+    batch_delay = 1 # second
+
+    def setup(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.thread_lock = threading.Lock()
+        for model in self.get_indexed_models():
+            post_save.connect(self.handle_save, sender=model)
+            post_delete.connect(self.handle_delete, sender=model)
+        atexit.register(self.flush)
+
+    def teardown(self):
+        for model in self.get_indexed_models():
+            post_save.disconnect(self.handle_save, sender=model)
+            post_delete.disconnect(self.handle_delete, sender=model)
+
+    def get_indexed_models(self):
+        models = set()
+        for using in self.connections.connections_info:
+            models.update(self.connections[using].get_unified_index().get_indexed_models())
+        return models
+
+    def handle_save(self, sender, instance, raw=False, **kwargs):
+        if raw:
+            return
+        self.enqueue(sender, instance.pk)
+
+    def handle_delete(self, sender, instance, **kwargs):
+        self.enqueue(sender, instance.pk)
+
+    def enqueue(self, model, pk):
+        transaction.on_commit(lambda: self.put(model, pk))
+
+    def put(self, model, pk):
+        self.queue.put((model, pk))
+        with self.thread_lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def get_batch(self, block=True):
+        try:
+            batch = [self.queue.get(block=block)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.batch_delay
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if block and timeout > 0:
+                    batch.append(self.queue.get(timeout=timeout))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.get_batch()
+            try:
+                self.process(batch)
+            except Exception:
+                logger.exception("Could not update the search index.")
+            finally:
+                for item in batch:
+                    self.queue.task_done()
+                # This thread has its own database connection.
+                connection.close()
+
+    def flush(self):
+        while True:
+            batch = self.get_batch(block=False)
+            if not batch:
+                break
+            try:
+                self.process(batch)
+            finally:
+                for item in batch:
+                    self.queue.task_done()
+        # Wait for the batch that the thread may already have taken
+        # off the queue.
+        self.queue.join()
+
+    def process(self, batch):
+        model_pks = {}
+        for model, pk in batch:
+            model_pks.setdefault(model, set()).add(pk)
+
+        for model, pks in model_pks.items():
+            for using in self.connection_router.for_write():
+                try:
+                    index = self.connections[using].get_unified_index().get_index(model)
+                except NotHandled:
+                    continue
+                # Indexes can widen the update to objects that changed
+                # without firing signals.
+                if hasattr(index, 'get_updated_pks'):
+                    pks = index.get_updated_pks(pks)
+                backend = self.connections[using].get_backend()
+                objects = list(index.index_queryset(using=using).filter(pk__in=pks))
+                if objects:
+                    backend.update(index, objects)
+                indexed_pks = set(obj.pk for obj in objects)
+                document_ids = ["{}.{}".format(get_model_ct(model), pk)
+                                for pk in pks if not pk in indexed_pks]
+                if isinstance(backend, InvertedIndexSearchBackend):
+                    backend.remove_ids(document_ids)
+                else:
+                    for document_id in document_ids:
+                        backend.remove(document_id)
@@ -11,3 +11,11 @@ class RevisionIndex(indexes.SearchIndex, indexes.Indexable):
 
     def index_queryset(self, using=None):
         return self.get_model().objects.undeleted().filter(is_last=True)
+
+    def get_updated_pks(self, pks):
+        # Saving a revision can change which revision of its question
+        # is the last one, and is_last is updated without signals, so
+        # all revisions of the question are re-indexed.
+        return set(pks) | \
+               set(self.get_model().objects.filter(question__revision__pk__in=pks)\
+                                           .values_list('pk', flat=True))
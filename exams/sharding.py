@@ -0,0 +1,69 @@
+from django.db import connections
+import multiprocessing
+import time
+
+# Helpers for maintenance commands (catch_duplicates and
+# suggest_changes) that scan many questions.  The work is cut into
+# shards, each covering a range of question primary keys within one
+# exam, which are processed by a pool of worker processes.  Workers
+# only read; their results are streamed back, in shard order, to the
+# command process, which does all the writing.
+
+class Budget:
+    # Paces work so that it only takes up `fraction` of the wall time
+    # (e.g. 0.1 for 10%, or 1 for no pacing).  Call step() regularly
+    # while working: once a slice of work has taken long enough, it
+    # sleeps for as long as needed to keep to the fraction.  As
+    # waiting on the database counts as work, this limits both CPU
+    # and IO.
+    min_slice = 0.05 # seconds
+
+    def __init__(self, fraction):
+        if not 0 < fraction <= 1:
+            raise ValueError("The budget has to be more than 0 and at most 1.")
+        self.fraction = fraction
+        self.slice_start = None
+
+    def step(self):
+        now = time.perf_counter()
+        if self.slice_start is None:
+            self.slice_start = now
+            return
+        worked = now - self.slice_start
+        if self.fraction < 1 and worked >= self.min_slice:
+            time.sleep(worked * (1 - self.fraction) / self.fraction)
+            self.slice_start = time.perf_counter()
+
+def get_shards(exam_pks, shard_size):
+    # exam_pks is an iterable of (exam primary key, question primary
+    # key) tuples.  Return a list of (exam primary key, question
+    # primary keys) shards of up to shard_size questions, ordered by
+    # exam and question.
+    pks_by_exam = {}
+    for exam_pk, pk in exam_pks:
+        pks_by_exam.setdefault(exam_pk, []).append(pk)
+
+    shards = []
+    for exam_pk in sorted(pks_by_exam):
+        pks = sorted(pks_by_exam[exam_pk])
+        for start in range(0, len(pks), shard_size):
+            shards.append((exam_pk, pks[start:start + shard_size]))
+    return shards
+
+def run_shards(function, tasks, workers=0):
+    # Yield the results of function over tasks, in order.  With
+    # workers, tasks are processed by that many worker processes.
+    # function has to be importable (i.e. a module-level function) to
+    # be passed to the workers.
+    if not workers:
+        for task in tasks:
+            yield function(task)
+        return
+
+    # Forked workers must not share the database connections of this
+    # process.  They open their own, and this process re-connects
+    # when it needs to.
+    connections.close_all()
+    with multiprocessing.Pool(workers) as pool:
+        for result in pool.imap(function, tasks):
+            yield result
@@ -1,6 +1,9 @@
-from django.db.models.signals import post_save, post_delete
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.db.models.signals import m2m_changed, post_save, post_delete, pre_delete
 from django.dispatch import receiver
-from exams.models import Category, Answer, Revision, ExplanationRevision, Choice
+from exams.models import Category, Answer, Revision, ExplanationRevision, Choice, Session, FirstAnswer, Question, Mnemonic, AnswerCorrection
+from exams import text_search, utils
 
 
 @receiver([post_save, post_delete], sender=Revision)
@@ -8,38 +11,16 @@ def update_latest_revision(sender, instance, raw=None, **kwargs):
     # If we are importing a fixture, do not fire the signal.
     if raw:
         return
-    question = instance.question
-
-    # Update is_last field:
-    latest_revision = question.get_latest_revision()
-    if latest_revision:
-        question.revision_set.exclude(pk=latest_revision.pk)\
-                         .update(is_last=False)
-        if not latest_revision.is_last:
-            latest_revision.is_last = True
-            latest_revision.save()
-
-    # Mark delete a question as such: 
-    if not question.revision_set.undeleted().count():
-        question.is_deleted = True
-        question.save()
 
-    # Update best_revision field:
-    best_revision = question.get_best_revision()
-    question.best_revision = best_revision
-
-    # Update approval status:
-    approved_revision = question.get_latest_approved_revision()
-    if approved_revision and \
-       not question.is_deleted and \
-       not question.issues.filter(is_blocker=True).exists() and \
-       approved_revision.choices.filter(is_right=True).exists() and \
-       approved_revision.choices.count() > 1:
-        question.is_approved = True
-    else:
-        question.is_approved = False
+    question = instance.question
+    # If the revision that the text preview comes from has been
+    # edited in place, make sure the preview is refreshed.
+    if question.preview_revision_id == instance.pk:
+        question.preview_revision_id = None
 
-    question.save()
+    # All fields derived from revisions are recomputed in one pass,
+    # or once at the end of defer_revision_updates() blocks.
+    utils.update_questions_from_revisions([question])
 
 @receiver([post_save, post_delete], sender=ExplanationRevision)
 def update_latest_explanation_revision(sender, instance, raw=None, **kwargs):
@@ -59,47 +40,318 @@ def update_latest_explanation_revision(sender, instance, raw=None, **kwargs):
 
         question.latest_explanation_revision = latest_explanation_revision
         question.save()
+        utils.update_question_search_index([question.pk])
+
+def is_in_session_pool(answer):
+    # Whether the question of the answer is counted by the session
+    # counters.  This mirrors Session.get_questions(), which
+    # update_session_counters() also follows: answers to deleted (or,
+    # outside INCOMPLETE sessions, unapproved) questions do not count.
+    try:
+        session = answer.session
+    except Session.DoesNotExist:
+        return False
+    if session.question_filter == 'INCOMPLETE':
+        questions = Question.objects.undeleted()
+    else:
+        questions = Question.objects.approved()
+    return questions.filter(pk=answer.question_id).exists()
 
 @receiver([post_save, post_delete], sender=Answer)
-def update_session_stats(sender, instance, raw=None, **kwargs):
+def update_session_stats(sender, instance, raw=None, created=False, **kwargs):
     if raw:
         return
     try:
         choice = instance.choice
     except Choice.DoesNotExist:
         choice = None
+
+    # Instead of recounting the whole session on every answer, we
+    # adjust the counters by the answer that was just added or
+    # removed.  If we cannot tell what changed (i.e. an existing
+    # answer was re-saved, or its choice has just been deleted), we
+    # fall back to a full recount.
+    if kwargs['signal'] is post_delete:
+        delta = -1
+    elif created:
+        delta = 1
+    else:
+        delta = None
+
+    if delta is None or \
+       instance.choice_id and choice is None:
+        utils.update_session_counters([instance.session_id])
+    elif is_in_session_pool(instance):
+        if choice is None:
+            counter_field = 'skipped_answer_count'
+        elif choice.is_right:
+            counter_field = 'correct_answer_count'
+        else:
+            counter_field = 'incorrect_answer_count'
+
+        if delta > 0:
+            changes = {counter_field: F(counter_field) + 1,
+                       'unused_question_count': Greatest(F('unused_question_count') - 1, 0)}
+        else:
+            changes = {counter_field: Greatest(F(counter_field) - 1, 0),
+                       'unused_question_count': F('unused_question_count') + 1}
+        Session.objects.filter(pk=instance.session_id).update(**changes)
+
+@receiver(post_save, sender=Answer)
+def set_first_answer(sender, instance, raw=None, created=False, **kwargs):
+    if raw or not created or not instance.choice_id:
+        return
+
+    # Skipped answers do not count.  Since answers are only added
+    # (never re-ordered), the first answer to reach this point is the
+    # first answer of the user, so we only insert if absent.
+    first_answer, was_created = FirstAnswer.objects.get_or_create(user_id=instance.session.submitter_id,
+                                                                  question_id=instance.question_id,
+                                                                  defaults={'answer': instance})
+    if was_created:
+        # Here we use update instead of save to avoid signal
+        # recrusion.
+        Answer.objects.filter(pk=instance.pk).update(is_first=True)
+
+@receiver(post_delete, sender=Answer)
+def replace_first_answer(sender, instance, **kwargs):
+    # The FirstAnswer record is deleted with its answer, so we have
+    # to promote the following answer, if any.
+    if instance.is_first:
+        utils.update_first_answers(user=instance.session.submitter_id,
+                                   question_pks=[instance.question_id])
+
+@receiver([post_save, post_delete], sender=Answer)
+def update_user_question_state(sender, instance, raw=None, **kwargs):
+    if raw:
+        return
     session = instance.session
-    question_pool = session.get_questions()
-
-    session.unused_question_count = session.get_unused_questions().count()
-
-    if choice is None:
-        session.skipped_answer_count = question_pool.filter(answer__choice__isnull=True,
-                                                            answer__session=session)\
-                                                    .count() or 0
-    elif choice.is_right:
-        session.correct_answer_count = question_pool.filter(answer__choice__is_right=True,
-                                                            answer__session=session)\
-                                                    .count() or 0
-    elif not choice.is_right:
-        session.incorrect_answer_count = question_pool.filter(answer__choice__is_right=False,
-                                                              answer__session=session)\
-                                                      .count() or 0
-
-    session.save()
-
-    # Set is_first
-    if choice:
-        similar_answers = Answer.objects.filter(question_id=instance.question_id,
-                                                choice__isnull=False,
-                                                session__submitter_id=instance.session.submitter_id)\
-                                        .order_by('pk')
-        first_answer = similar_answers.first()
-        if not first_answer.is_first: 
-            # Here we use update instead of save to avoid signal
-            # recrusion.
-            similar_answers.filter(pk=first_answer.pk).update(is_first=True)
-            similar_answers.exclude(pk=first_answer.pk).update(is_first=False)
+    utils.update_user_question_states(user=session.submitter_id,
+                                      question_pks=[instance.question_id])
+
+@receiver(post_save, sender=Question)
+def update_question_tree(sender, instance, raw=None, created=False, **kwargs):
+    # If we are importing a fixture, do not fire the signal.
+    if raw:
+        return
+
+    # Only update the question tree index when parent_question has
+    # changed (or the question has not been indexed yet), otherwise
+    # this would run on every revision save.
+    loaded_values = getattr(instance, '_loaded_values', {})
+    loaded_parent_question_id = loaded_values.get('parent_question_id')
+    if not created and instance.tree_root_id and \
+       instance.parent_question_id == loaded_parent_question_id:
+        return
+
+    question_pks = [instance.pk]
+    if loaded_parent_question_id:
+        question_pks.append(loaded_parent_question_id)
+    tree_index = utils.update_question_trees(question_pks)
+    instance.tree_root_id, instance.tree_position, instance.tree_size = tree_index[instance.pk]
+    loaded_values['parent_question_id'] = instance.parent_question_id
+    instance._loaded_values = loaded_values
+
+@receiver(pre_delete, sender=Question)
+def collect_question_tree(sender, instance, **kwargs):
+    # Deleting a question sets parent_question (and tree_root) of the
+    # rest of its tree to NULL in SQL, without any signal, so we note
+    # the tree here and re-index it once the question is gone.
+    if instance.tree_size > 1:
+        instance._tree_member_pks = list(Question.objects.filter(tree_root=instance.tree_root_id)\
+                                                         .exclude(pk=instance.pk)\
+                                                         .values_list('pk', flat=True))
+
+@receiver(post_delete, sender=Question)
+def update_deleted_question_tree(sender, instance, **kwargs):
+    tree_member_pks = getattr(instance, '_tree_member_pks', None)
+    if tree_member_pks:
+        utils.update_question_trees(tree_member_pks)
+
+@receiver(post_save, sender=Question)
+def reset_session_question_orders(sender, instance, raw=None, created=False, **kwargs):
+    if raw or created:
+        return
+
+    # Approval and deletion decide whether a question is part of
+    # Session.get_questions().
+    loaded_values = getattr(instance, '_loaded_values', {})
+    if instance.is_approved == loaded_values.get('is_approved') and \
+       instance.is_deleted == loaded_values.get('is_deleted'):
+        return
+
+    utils.reset_session_question_orders([instance.pk])
+    loaded_values['is_approved'] = instance.is_approved
+    loaded_values['is_deleted'] = instance.is_deleted
+    instance._loaded_values = loaded_values
+
+@receiver(post_save, sender=Question)
+def update_question_search_index(sender, instance, raw=None, **kwargs):
+    if raw:
+        return
+
+    # The content of the best revision does not change in place, so
+    # the question only needs re-indexing when the best revision,
+    # approval or deletion change.
+    indexed_values = (instance.best_revision_id,
+                      instance.is_approved,
+                      instance.is_deleted)
+    if indexed_values == getattr(instance, '_indexed_values', None):
+        return
+    utils.update_question_search_index([instance.pk])
+    instance._indexed_values = indexed_values
+
+@receiver(post_save, sender=Question)
+def update_question_fingerprint(sender, instance, raw=None, created=False, **kwargs):
+    if raw:
+        return
+
+    # Questions are fingerprinted, and checked for duplicates, when
+    # their best revision changes.  New questions usually get theirs
+    # with a later save.
+    fingerprinted_values = (instance.best_revision_id,
+                            instance.exam_id,
+                            instance.is_deleted)
+    if created and not instance.best_revision_id:
+        instance._fingerprinted_values = fingerprinted_values
+        return
+    if fingerprinted_values == getattr(instance, '_fingerprinted_values', None):
+        return
+    utils.queue_question_fingerprint(instance.pk)
+    instance._fingerprinted_values = fingerprinted_values
+
+@receiver(post_delete, sender=Question)
+def remove_question_text_search(sender, instance, **kwargs):
+    text_search.remove_autocomplete_texts([instance.pk])
+    text_search.remove_search_documents([instance.pk])
+
+@receiver(m2m_changed, sender=Revision.choices.through)
+def update_revision_choice_search_index(sender, instance, action, reverse, **kwargs):
+    if not action in ['post_add', 'post_remove', 'post_clear'] or \
+       reverse:
+        return
+    # Only the choices of best revisions are indexed.
+    question_pks = Question.objects.filter(best_revision=instance)\
+                                   .values_list('pk', flat=True)
+    if question_pks:
+        utils.update_question_search_index(question_pks)
+
+@receiver([post_save, post_delete], sender=Question)
+def invalidate_question_exam_caches(sender, instance, raw=None, **kwargs):
+    if raw:
+        return
+    # Approval, deletion and difficulty are all part of the facet
+    # index and the meta question counts.  Revision changes end up
+    # saving the question as well.
+    utils.invalidate_exam_question_caches([instance.exam_id])
+
+@receiver([post_save, post_delete], sender=Choice)
+def invalidate_choice_exam_caches(sender, instance, raw=None, **kwargs):
+    if raw:
+        return
+    # Choices decide whether a question is incomplete.
+    exam_pks = Question.objects.filter(pk=instance.question_id)\
+                               .values_list('exam', flat=True)
+    utils.invalidate_exam_question_caches(exam_pks)
+
+@receiver(m2m_changed, sender=Revision.choices.through)
+def invalidate_revision_choice_exam_caches(sender, instance, action, **kwargs):
+    if not action in ['post_add', 'post_remove', 'post_clear']:
+        return
+    # Both revisions and choices have a question.
+    exam_pks = Question.objects.filter(pk=instance.question_id)\
+                               .values_list('exam', flat=True)
+    utils.invalidate_exam_question_caches(exam_pks)
+
+@receiver(m2m_changed, sender=Question.subjects.through)
+@receiver(m2m_changed, sender=Question.sources.through)
+@receiver(m2m_changed, sender=Question.exam_types.through)
+@receiver(m2m_changed, sender=Question.issues.through)
+def invalidate_meta_exam_caches(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        # The questions of a cleared relationship are not known
+        # anymore on post_clear, so we note their exams now.
+        instance._cleared_exam_pks = set(sender.objects.filter(**{get_meta_field_name(sender, instance): instance})\
+                                                       .values_list('question__exam', flat=True))
+        return
+    if not action in ['post_add', 'post_remove', 'post_clear']:
+        return
+    if not reverse:
+        exam_pks = [instance.exam_id]
+    elif action == 'post_clear':
+        exam_pks = getattr(instance, '_cleared_exam_pks', [])
+    else:
+        exam_pks = Question.objects.filter(pk__in=pk_set)\
+                                   .values_list('exam', flat=True)
+    utils.invalidate_exam_question_caches(exam_pks)
+
+def get_meta_field_name(through, instance):
+    # The name of the field of a Question m2m through model that
+    # points to the meta model of instance (e.g. 'subject').
+    for field in through._meta.get_fields():
+        if field.is_relation and field.related_model is type(instance):
+            return field.name
+
+@receiver([post_save, post_delete], sender=Question)
+@receiver([post_save, post_delete], sender=Revision)
+@receiver([post_save, post_delete], sender=ExplanationRevision)
+@receiver([post_save, post_delete], sender=Mnemonic)
+def bump_question_bundle_version(sender, instance, raw=None, **kwargs):
+    if raw:
+        return
+    if sender is Question:
+        question_pk = instance.pk
+    else:
+        question_pk = instance.question_id
+    utils.bump_question_bundle_versions([question_pk])
+
+@receiver([post_save, post_delete], sender=Choice)
+def bump_choice_question_bundle_version(sender, instance, raw=None, **kwargs):
+    if raw:
+        return
+    utils.bump_question_bundle_versions([instance.question_id])
+
+@receiver(m2m_changed, sender=Revision.choices.through)
+def bump_revision_choice_question_bundle_version(sender, instance, action, **kwargs):
+    if not action in ['post_add', 'post_remove', 'post_clear']:
+        return
+    # Both revisions and choices have a question.
+    utils.bump_question_bundle_versions([instance.question_id])
+
+@receiver([post_save, post_delete], sender=AnswerCorrection)
+def bump_correction_question_bundle_version(sender, instance, raw=None, **kwargs):
+    if raw:
+        return
+    question_pks = Choice.objects.filter(pk=instance.choice_id)\
+                                 .values_list('question', flat=True)
+    utils.bump_question_bundle_versions(question_pks)
+
+@receiver(m2m_changed, sender=Mnemonic.likes.through)
+def bump_mnemonic_question_bundle_version(sender, instance, action, reverse, pk_set, **kwargs):
+    # Like counts are part of the question bundle.
+    if not action in ['post_add', 'post_remove', 'post_clear']:
+        return
+    if not reverse:
+        question_pks = [instance.question_id]
+    elif pk_set:
+        question_pks = Mnemonic.objects.filter(pk__in=pk_set)\
+                                       .values_list('question', flat=True)
+    else:
+        question_pks = Mnemonic.objects.filter(likes=instance)\
+                                       .values_list('question', flat=True)
+    utils.bump_question_bundle_versions(question_pks)
+
+@receiver([post_save, post_delete], sender=Category)
+def invalidate_accessible_category_pks(sender, raw=None, **kwargs):
+    if raw:
+        return
+    utils.invalidate_accessible_category_pks()
+
+@receiver(m2m_changed, sender=Category.group_limit.through)
+def invalidate_group_limit_accessible_category_pks(sender, action, **kwargs):
+    if not action in ['post_add', 'post_remove', 'post_clear']:
+        return
+    utils.invalidate_accessible_category_pks()
 
 @receiver(post_save, sender=Category)
 def update_slug_cache(sender, instance, raw=None, **kwargs):
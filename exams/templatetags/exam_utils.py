@@ -6,29 +6,13 @@ register = template.Library()
 
 @register.filter
 def has_changed_choices(revision, previous_revision):
-    previous_choice_texts = previous_revision.choices\
-                                             .values_list('text')
-    new_choice_texts = revision.choices\
-                               .values_list('text')
-    return revision.choices\
-                   .exclude(text__in=previous_choice_texts)\
-                   .exists() or \
-           previous_revision.choices\
-                            .exclude(text__in=new_choice_texts)\
-                            .exists()
+    diffs = utils.get_revision_diffs([(revision, previous_revision)])
+    return diffs[(revision.pk, previous_revision.pk)]['is_choices_changed']
 
 @register.filter
 def get_choice_pairs(revision, previous_revision):
-    index = 0
-    for new_choice in revision.choices.order_by_alphabet():
-        try:
-            previous_choice = previous_revision.choices.order_by_alphabet()[index]
-        except IndexError:
-            previous_choice_text = ''
-        else:
-            previous_choice_text = previous_choice.text
-        yield new_choice.text, previous_choice_text, new_choice.is_right
-        index += 1
+    diffs = utils.get_revision_diffs([(revision, previous_revision)])
+    return diffs[(revision.pk, previous_revision.pk)]['choice_pairs']
 
 @register.filter
 def get_question_sequence(question, session):
@@ -1,3 +1,131 @@
-from django.test import TestCase
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.test import TransactionTestCase
+from django.utils import timezone
+from exams.models import *
+from exams.search_backends import InvertedIndexSearchBackend, get_segment
+from exams.search_indexes import RevisionIndex
+import shutil
+import tempfile
 
-# Create your tests here.
+
+class DuplicateContainerKeepTests(TransactionTestCase):
+    def setUp(self):
+        # Revisions are indexed by the queued signal processor once
+        # committed, which would write to the configured search index.
+        signal_processor = apps.get_app_config('haystack').signal_processor
+        signal_processor.teardown()
+        self.addCleanup(signal_processor.setup)
+
+        self.user = User.objects.create_user('examinee', 'examinee@example.com', 'password')
+        category = Category.objects.create(slug='medicine', name="Medicine")
+        self.exam = Exam.objects.create(name="Pharmacology", category=category)
+        self.kept_question, self.kept_choices = self.create_question("Which drug inhibits platelet aggregation irreversibly?")
+        self.duplicate_question, self.duplicate_choices = self.create_question("Which of the following is first line for pulmonary embolism during pregnancy?")
+
+    def create_question(self, text):
+        question = Question.objects.create(exam=self.exam)
+        revision = Revision.objects.create(question=question, text=text,
+                                           is_approved=True)
+        choices = {'Aspirin': Choice.objects.create(text="Aspirin", is_right=True,
+                                                    revision=revision),
+                   'Heparin': Choice.objects.create(text="Heparin",
+                                                    revision=revision)}
+        revision.choices.add(*choices.values())
+        return Question.objects.get(pk=question.pk), choices
+
+    def create_answer(self, question, choice):
+        session = Session.objects.create(exam=self.exam, submitter=self.user,
+                                         question_filter='ALL',
+                                         secret_key='secret')
+        session.questions.add(question)
+        return Answer.objects.create(session=session, question=question,
+                                     choice=choice)
+
+    def test_keep_moves_answers_and_recomputes_first_answers(self):
+        # The answer to the duplicate question is older, so once it is
+        # moved, it becomes the first answer of the kept question.
+        moved_answer = self.create_answer(self.duplicate_question,
+                                          self.duplicate_choices['Aspirin'])
+        kept_answer = self.create_answer(self.kept_question,
+                                         self.kept_choices['Heparin'])
+        self.assertEqual(FirstAnswer.objects.get(question=self.kept_question).answer,
+                         kept_answer)
+
+        container = DuplicateContainer.objects.create(primary_question=self.kept_question)
+        Duplicate.objects.create(container=container,
+                                 question=self.duplicate_question, ratio=1)
+        report = container.keep(self.kept_question)
+
+        self.assertEqual(report['deleted_questions'], 1)
+        self.assertEqual(report['moved_answers'], 1)
+        self.assertTrue(Question.objects.get(pk=self.duplicate_question.pk).is_deleted)
+
+        # The answer moves to the choice of the kept question with the
+        # same text, and so does its session.
+        moved_answer.refresh_from_db()
+        self.assertEqual(moved_answer.question, self.kept_question)
+        self.assertEqual(moved_answer.choice, self.kept_choices['Aspirin'])
+        self.assertEqual(list(moved_answer.session.questions.all()),
+                         [self.kept_question])
+
+        self.assertEqual(FirstAnswer.objects.get(user=self.user,
+                                                 question=self.kept_question).answer,
+                         moved_answer)
+        self.assertFalse(FirstAnswer.objects.filter(question=self.duplicate_question).exists())
+        self.assertTrue(moved_answer.is_first)
+        kept_answer.refresh_from_db()
+        self.assertFalse(kept_answer.is_first)
+
+        state = UserQuestionState.objects.get(user=self.user,
+                                              question=self.kept_question)
+        self.assertEqual(state.best_result, 'CORRECT')
+        self.assertFalse(UserQuestionState.objects.filter(question=self.duplicate_question).exists())
+
+
+class InvertedIndexSearchBackendTests(TransactionTestCase):
+    def setUp(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        # With at most two segments, the third update merges them.
+        self.backend = InvertedIndexSearchBackend('default', PATH=path,
+                                                  MAX_SEGMENTS=2)
+        self.index = RevisionIndex()
+
+    def get_revision(self, pk, text):
+        # Documents are prepared from the instances alone, so they
+        # do not need to be saved.
+        return Revision(pk=pk, text=text, submission_date=timezone.now())
+
+    def search(self, query_string):
+        results = self.backend.search(query_string, models=[Revision])
+        return sorted(int(result.pk) for result in results['results'])
+
+    def test_index_update_delete_and_search(self):
+        first = self.get_revision(1, "Aspirin inhibits platelet aggregation")
+        second = self.get_revision(2, "Aspirin is contraindicated in children")
+        self.backend.update(self.index, [first, second])
+        third = self.get_revision(3, "Aspirin overdose causes tinnitus")
+        fourth = self.get_revision(4, "Aspirin and heparin are both antithrombotics")
+        self.backend.update(self.index, [third, fourth])
+        self.assertEqual(self.search("aspirin"), [1, 2, 3, 4])
+
+        first.text = "Heparin potentiates antithrombin"
+        self.backend.update(self.index, [first])
+        self.assertEqual(len(self.backend.read_manifest()['segments']), 1)
+        self.backend.remove(second)
+
+        self.assertEqual(self.search("aspirin"), [3, 4])
+        self.assertEqual(self.search("heparin"), [1, 4])
+        self.assertEqual(self.search("aspirin heparin"), [4])
+        self.assertEqual(self.search("children"), [])
+        self.assertEqual(self.search("*"), [1, 3, 4])
+
+        # The statistics of the manifest follow the deletions.
+        for entry in self.backend.read_manifest()['segments']:
+            segment = get_segment(self.backend.path, entry['name'])
+            live_documents = [document for document_number, document in enumerate(segment.documents)
+                              if not document_number in entry['deleted']]
+            self.assertEqual(entry['document_count'], len(live_documents))
+            self.assertEqual(entry['total_length'],
+                             sum(document[4] for document in live_documents))
@@ -0,0 +1,251 @@
+from django.db import connection
+import re
+
+# Question text search is served from database-side full-text
+# indexes: FTS5 virtual tables on SQLite, and tsvector tables with GIN
+# indexes on PostgreSQL.  The tables are created and first filled by
+# migrations (0119, 0120 and 0123).  On
+# other databases, is_supported() is False and callers have to fall
+# back to plain filtering.
+#
+# There are two indexes:
+#
+#  - The autocomplete index matches term prefixes of the latest
+#    revision text, so partially typed words find their questions.
+#    It is kept up-to-date by utils.update_questions_from_revisions().
+#
+#  - The search index holds the best revision text, its choices and
+#    the latest explanation, ranked in that order.  It is kept
+#    up-to-date by utils.update_question_search_index().
+
+AUTOCOMPLETE_TABLE = 'exams_question_autocomplete'
+SEARCH_TABLE = 'exams_question_search'
+
+# SQLite allows at most 999 bound variables per statement.
+CHUNK_SIZE = 500
+
+def get_chunks(items):
+    items = list(items)
+    for start in range(0, len(items), CHUNK_SIZE):
+        yield items[start:start + CHUNK_SIZE]
+
+def is_supported():
+    return connection.vendor in ['sqlite', 'postgresql']
+
+def get_terms(text):
+    # Only word characters are kept, which also makes the terms safe
+    # to use in FTS5 and tsquery expressions.
+    return re.findall(r'\w+', text.lower())
+
+def get_sqlite_match(terms):
+    return " ".join('"{}"*'.format(term) for term in terms)
+
+def get_postgresql_query(terms):
+    return " & ".join("{}:*".format(term) for term in terms)
+
+def index_autocomplete_texts(question_texts):
+    # question_texts is a list of (question_pk, exam_pk, text) tuples.
+    if not question_texts or not is_supported():
+        return
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            # FTS5 tables have no upsert, so we replace the rows.
+            for chunk in get_chunks(question_texts):
+                placeholders = ", ".join(["%s"] * len(chunk))
+                cursor.execute("DELETE FROM {} WHERE rowid IN ({})".format(AUTOCOMPLETE_TABLE, placeholders),
+                               [question_pk for question_pk, exam_pk, text in chunk])
+            cursor.executemany("INSERT INTO {} (rowid, exam_id, text) VALUES (%s, %s, %s)".format(AUTOCOMPLETE_TABLE),
+                               question_texts)
+        elif connection.vendor == 'postgresql':
+            cursor.executemany("INSERT INTO {} (question_id, exam_id, document) "
+                               "VALUES (%s, %s, to_tsvector('simple', %s)) "
+                               "ON CONFLICT (question_id) DO UPDATE "
+                               "SET exam_id = EXCLUDED.exam_id, "
+                               "document = EXCLUDED.document".format(AUTOCOMPLETE_TABLE),
+                               question_texts)
+
+def clear_autocomplete_index():
+    if not is_supported():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM {}".format(AUTOCOMPLETE_TABLE))
+
+def remove_autocomplete_texts(question_pks):
+    question_pks = list(question_pks)
+    if not question_pks or not is_supported():
+        return
+    if connection.vendor == 'sqlite':
+        column = 'rowid'
+    else:
+        column = 'question_id'
+    with connection.cursor() as cursor:
+        for chunk in get_chunks(question_pks):
+            placeholders = ", ".join(["%s"] * len(chunk))
+            cursor.execute("DELETE FROM {} WHERE {} IN ({})".format(AUTOCOMPLETE_TABLE, column, placeholders),
+                           chunk)
+
+def search_autocomplete(exam_pk, text, limit=20):
+    # Return the primary keys of the best-matching questions of the
+    # exam, best first.  Every term has to match (as a prefix).
+    terms = get_terms(text)
+    if not terms:
+        return []
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute("SELECT rowid FROM {0} WHERE {0} MATCH %s AND exam_id = %s "
+                           "ORDER BY rank LIMIT %s".format(AUTOCOMPLETE_TABLE),
+                           [get_sqlite_match(terms), exam_pk, limit])
+        elif connection.vendor == 'postgresql':
+            cursor.execute("SELECT question_id FROM {}, to_tsquery('simple', %s) query "
+                           "WHERE exam_id = %s AND document @@ query "
+                           "ORDER BY ts_rank(document, query) DESC LIMIT %s".format(AUTOCOMPLETE_TABLE),
+                           [get_postgresql_query(terms), exam_pk, limit])
+        return [row[0] for row in cursor.fetchall()]
+
+def index_search_documents(documents):
+    # documents is a list of (question_pk, exam_pk, is_approved,
+    # is_deleted, text, choices, explanation) tuples.
+    if not documents or not is_supported():
+        return
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            for chunk in get_chunks(documents):
+                placeholders = ", ".join(["%s"] * len(chunk))
+                cursor.execute("DELETE FROM {} WHERE rowid IN ({})".format(SEARCH_TABLE, placeholders),
+                               [document[0] for document in chunk])
+            cursor.executemany("INSERT INTO {} (rowid, exam_id, is_approved, is_deleted, "
+                               "text, choices, explanation) "
+                               "VALUES (%s, %s, %s, %s, %s, %s, %s)".format(SEARCH_TABLE),
+                               [(question_pk, exam_pk, int(is_approved), int(is_deleted),
+                                 text, choices, explanation)
+                                for question_pk, exam_pk, is_approved, is_deleted, text, choices, explanation in documents])
+        elif connection.vendor == 'postgresql':
+            cursor.executemany("INSERT INTO {} (question_id, exam_id, is_approved, is_deleted, document) "
+                               "VALUES (%s, %s, %s, %s, "
+                               "setweight(to_tsvector('english', %s), 'A') || "
+                               "setweight(to_tsvector('english', %s), 'B') || "
+                               "setweight(to_tsvector('english', %s), 'C')) "
+                               "ON CONFLICT (question_id) DO UPDATE "
+                               "SET exam_id = EXCLUDED.exam_id, "
+                               "is_approved = EXCLUDED.is_approved, "
+                               "is_deleted = EXCLUDED.is_deleted, "
+                               "document = EXCLUDED.document".format(SEARCH_TABLE),
+                               documents)
+
+def clear_search_index():
+    if not is_supported():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM {}".format(SEARCH_TABLE))
+
+def remove_search_documents(question_pks):
+    question_pks = list(question_pks)
+    if not question_pks or not is_supported():
+        return
+    if connection.vendor == 'sqlite':
+        column = 'rowid'
+    else:
+        column = 'question_id'
+    with connection.cursor() as cursor:
+        for chunk in get_chunks(question_pks):
+            placeholders = ", ".join(["%s"] * len(chunk))
+            cursor.execute("DELETE FROM {} WHERE {} IN ({})".format(SEARCH_TABLE, column, placeholders),
+                           chunk)
+
+class QuestionSearch:
+    # A lazy, sliceable sequence of the primary keys of the questions
+    # that match a search, best first, so that it can be passed to
+    # django.core.paginator.Paginator.  Only the requested page is
+    # fetched.  exam_pks limits the search to the given exams (None
+    # means all exams), and approved_only hides unapproved and
+    # deleted questions.  first_pks are listed before the matches
+    # (e.g. a question looked up by its primary key), and it is up
+    # to the caller to check them against the same limits.
+    def __init__(self, text, exam_pks=None, approved_only=True,
+                 first_pks=None):
+        self.terms = get_terms(text)
+        self.exam_pks = exam_pks
+        self.approved_only = approved_only
+        self.first_pks = list(first_pks or [])
+        self._count = None
+
+    def is_empty(self):
+        # Whether there are no matches, besides first_pks.
+        return not self.terms or \
+               (self.exam_pks is not None and not self.exam_pks)
+
+    def get_conditions(self):
+        if connection.vendor == 'sqlite':
+            conditions = ["{0} MATCH %s".format(SEARCH_TABLE)]
+            params = [" ".join('"{}"'.format(term) for term in self.terms)]
+        else:
+            conditions = ["document @@ query"]
+            params = []
+        if self.exam_pks is not None:
+            placeholders = ", ".join(["%s"] * len(self.exam_pks))
+            conditions.append("exam_id IN ({})".format(placeholders))
+            params += list(self.exam_pks)
+        if self.approved_only:
+            if connection.vendor == 'sqlite':
+                conditions.append("is_approved = 1 AND is_deleted = 0")
+            else:
+                conditions.append("is_approved AND NOT is_deleted")
+        if self.first_pks:
+            placeholders = ", ".join(["%s"] * len(self.first_pks))
+            if connection.vendor == 'sqlite':
+                conditions.append("rowid NOT IN ({})".format(placeholders))
+            else:
+                conditions.append("question_id NOT IN ({})".format(placeholders))
+            params += self.first_pks
+        return " AND ".join(conditions), params
+
+    def get_from_clause(self):
+        if connection.vendor == 'sqlite':
+            return SEARCH_TABLE, []
+        else:
+            return "{}, plainto_tsquery('english', %s) query".format(SEARCH_TABLE), \
+                   [" ".join(self.terms)]
+
+    def count(self):
+        if self._count is None:
+            self._count = len(self.first_pks)
+            if not self.is_empty():
+                from_clause, from_params = self.get_from_clause()
+                conditions, params = self.get_conditions()
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT COUNT(*) FROM {} WHERE {}".format(from_clause, conditions),
+                                   from_params + params)
+                    self._count += cursor.fetchone()[0]
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key:key + 1][0]
+        start = key.start or 0
+        stop = key.stop if key.stop is not None else self.count()
+        if stop <= start:
+            return []
+        first_pks = self.first_pks[start:stop]
+        start = max(start - len(self.first_pks), 0)
+        stop = max(stop - len(self.first_pks), 0)
+        if self.is_empty() or stop <= start:
+            return first_pks
+
+        from_clause, from_params = self.get_from_clause()
+        conditions, params = self.get_conditions()
+        if connection.vendor == 'sqlite':
+            # Matches in the question text weigh the most, then those
+            # in choices, then those in the explanation.
+            columns = "rowid"
+            ordering = "bm25({}, 10.0, 5.0, 1.0)".format(SEARCH_TABLE)
+        else:
+            columns = "question_id"
+            ordering = "ts_rank(document, query) DESC"
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT {} FROM {} WHERE {} ORDER BY {} LIMIT %s OFFSET %s".format(columns, from_clause,
+                                                                                         conditions, ordering),
+                           from_params + params + [stop - start, start])
+            return first_pks + [row[0] for row in cursor.fetchall()]
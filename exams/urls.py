@@ -33,6 +33,8 @@ urlpatterns =[
     url(r'^ajax/examinees/explain$', views.contribute_explanation, name='contribute_explanation'),
     url(r'^ajax/examinees/mnemonics$', views.contribute_mnemonics, name='contribute_mnemonics'),
     url(r'^ajax/examinees/submit_answer$', views.submit_answer, name='submit_answer'),
+    url(r'^ajax/examinees/submit_answers$', views.submit_answers, name='submit_answers'),
+    url(r'^ajax/examinees/prefetch/(?P<session_pk>\d+)$', views.prefetch_session_questions, name='prefetch_session_questions'),
     url(r'^ajax/examinees/submit_highlight$', views.submit_highlight, name='submit_highlight'),
     url(r'^ajax/examinees/toggle_marked$', views.toggle_marked, name='toggle_marked'),
     url(r'^ajax/examinees/toggle_sharing_results$', views.toggle_sharing_results, name='toggle_sharing_results'),
@@ -1,6 +1,16 @@
-from django.db.models import Count, Q
-from exams import models
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Count, Max, Min, Prefetch, Q, prefetch_related_objects
+from exams import duplicates, models, text_search
+import accounts.models
+import accounts.utils
+import contextlib
 import teams.utils
+import textwrap
+import threading
+import uuid
 
 
 def is_question_marked(question, user):
@@ -34,6 +44,296 @@ def get_deepest_category_level():
         count += 1
     return count
 
+def sample_question_pks(question_pool, count):
+    # Django is buggy when it comes to slicing a randomized query with
+    # many filters (and Postgres refuses to randomly order a DISTINCT
+    # query), so we randomize a plain query over the PKs of the pool.
+    # This way, sampling happens in the database, and only the
+    # sampled PKs are fetched.
+    return list(models.Question.objects.filter(pk__in=question_pool.values('pk'))\
+                                       .order_by('?')\
+                                       .values_list('pk', flat=True)[:count])
+
+def allocate_session_question_pks(question_pool, number_of_questions,
+                                  approved_only=True):
+    # Return the PKs of number_of_questions random questions of
+    # question_pool for a new session.  Randomization and slicing
+    # happen in the database, so only the sampled PKs are ever
+    # loaded.  Question trees count toward the total: whole trees of
+    # the sampled questions are added first, and the remaining slots
+    # are filled with sampled orphan questions.
+    sampled_pks = sample_question_pks(question_pool, number_of_questions)
+    selected_pool = models.Question.objects.filter(pk__in=sampled_pks)
+    # Questions that bypassed the signals that maintain the question
+    # tree index (e.g. bulk_create()) are indexed now, so that their
+    # trees are not silently dropped.
+    unindexed_pks = list(selected_pool.filter(tree_root__isnull=True)\
+                                      .values_list('pk', flat=True))
+    if unindexed_pks:
+        update_question_trees(unindexed_pks)
+    tree_members = selected_pool.filter(tree_size__gt=1)
+    tree_member_pks = set(tree_members.values_list('pk', flat=True))
+
+    questions_with_tree = tree_members.with_trees()
+    if approved_only:
+        questions_with_tree = questions_with_tree.approved()
+
+    question_pks = list(questions_with_tree.values_list('pk', flat=True))
+    remaining_count = number_of_questions - len(question_pks)
+    if remaining_count > 0:
+        orphan_pks = [pk for pk in sampled_pks
+                      if pk not in tree_member_pks][:remaining_count]
+        question_pks += orphan_pks
+    return question_pks
+
+def get_question_tree_pks(question_pks):
+    """Expand question PKs to the PKs of their whole question trees."""
+    questions = models.Question.objects.filter(pk__in=question_pks)
+    return set(questions.with_trees().values_list('pk', flat=True))
+
+def walk_question_trees(question_pks):
+    # Unlike get_question_tree_pks(), this follows parent_question
+    # rather than the question tree index, so it is what we use to
+    # (re)build the index.  Rather than following parent_question and
+    # child_question one question at a time, we walk all trees
+    # together, one query per tree level.
+    tree_pks = set(question_pks)
+    frontier = set(question_pks)
+    while frontier:
+        links = models.Question.objects.filter(Q(pk__in=frontier) |
+                                               Q(parent_question__in=frontier))\
+                                       .values_list('pk', 'parent_question')
+        found_pks = set()
+        for pk, parent_pk in links:
+            found_pks.add(pk)
+            if parent_pk:
+                found_pks.add(parent_pk)
+        frontier = found_pks - tree_pks
+        tree_pks |= found_pks
+    return tree_pks
+
+def update_question_trees(question_pks=None):
+    # Recompute the question tree index (tree_root, tree_position and
+    # tree_size) of all questions, or only of the trees of
+    # `question_pks`.  In the latter case, both the trees the
+    # questions are currently linked to and the trees they were
+    # indexed in are recomputed, so split trees are handled as well.
+    # Returns a dictionary of PK: (tree_root, tree_position, tree_size)
+    # of the recomputed questions.
+    questions = models.Question.objects.all()
+    if question_pks is not None:
+        indexed_pks = get_question_tree_pks(question_pks)
+        questions = questions.filter(pk__in=walk_question_trees(indexed_pks))
+
+    parents = {}
+    current_index = {}
+    for pk, parent_pk, tree_root_pk, tree_position, tree_size in \
+        questions.values_list('pk', 'parent_question', 'tree_root',
+                              'tree_position', 'tree_size').iterator():
+        parents[pk] = parent_pk
+        current_index[pk] = (tree_root_pk, tree_position, tree_size)
+    children = {parent_pk: pk for pk, parent_pk in parents.items()
+                if parent_pk in parents}
+
+    new_index = {}
+    for pk, parent_pk in parents.items():
+        if parent_pk in parents:
+            continue
+        tree = [pk]
+        while tree[-1] in children:
+            tree.append(children[tree[-1]])
+        for tree_position, tree_pk in enumerate(tree):
+            new_index[tree_pk] = (pk, tree_position, len(tree))
+
+    changed_questions = []
+    for pk in parents:
+        # Questions that are part of a parent_question cycle have no
+        # root.  Index them as orphans rather than looping forever.
+        tree_root_pk, tree_position, tree_size = new_index.setdefault(pk, (pk, 0, 1))
+        if current_index[pk] != new_index[pk]:
+            changed_questions.append(models.Question(pk=pk,
+                                                     tree_root_id=tree_root_pk,
+                                                     tree_position=tree_position,
+                                                     tree_size=tree_size))
+    models.Question.objects.bulk_update(changed_questions,
+                                        ['tree_root', 'tree_position',
+                                         'tree_size'],
+                                        batch_size=1000)
+    return new_index
+
+def get_text_preview(text):
+    return textwrap.shorten(text, 70, placeholder='...')
+
+# While defer_revision_updates() is active, the questions whose
+# revisions have changed are collected here, keyed by primary key,
+# instead of being recomputed right away.
+_revision_updates = threading.local()
+
+@contextlib.contextmanager
+def defer_revision_updates():
+    # Bulk operations (imports, suggestion handling, duplicate merges)
+    # save many revisions, some of them more than once.  Within this
+    # context, update_questions_from_revisions() only queues the
+    # questions, and each of them is recomputed once on exit.  Nested
+    # uses are folded into the outermost one.  It can also be used as
+    # a decorator.
+    if getattr(_revision_updates, 'questions', None) is not None:
+        yield
+        return
+    _revision_updates.questions = {}
+    try:
+        yield
+    except BaseException:
+        questions = _revision_updates.questions
+        _revision_updates.questions = None
+        # What the block saved before it raised may well be committed
+        # (e.g. the questions imported so far), so it is recomputed
+        # all the same.  If the transaction is broken, its writes are
+        # rolled back anyway, and the original error is what matters.
+        with contextlib.suppress(DatabaseError):
+            with transaction.atomic():
+                update_questions_from_revisions(questions.values())
+        raise
+    questions = _revision_updates.questions
+    _revision_updates.questions = None
+    update_questions_from_revisions(questions.values())
+
+def update_questions_from_revisions(questions):
+    # Derive Revision.is_last, and Question.is_deleted, best_revision,
+    # is_approved and the text preview from a single ordered fetch of
+    # the revisions of the given questions (instances or primary
+    # keys).  Instances that are passed are updated in place.  Only
+    # questions whose fields have actually changed are saved.
+    instances = {}
+    question_pks = set()
+    for question in questions:
+        if isinstance(question, models.Question):
+            instances[question.pk] = question
+            question_pks.add(question.pk)
+        else:
+            question_pks.add(question)
+
+    # Keep the instances, so that the callers' copies are the ones
+    # that get updated once the deferred recomputation runs.
+    pending_questions = getattr(_revision_updates, 'questions', None)
+    if pending_questions is not None:
+        for question_pk in question_pks:
+            if question_pk in instances or \
+               question_pk not in pending_questions:
+                pending_questions[question_pk] = instances.get(question_pk, question_pk)
+        return
+    if not question_pks:
+        return
+
+    missing_pks = question_pks - set(instances)
+    if missing_pks:
+        for question in models.Question.objects.filter(pk__in=missing_pks):
+            instances[question.pk] = question
+
+    revisions = models.Revision.objects\
+                              .filter(question__in=question_pks)\
+                              .annotate(choice_count=Count('choices'),
+                                        right_choice_count=Count('choices',
+                                                                 filter=Q(choices__is_right=True)))\
+                              .order_by('question', 'submission_date', 'pk')\
+                              .values('pk', 'question', 'is_deleted',
+                                      'is_approved', 'is_contribution',
+                                      'is_last', 'choice_count',
+                                      'right_choice_count')
+    question_revisions = {}
+    for revision in revisions:
+        question_revisions.setdefault(revision['question'], []).append(revision)
+    blocked_pks = set(models.Question.objects\
+                                     .filter(pk__in=question_pks,
+                                             issues__is_blocker=True)\
+                                     .values_list('pk', flat=True))
+
+    last_pks = []
+    not_last_pks = []
+    changed_questions = {}
+    preview_revision_pks = {}
+    for question_pk, question in instances.items():
+        all_revisions = question_revisions.get(question_pk, [])
+        undeleted_revisions = [revision for revision in all_revisions
+                               if not revision['is_deleted']]
+        approved_revisions = [revision for revision in undeleted_revisions
+                              if revision['is_approved']]
+        editor_revisions = [revision for revision in undeleted_revisions
+                            if not revision['is_contribution']]
+
+        changed_fields = []
+        if undeleted_revisions:
+            latest_revision = undeleted_revisions[-1]
+            if question.preview_revision_id != latest_revision['pk']:
+                preview_revision_pks[question_pk] = latest_revision['pk']
+            for revision in all_revisions:
+                is_last = revision['pk'] == latest_revision['pk']
+                if revision['is_last'] != is_last:
+                    if is_last:
+                        last_pks.append(revision['pk'])
+                    else:
+                        not_last_pks.append(revision['pk'])
+
+        # A question with no undeleted revisions is deleted, but we
+        # never undelete questions from here.
+        is_deleted = question.is_deleted or not undeleted_revisions
+
+        best_revisions = approved_revisions or \
+                         editor_revisions or \
+                         undeleted_revisions
+        best_revision_pk = best_revisions[-1]['pk'] if best_revisions else None
+
+        approved_revision = approved_revisions[-1] if approved_revisions else None
+        is_approved = bool(approved_revision and \
+                           not is_deleted and \
+                           question_pk not in blocked_pks and \
+                           approved_revision['right_choice_count'] and \
+                           approved_revision['choice_count'] > 1)
+
+        if question.is_deleted != is_deleted:
+            question.is_deleted = is_deleted
+            changed_fields.append('is_deleted')
+        if question.best_revision_id != best_revision_pk:
+            question.best_revision_id = best_revision_pk
+            # Drop any previously-cached best_revision instance.
+            models.Question._meta.get_field('best_revision')\
+                                 .delete_cached_value(question)
+            changed_fields.append('best_revision')
+        if question.is_approved != is_approved:
+            question.is_approved = is_approved
+            changed_fields.append('is_approved')
+        if changed_fields or question_pk in preview_revision_pks:
+            changed_questions[question_pk] = changed_fields
+
+    # Only fetch the text of the latest revisions that have changed.
+    if preview_revision_pks:
+        revision_texts = dict(models.Revision.objects\
+                                    .filter(pk__in=preview_revision_pks.values())\
+                                    .values_list('pk', 'text'))
+        autocomplete_texts = []
+        for question_pk, revision_pk in preview_revision_pks.items():
+            question = instances[question_pk]
+            question.preview_revision_id = revision_pk
+            question.preview_text = get_text_preview(revision_texts[revision_pk])
+            changed_questions[question_pk] += ['preview_revision',
+                                               'preview_text']
+            autocomplete_texts.append((question_pk, question.exam_id,
+                                       revision_texts[revision_pk]))
+        text_search.index_autocomplete_texts(autocomplete_texts)
+    text_search.remove_autocomplete_texts([question_pk
+                                           for question_pk, changed_fields in changed_questions.items()
+                                           if 'is_deleted' in changed_fields])
+
+    for question_pk, changed_fields in changed_questions.items():
+        instances[question_pk].save(update_fields=changed_fields)
+
+    if last_pks:
+        models.Revision.objects.filter(pk__in=last_pks)\
+                               .update(is_last=True)
+    if not_last_pks:
+        models.Revision.objects.filter(pk__in=not_last_pks)\
+                               .update(is_last=False)
+
 def get_user_question_stats(target, user, result, total=None, percent=False):
     # Target can either be an exam, subject or session.
     #
@@ -51,16 +351,8 @@ def get_user_question_stats(target, user, result, total=None, percent=False):
     # Subject and Exam models have a similar way of calculation.
     if type(target) in [models.Subject, models.Exam]:
         if type(target) is models.Exam:
-            all_pks = models.Answer.objects.filter(session__submitter=user,
-                                                   question__exam=target,
-                                                   session__is_deleted=False)\
-                                           .values('question')
             pool = models.Question.objects.undeleted().filter(exam=target)
         elif type(target) is models.Subject:
-            all_pks = models.Answer.objects.filter(session__submitter=user,
-                                                   question__subjects=target,
-                                                   session__is_deleted=False)\
-                                           .values('question')
             pool = models.Question.objects.undeleted().filter(subjects=target)
 
         if result == 'correct':
@@ -73,7 +365,8 @@ def get_user_question_stats(target, user, result, total=None, percent=False):
             count = pool.skipped_by_user(user)\
                         .count()
         elif result == 'total':
-            count = pool.filter(pk__in=all_pks).count()
+            count = pool.used_by_user(user, exclude_skipped=False)\
+                        .count()
     elif type(target) is models.Session:
         pool = models.Answer.objects.filter(session=target)\
                                     .of_undeleted_questions()\
@@ -97,6 +390,278 @@ def get_user_question_stats(target, user, result, total=None, percent=False):
     else:
         return count
 
+def add_session_questions(session, question_pks, batch_size=1000):
+    # Insert rows into the Session.questions through table straight
+    # from PKs, without loading Question instances.  Unlike
+    # session.questions.add(), this does not look for existing rows,
+    # so it is meant for newly-created sessions.  Returns the number
+    # of distinct PKs, which is the number of inserted rows, as
+    # bulk_create() either inserts every row or raises.
+    SessionQuestion = models.Session.questions.through
+    added_pks = set()
+    rows = []
+    for question_pk in question_pks:
+        if question_pk in added_pks:
+            continue
+        added_pks.add(question_pk)
+        rows.append(SessionQuestion(session_id=session.pk,
+                                    question_id=question_pk))
+        if len(rows) >= batch_size:
+            SessionQuestion.objects.bulk_create(rows)
+            rows = []
+    SessionQuestion.objects.bulk_create(rows)
+    return len(added_pks)
+
+def copy_session_questions(question_pks, new_question_pk):
+    # Add new_question_pk to every session that has any of
+    # question_pks and does not have it yet, in a single INSERT ...
+    # SELECT on the Session.questions through table (e.g. when
+    # merging duplicates).  Returns the number of inserted rows.
+    question_pks = list(question_pks)
+    if not question_pks:
+        return 0
+    SessionQuestion = models.Session.questions.through
+    table = connection.ops.quote_name(SessionQuestion._meta.db_table)
+    session_column = connection.ops.quote_name(SessionQuestion._meta.get_field('session').column)
+    question_column = connection.ops.quote_name(SessionQuestion._meta.get_field('question').column)
+    placeholders = ", ".join(["%s"] * len(question_pks))
+    sql = f"INSERT INTO {table} ({session_column}, {question_column}) " \
+          f"SELECT DISTINCT {session_column}, %s FROM {table} " \
+          f"WHERE {question_column} IN ({placeholders}) " \
+          f"AND {session_column} NOT IN " \
+          f"(SELECT {session_column} FROM {table} WHERE {question_column} = %s)"
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [new_question_pk] + question_pks + [new_question_pk])
+        return cursor.rowcount
+
+def reset_session_question_orders(question_pks):
+    # Mark the stored question orders of all sessions with any of the
+    # given questions as stale.  They are recomputed, one session at a
+    # time, the next time they are needed (see
+    # Session.get_question_order()), so this costs a single query
+    # however many sessions are affected.
+    return models.Session.objects.filter(questions__in=question_pks)\
+                                 .exclude(question_order="")\
+                                 .update(question_order="")
+
+def update_user_question_states(user=None, question_pks=None):
+    # Recompute UserQuestionState rows from the Answer table.  Either
+    # (or both) of `user` and `question_pks` can be used to limit the
+    # scope of recomputation.  Only answers in undeleted sessions are
+    # considered, and rows that no longer have any answer are
+    # removed.
+    answers = models.Answer.objects.filter(session__is_deleted=False)
+    states = models.UserQuestionState.objects.all()
+    if user:
+        answers = answers.filter(session__submitter=user)
+        states = states.filter(user=user)
+    if question_pks is not None:
+        answers = answers.filter(question__in=question_pks)
+        states = states.filter(question__in=question_pks)
+
+    with transaction.atomic():
+        # Lock the current rows before reading the answers, so that
+        # concurrent recomputations of the same states (e.g. two
+        # answers submitted at once from two tabs) wait for each
+        # other.
+        current_states = {(state.user_id, state.question_id): state
+                          for state in states.select_for_update()}
+
+        # Like FirstAnswer, skipped answers do not count as first
+        # answers.
+        rows = answers.values('session__submitter', 'question')\
+                      .annotate(correct_count=Count('pk', filter=Q(choice__is_right=True)),
+                                incorrect_count=Count('pk', filter=Q(choice__is_right=False)),
+                                first_answer=Min('pk', filter=Q(choice__isnull=False)),
+                                last_answer_date=Max('submission_date'))\
+                      .order_by()
+
+        new_states = []
+        changed_states = []
+        for row in rows.iterator():
+            if row['correct_count']:
+                best_result = 'CORRECT'
+            elif row['incorrect_count']:
+                best_result = 'INCORRECT'
+            else:
+                best_result = 'SKIPPED'
+            values = (best_result, row['first_answer'],
+                      row['last_answer_date'])
+            key = (row['session__submitter'], row['question'])
+            state = current_states.pop(key, None)
+            if state is None:
+                state = models.UserQuestionState(user_id=row['session__submitter'],
+                                                 question_id=row['question'])
+                new_states.append(state)
+            elif (state.best_result, state.first_answer_id,
+                  state.last_answer_date) != values:
+                changed_states.append(state)
+            state.best_result, state.first_answer_id, state.last_answer_date = values
+
+        # What is left no longer has any answer.
+        stale_state_pks = [state.pk for state in current_states.values()]
+        for start in range(0, len(stale_state_pks), 500):
+            models.UserQuestionState.objects\
+                                    .filter(pk__in=stale_state_pks[start:start + 500])\
+                                    .delete()
+
+        # A concurrent recomputation can still insert a row we have
+        # not seen first.  Ours is then ignored, and the update below
+        # overwrites it with what we have computed.
+        models.UserQuestionState.objects.bulk_create(new_states,
+                                                     batch_size=1000,
+                                                     ignore_conflicts=True)
+        if new_states:
+            state_pks = {(user_pk, question_pk): pk
+                         for pk, user_pk, question_pk in states.values_list('pk', 'user', 'question')}
+            for state in new_states:
+                state.pk = state_pks.get((state.user_id, state.question_id))
+                if state.pk:
+                    changed_states.append(state)
+        models.UserQuestionState.objects.bulk_update(changed_states,
+                                                     ['best_result',
+                                                      'first_answer',
+                                                      'last_answer_date'],
+                                                     batch_size=1000)
+
+def update_first_answers(user=None, question_pks=None):
+    # Rebuild FirstAnswer rows (and the Answer.is_first flag derived
+    # from them).  This is only needed when answers are removed or
+    # moved between questions; new answers are handled by the
+    # set_first_answer signal.  Skipped answers do not count.
+    answers = models.Answer.objects.all()
+    first_answers = models.FirstAnswer.objects.all()
+    if user:
+        answers = answers.filter(session__submitter=user)
+        first_answers = first_answers.filter(user=user)
+    if question_pks is not None:
+        answers = answers.filter(question__in=question_pks)
+        first_answers = first_answers.filter(question__in=question_pks)
+
+    rows = answers.filter(choice__isnull=False)\
+                  .values('session__submitter', 'question')\
+                  .annotate(first_answer=Min('pk'))\
+                  .order_by()
+    new_first_answers = [models.FirstAnswer(user_id=row['session__submitter'],
+                                            question_id=row['question'],
+                                            answer_id=row['first_answer'])
+                         for row in rows.iterator()]
+
+    with transaction.atomic():
+        first_answers.delete()
+        models.FirstAnswer.objects.bulk_create(new_first_answers,
+                                               batch_size=1000)
+        # Once recreated, first_answers holds exactly the new rows, so
+        # the flags are updated with a subquery rather than binding a
+        # parameter per first answer.
+        first_answer_pks = first_answers.values('answer')
+        answers.filter(is_first=True)\
+               .exclude(pk__in=first_answer_pks)\
+               .update(is_first=False)
+        models.Answer.objects.filter(pk__in=first_answer_pks,
+                                     is_first=False)\
+                             .update(is_first=True)
+
+def update_session_counters(session_pks):
+    # Recompute the stored answer and question counts of the given
+    # sessions in bulk.  This is what update_session_stats used to do
+    # on every answer, and it is now only needed to repair drift (see
+    # the resync_session_counters command).  Returns the number of
+    # sessions whose counters have changed.
+    sessions = models.Session.objects.filter(pk__in=session_pks)\
+                                     .only('pk', 'unused_question_count',
+                                           'correct_answer_count',
+                                           'incorrect_answer_count',
+                                           'skipped_answer_count')
+    # This mirrors Session.get_questions()
+    pool_query = Q(question__is_deleted=False) & \
+                 (Q(question__is_approved=True) |
+                  Q(session__question_filter='INCOMPLETE'))
+
+    answer_counts = models.Answer.objects.filter(pool_query,
+                                                 session__in=session_pks)\
+                                         .values('session')\
+                                         .annotate(correct=Count('pk', filter=Q(choice__is_right=True)),
+                                                   incorrect=Count('pk', filter=Q(choice__is_right=False)),
+                                                   skipped=Count('pk', filter=Q(choice__isnull=True)))\
+                                         .order_by()
+    answer_counts = {row['session']: row for row in answer_counts}
+
+    question_counts = models.Session.questions.through.objects\
+                                    .filter(pool_query,
+                                            session__in=session_pks)\
+                                    .values('session')\
+                                    .annotate(total=Count('pk'))\
+                                    .order_by()
+    question_counts = {row['session']: row['total'] for row in question_counts}
+
+    changed_sessions = []
+    for session in sessions:
+        counts = answer_counts.get(session.pk, {})
+        correct = counts.get('correct', 0)
+        incorrect = counts.get('incorrect', 0)
+        skipped = counts.get('skipped', 0)
+        total = question_counts.get(session.pk, 0)
+        unused = max(total - correct - incorrect - skipped, 0)
+        if (session.correct_answer_count, session.incorrect_answer_count,
+            session.skipped_answer_count, session.unused_question_count) != \
+           (correct, incorrect, skipped, unused):
+            session.correct_answer_count = correct
+            session.incorrect_answer_count = incorrect
+            session.skipped_answer_count = skipped
+            session.unused_question_count = unused
+            changed_sessions.append(session)
+
+    models.Session.objects.bulk_update(changed_sessions,
+                                       ['correct_answer_count',
+                                        'incorrect_answer_count',
+                                        'skipped_answer_count',
+                                        'unused_question_count'])
+    return len(changed_sessions)
+
+META_COUNT_FIELDS = ['subjects', 'sources', 'exam_types', 'issues',
+                     'difficulty']
+
+def get_exam_meta_question_counts_key(exam_pk, approved_only):
+    return f'exam_{exam_pk}_meta_question_counts_{approved_only}'
+
+def get_exam_meta_question_counts(exam, approved_only=False, use_cache=True):
+    # The same numbers as get_exam_question_count_per_meta(), but
+    # for every meta type and value at once: one grouped query per
+    # meta type.  Returns a dictionary of {meta field: {meta PK:
+    # question count}}.
+    cache_key = get_exam_meta_question_counts_key(exam.pk, approved_only)
+    if use_cache:
+        counts = cache.get(cache_key)
+        if counts is not None:
+            return counts
+
+    questions = models.Question.objects.filter(exam=exam)
+    if approved_only:
+        questions = questions.filter(is_deleted=False, is_approved=True)
+
+    counts = {}
+    for field_name in META_COUNT_FIELDS:
+        field = models.Question._meta.get_field(field_name)
+        if field.many_to_many:
+            # Through rows are unique per question and meta, so there
+            # is no need for COUNT(DISTINCT).
+            meta_field_name = field.m2m_reverse_field_name()
+            rows = field.remote_field.through.objects\
+                                             .filter(question__in=questions)
+        else:
+            meta_field_name = field_name
+            rows = questions.filter(**{field_name + '__isnull': False})
+        rows = rows.values(meta_field_name)\
+                   .annotate(count=Count('pk'))\
+                   .order_by()
+        counts[field_name] = {row[meta_field_name]: row['count']
+                              for row in rows}
+
+    if use_cache:
+        cache.set(cache_key, counts, settings.CACHE_PERIODS['STABLE'])
+    return counts
+
 def get_exam_question_count_per_meta(exam, meta, approved_only=False):
     if type(meta) is models.Source:
         keyword = 'sources'
@@ -118,13 +683,632 @@ def get_exam_question_count_per_meta(exam, meta, approved_only=False):
 
     return question_pool.filter(**query).distinct().count()
 
+# The facet index of an exam maps every subject, source, exam type and
+# difficulty to a bitset (a plain Python integer) of the questions that
+# have it, where bit `n` stands for the `n`th question of the exam in PK
+# order.  Counting the questions of a create-session selection then
+# becomes a few bitwise operations over a cached object.  It is
+# invalidated by signals whenever questions, their meta information or
+# their choices change.
+FACET_FIELDS = {'subjects': 'subjects',
+                'sources': 'sources',
+                'exam_types': 'exam_types',
+                'difficulties': 'difficulty'}
+
+def make_bitset(positions):
+    positions = list(positions)
+    if not positions:
+        return 0
+    bits = bytearray(max(positions) // 8 + 1)
+    for position in positions:
+        bits[position // 8] |= 1 << (position % 8)
+    return int.from_bytes(bits, 'little')
+
+def count_bitset(bitset):
+    return bin(bitset).count('1')
+
+def get_exam_facet_index_key(exam_pk):
+    return f'exam_{exam_pk}_facet_index'
+
+def build_exam_facet_index(exam):
+    questions = models.Question.objects.filter(exam=exam)
+    rows = list(questions.order_by('pk')\
+                         .values_list('pk', 'is_deleted', 'is_approved',
+                                      'difficulty'))
+    positions = {row[0]: position for position, row in enumerate(rows)}
+
+    approved_positions = []
+    facet_positions = {facet: {} for facet in FACET_FIELDS}
+    for pk, is_deleted, is_approved, difficulty_pk in rows:
+        if is_approved and not is_deleted:
+            approved_positions.append(positions[pk])
+        if difficulty_pk:
+            facet_positions['difficulties'].setdefault(difficulty_pk, [])\
+                                           .append(positions[pk])
+
+    for facet in ['subjects', 'sources', 'exam_types']:
+        field = models.Question._meta.get_field(FACET_FIELDS[facet])
+        links = field.remote_field.through.objects\
+                                          .filter(question__exam=exam)\
+                                          .values_list('question',
+                                                       field.m2m_reverse_field_name())
+        for question_pk, meta_pk in links.iterator():
+            facet_positions[facet].setdefault(meta_pk, [])\
+                                  .append(positions[question_pk])
+
+    incomplete_pks = questions.incomplete().values_list('pk', flat=True)
+    index = {'question_pks': list(positions),
+             'approved': make_bitset(approved_positions),
+             'incomplete': make_bitset(positions[pk] for pk in incomplete_pks)}
+    for facet, meta_positions in facet_positions.items():
+        index[facet] = {meta_pk: make_bitset(meta_positions[meta_pk])
+                        for meta_pk in meta_positions}
+    return index
+
+def is_cache_persistent():
+    # The default DummyCache (see settings.py) stores nothing, so
+    # anything we cache with it is rebuilt on every request.
+    return not isinstance(caches['default'], DummyCache)
+
+def get_exam_facet_index(exam):
+    cache_key = get_exam_facet_index_key(exam.pk)
+    index = cache.get(cache_key)
+    if index is None:
+        index = build_exam_facet_index(exam)
+        cache.set(cache_key, index, settings.CACHE_PERIODS['STABLE'])
+    return index
+
+def invalidate_exam_question_caches(exam_pks):
+    # Drop the facet index and the meta question counts of exams.
+    cache_keys = []
+    for exam_pk in set(exam_pks):
+        cache_keys += [get_exam_facet_index_key(exam_pk),
+                       get_exam_meta_question_counts_key(exam_pk, True),
+                       get_exam_meta_question_counts_key(exam_pk, False)]
+    cache.delete_many(cache_keys)
+
+def count_selected_questions(exam, user, question_filter='ALL', selections=None):
+    # This mirrors SessionForm.get_question_pool() for new sessions.
+    # `selections` maps facet names (see FACET_FIELDS) to lists of
+    # selected PKs.  Only the user-specific question filters need a
+    # (single) query.
+    index = get_exam_facet_index(exam)
+
+    if question_filter == 'INCOMPLETE':
+        pool = index['incomplete']
+    else:
+        pool = index['approved']
+        user_question_pks = None
+        if question_filter in ['UNUSED', 'INCORRECT', 'SKIPPED']:
+            states = models.UserQuestionState.objects.filter(user=user,
+                                                             question__exam=exam)
+            if question_filter == 'INCORRECT':
+                states = states.incorrect()
+            elif question_filter == 'SKIPPED':
+                states = states.skipped()
+            user_question_pks = states.values_list('question', flat=True)
+        elif question_filter == 'MARKED':
+            user_question_pks = user.marked_questions.filter(exam=exam)\
+                                                     .values_list('pk', flat=True)
+
+        if user_question_pks is not None:
+            positions = {pk: position
+                         for position, pk in enumerate(index['question_pks'])}
+            user_bitset = make_bitset(positions[pk] for pk in user_question_pks
+                                      if pk in positions)
+            if question_filter == 'UNUSED':
+                pool &= ~user_bitset
+            else:
+                pool &= user_bitset
+
+    for facet, meta_pks in (selections or {}).items():
+        # Like the form, an empty selection does not filter, but a
+        # selection that matches no question of the exam (the form
+        # lists difficulties of all exams) empties the pool.
+        if not meta_pks:
+            continue
+        facet_bitset = 0
+        for meta_pk in meta_pks:
+            facet_bitset |= index[facet].get(meta_pk, 0)
+        pool &= facet_bitset
+
+    return count_bitset(pool)
+
+# A question bundle is a Question instance with everything
+# select_for_show_session() loads (plus figures), pickled into the
+# cache.  Bundles are user-independent.  Every question has a version
+# stamp in the cache, which is part of the bundle cache key and is
+# replaced by signals whenever any part of the bundle changes, so a
+# bundle that was being built during a change is never served.
+def get_question_bundle_version_key(question_pk):
+    return f'question_{question_pk}_bundle_version'
+
+def get_question_bundle_key(question_pk, version):
+    return f'question_{question_pk}_bundle_{version}'
+
+def bump_question_bundle_versions(question_pks):
+    versions = {get_question_bundle_version_key(question_pk): uuid.uuid4().hex
+                for question_pk in set(question_pks)}
+    cache.set_many(versions, settings.CACHE_PERIODS['STABLE'])
+
+def get_question_bundle_versions(question_pks):
+    # Returns a dictionary of PK: version stamp, in one cache round
+    # trip (plus one per question that has no version yet).  Anything
+    # derived from the question bundle can be cached under its
+    # version.
+    version_keys = {question_pk: get_question_bundle_version_key(question_pk)
+                    for question_pk in set(question_pks)}
+    cached_versions = cache.get_many(version_keys.values())
+
+    versions = {}
+    for question_pk, version_key in version_keys.items():
+        version = cached_versions.get(version_key)
+        if version is None:
+            version = uuid.uuid4().hex
+            # Never overwrite a version set by a concurrent change.
+            if not cache.add(version_key, version,
+                             settings.CACHE_PERIODS['STABLE']):
+                version = cache.get(version_key, version)
+        versions[question_pk] = version
+    return versions
+
+def get_question_bundles(question_pks, versions=None):
+    # Returns a dictionary of PK: question bundle.  Cached bundles cost
+    # two cache round trips (versions and bundles) regardless of their
+    # number, and missing ones are built together with one
+    # select_for_show_session() query.  Questions that do not exist
+    # are not included.
+    if versions is None:
+        versions = get_question_bundle_versions(question_pks)
+    bundle_keys = {question_pk: get_question_bundle_key(question_pk, version)
+                   for question_pk, version in versions.items()}
+
+    cached_bundles = cache.get_many(bundle_keys.values())
+    bundles = {}
+    missing_pks = []
+    for question_pk, bundle_key in bundle_keys.items():
+        if bundle_key in cached_bundles:
+            bundles[question_pk] = cached_bundles[bundle_key]
+        else:
+            missing_pks.append(question_pk)
+
+    if missing_pks:
+        new_bundles = {}
+        questions = models.Question.objects.select_for_show_session()\
+                                           .prefetch_related('best_revision__figures',
+                                                             'latest_explanation_revision__figures')\
+                                           .filter(pk__in=missing_pks)
+        for question in questions:
+            bundles[question.pk] = question
+            new_bundles[bundle_keys[question.pk]] = question
+        cache.set_many(new_bundles, settings.CACHE_PERIODS['STABLE'])
+
+    return bundles
+
+def get_question_bundle(question_pk):
+    return get_question_bundles([question_pk]).get(question_pk)
+
+def get_revision_diff_key(revision_pk, previous_revision_pk):
+    return "revision_{}_diff_{}".format(revision_pk, previous_revision_pk)
+
+def get_right_choice_text(revision):
+    right_choices = [choice for choice in revision.choice_list
+                     if choice.is_right]
+    if right_choices:
+        return min(right_choices, key=lambda choice: choice.pk).text
+
+def compute_revision_diff(revision, previous_revision):
+    # Both revisions need their choice_list, in alphabetical order.
+    new_choice_texts = [choice.text for choice in revision.choice_list]
+    previous_choice_texts = [choice.text for choice in previous_revision.choice_list]
+    choice_pairs = []
+    for index, choice in enumerate(revision.choice_list):
+        if index < len(previous_choice_texts):
+            previous_choice_text = previous_choice_texts[index]
+        else:
+            previous_choice_text = ''
+        choice_pairs.append((choice.text, previous_choice_text, choice.is_right))
+    return {'is_text_changed': revision.text.strip() != previous_revision.text.strip(),
+            'is_choices_changed': set(new_choice_texts) != set(previous_choice_texts),
+            'choice_pairs': choice_pairs,
+            'right_choice_text': get_right_choice_text(revision),
+            'previous_right_choice_text': get_right_choice_text(previous_revision)}
+
+def get_revision_diffs(revision_pairs):
+    # Return the diffs of (revision, previous revision) pairs, keyed
+    # by the primary keys of both.  Revisions do not change once
+    # submitted, so diffs are cached for good.  The choices of all
+    # uncached pairs are fetched in a single query.
+    pair_keys = {get_revision_diff_key(revision.pk, previous_revision.pk): (revision, previous_revision)
+                 for revision, previous_revision in revision_pairs}
+    diffs = cache.get_many(pair_keys.keys())
+    missing_keys = [key for key in pair_keys if not key in diffs]
+    if missing_keys:
+        revisions = set()
+        for key in missing_keys:
+            revisions.update(pair_keys[key])
+        prefetch_related_objects(list(revisions),
+                                 Prefetch('choices',
+                                          models.Choice.objects.order_by_alphabet(),
+                                          to_attr='choice_list'))
+        new_diffs = {key: compute_revision_diff(*pair_keys[key])
+                     for key in missing_keys}
+        cache.set_many(new_diffs, settings.CACHE_PERIODS['STABLE'])
+        diffs.update(new_diffs)
+
+    return {(revision.pk, previous_revision.pk): diffs[key]
+            for key, (revision, previous_revision) in pair_keys.items()}
+
+def get_question_revision_pairs(question_pk):
+    # Pair every undeleted revision of the question with the one
+    # before it (see Revision.get_previous()), from a single query.
+    revisions = models.Revision.objects.filter(question_id=question_pk,
+                                               is_deleted=False)\
+                                       .order_by('submission_date', 'pk')
+    revision_pairs = {}
+    earlier_revisions = []
+    previous_revision = None
+    for revision in revisions:
+        # Revisions submitted at the very same moment do not precede
+        # each other.
+        while earlier_revisions and \
+              earlier_revisions[0].submission_date < revision.submission_date:
+            previous_revision = earlier_revisions.pop(0)
+        revision_pairs[revision.pk] = (revision, previous_revision)
+        earlier_revisions.append(revision)
+    return revision_pairs
+
+def get_accessible_category_pks_key(group_pk):
+    return "accessible_category_pks_group_{}".format(group_pk)
+
+def invalidate_accessible_category_pks():
+    group_pks = list(accounts.models.Group.objects.values_list('pk', flat=True))
+    cache.delete_many([get_accessible_category_pks_key(group_pk)
+                       for group_pk in group_pks + [None]])
+
+def get_accessible_category_pks(user):
+    # The same rules as Category.can_user_access(), computed for all
+    # categories at once from two queries, and cached per user group.
+    # Returns None if the user can access all categories.
+    if not user.is_authenticated:
+        return []
+    elif user.is_superuser:
+        return None
+
+    user_group = accounts.utils.get_user_group(user)
+    group_pk = user_group.pk if user_group else None
+    cache_key = get_accessible_category_pks_key(group_pk)
+    category_pks = cache.get(cache_key)
+    if category_pks is not None:
+        return category_pks
+
+    parents = dict(models.Category.objects.values_list('pk', 'parent_category'))
+    group_limits = {}
+    for category_pk, limit_group_pk in models.Category.group_limit.through.objects\
+                                                                 .values_list('category', 'group'):
+        group_limits.setdefault(category_pk, set()).add(limit_group_pk)
+
+    category_pks = []
+    for category_pk in parents:
+        current_pk = category_pk
+        while current_pk:
+            if current_pk in group_limits and \
+               group_pk not in group_limits[current_pk]:
+                break
+            current_pk = parents[current_pk]
+        else:
+            category_pks.append(category_pk)
+
+    cache.set(cache_key, category_pks,
+              settings.CACHE_PERIODS['STABLE'])
+    return category_pks
+
 def get_user_allowed_categories(user):
-    categories=[]
-    for cat in models.Category.objects.all():
-        if cat.can_user_access(user):
-            categories.append(cat)
-    return categories
+    category_pks = get_accessible_category_pks(user)
+    if category_pks is None:
+        return models.Category.objects.all()
+    return models.Category.objects.filter(pk__in=category_pks)
+
+def update_question_search_index(question_pks):
+    # (Re-)index the best revision text, its choices and the latest
+    # explanation of the given questions.  Questions that no longer
+    # exist or have no best revision are removed from the index.
+    if not text_search.is_supported():
+        return
+    question_pks = set(question_pks)
+    questions = models.Question.objects\
+                               .filter(pk__in=question_pks,
+                                       best_revision__isnull=False)\
+                               .values_list('pk', 'exam_id',
+                                            'is_approved', 'is_deleted',
+                                            'best_revision__text',
+                                            'latest_explanation_revision__explanation_text')
+    choice_texts = {}
+    for question_pk, choice_text in models.Revision.choices.through.objects\
+                                                  .filter(revision__best_of__in=question_pks)\
+                                                  .order_by('choice')\
+                                                  .values_list('revision__best_of',
+                                                               'choice__text'):
+        choice_texts.setdefault(question_pk, []).append(choice_text)
+
+    documents = []
+    for question_pk, exam_pk, is_approved, is_deleted, text, explanation_text in questions:
+        documents.append((question_pk, exam_pk, is_approved, is_deleted,
+                          text, "\n".join(choice_texts.get(question_pk, [])),
+                          explanation_text or ""))
+    indexed_pks = set(document[0] for document in documents)
+    text_search.remove_search_documents(question_pks - indexed_pks)
+    text_search.index_search_documents(documents)
+
+def resolve_duplicate_groups(groups):
+    # groups is a list of (primary question primary key, [(question
+    # primary key, ratio)]) tuples.  Adjust them to the containers
+    # that already exist, so that the rules of catch_duplicates hold
+    # across runs: a question that is a duplicate in a pending or kept
+    # container is never a primary question, so its group goes to the
+    # primary question of that container, and it is not added as a
+    # duplicate of any other primary question.
+    question_pks = set()
+    for primary_pk, duplicate_pairs in groups:
+        question_pks.add(primary_pk)
+        question_pks.update(question_pk for question_pk, ratio in duplicate_pairs)
+    question_pks = list(question_pks)
+    primary_pks = {}
+    for start in range(0, len(question_pks), 500):
+        primary_pks.update(models.Duplicate.objects\
+                                 .filter(question__in=question_pks[start:start + 500],
+                                         container__status__in=['PENDING', 'KEPT'])\
+                                 .values_list('question', 'container__primary_question'))
+
+    resolved_groups = {}
+    for primary_pk, duplicate_pairs in groups:
+        primary_pk = primary_pks.get(primary_pk, primary_pk)
+        for question_pk, ratio in duplicate_pairs:
+            if question_pk == primary_pk or \
+               primary_pks.get(question_pk, primary_pk) != primary_pk:
+                continue
+            resolved_groups.setdefault(primary_pk, {})\
+                           .setdefault(question_pk, ratio)
+    return [(primary_pk, sorted(resolved_groups[primary_pk].items()))
+            for primary_pk in sorted(resolved_groups)]
+
+def find_question_duplicates(question, band_values,
+                             cutoff=duplicates.DEFAULT_CUTOFF,
+                             short_limit=duplicates.DEFAULT_SHORT_LIMIT):
+    # Match the question against the stored fingerprints of its exam,
+    # and add the confirmed duplicates to containers the same way
+    # catch_duplicates does: the primary question is always the one
+    # with the smaller primary key, and a question that duplicates an
+    # earlier one (or is already a duplicate in another container, see
+    # resolve_duplicate_groups()) is not a primary question itself.
+    candidate_pks = models.FingerprintBand.objects\
+                                          .filter(exam=question.exam_id,
+                                                  value__in=band_values)\
+                                          .exclude(fingerprint=question.pk)\
+                                          .values('fingerprint')
+    candidates = models.Question.objects.select_related('best_revision')\
+                                        .filter(pk__in=candidate_pks,
+                                                best_revision__isnull=False)\
+                                        .undeleted()\
+                                        .order_by('pk')
+    text = question.best_revision.text
+    earlier_duplicates = []
+    later_duplicates = []
+    for candidate in candidates:
+        if candidate.pk < question.pk:
+            ratio = duplicates.get_duplicate_ratio(candidate.best_revision.text, text,
+                                                   cutoff, short_limit)
+            if ratio is not None:
+                earlier_duplicates.append((candidate, ratio))
+        else:
+            ratio = duplicates.get_duplicate_ratio(text, candidate.best_revision.text,
+                                                   cutoff, short_limit)
+            if ratio is not None:
+                later_duplicates.append((candidate, ratio))
+
+    if earlier_duplicates:
+        primary_question, ratio = earlier_duplicates[0]
+        groups = [(primary_question.pk, [(question.pk, ratio)])]
+    elif later_duplicates:
+        groups = [(question.pk, [(later_question.pk, ratio)
+                                 for later_question, ratio in later_duplicates])]
+    else:
+        return
+    add_duplicates_in_bulk(resolve_duplicate_groups(groups))
+
+def store_question_fingerprints(fingerprints):
+    # fingerprints is a list of (question primary key, exam primary
+    # key, best revision primary key, signature) tuples.  Replace the
+    # stored fingerprints of those questions, and return a dictionary
+    # of their primary keys and band values.
+    question_pks = [fingerprint[0] for fingerprint in fingerprints]
+    models.FingerprintBand.objects.filter(fingerprint__in=question_pks).delete()
+    models.QuestionFingerprint.objects.filter(question__in=question_pks).delete()
+
+    band_values = {}
+    question_fingerprints = []
+    bands = []
+    for question_pk, exam_pk, revision_pk, signature in fingerprints:
+        band_values[question_pk] = duplicates.get_band_values(signature)
+        question_fingerprints.append(models.QuestionFingerprint(question_id=question_pk,
+                                                                revision_id=revision_pk,
+                                                                signature=duplicates.pack_signature(signature)))
+        bands += [models.FingerprintBand(fingerprint_id=question_pk,
+                                         exam_id=exam_pk,
+                                         value=value)
+                  for value in band_values[question_pk]]
+    models.QuestionFingerprint.objects.bulk_create(question_fingerprints, batch_size=1000)
+    models.FingerprintBand.objects.bulk_create(bands, batch_size=1000)
+    return band_values
+
+def update_question_fingerprints(question_pks, detect_duplicates=True,
+                                 cutoff=duplicates.DEFAULT_CUTOFF,
+                                 short_limit=duplicates.DEFAULT_SHORT_LIMIT):
+    # (Re-)fingerprint the best revisions of the given questions, and,
+    # unless detect_duplicates is False, match them against the other
+    # questions of their exams.  Deleted questions and those with no
+    # best revision lose their fingerprint.
+    question_pks = list(question_pks)
+    questions = list(models.Question.objects.select_related('best_revision')\
+                                            .filter(pk__in=question_pks,
+                                                    best_revision__isnull=False)\
+                                            .undeleted()\
+                                            .order_by('pk'))
+    models.FingerprintBand.objects.filter(fingerprint__in=question_pks).delete()
+    models.QuestionFingerprint.objects.filter(question__in=question_pks).delete()
+    band_values = store_question_fingerprints([(question.pk, question.exam_id,
+                                                question.best_revision_id,
+                                                duplicates.get_signature(question.best_revision.text))
+                                               for question in questions])
+
+    # All fingerprints are stored first, so that questions that are
+    # fingerprinted together are matched against each other as well.
+    if detect_duplicates:
+        for question in questions:
+            find_question_duplicates(question, band_values[question.pk],
+                                     cutoff, short_limit)
+
+# Questions whose fingerprints are to be updated once the current
+# transaction is committed (see queue_question_fingerprint()).
+_fingerprint_updates = threading.local()
+
+def queue_question_fingerprint(question_pk):
+    # Fingerprinting and duplicate detection take a candidate query,
+    # SequenceMatcher comparisons and container writes, so rather than
+    # running them within every Question.save(), questions are
+    # collected and handled together once the transaction is
+    # committed.  Outside transactions, that is right away.  Every
+    # call registers a callback, as those of rolled-back transactions
+    # are dropped; the first callback to run handles the whole queue.
+    question_pks = getattr(_fingerprint_updates, 'question_pks', None)
+    if question_pks is None:
+        question_pks = _fingerprint_updates.question_pks = set()
+    question_pks.add(question_pk)
+    transaction.on_commit(run_queued_question_fingerprints)
+
+def run_queued_question_fingerprints():
+    question_pks = getattr(_fingerprint_updates, 'question_pks', None)
+    _fingerprint_updates.question_pks = None
+    if question_pks:
+        update_question_fingerprints(question_pks)
+
+def add_duplicates_in_bulk(groups):
+    # groups is a list of (primary question primary key, [(question
+    # primary key, ratio)]) tuples, as returned by
+    # duplicates.group_duplicates().  Add the questions to the
+    # pending containers of the primary questions, unless an
+    # identical container has been declined before, in a fixed number
+    # of queries.  Return the primary keys of the primary questions
+    # whose identical containers have been declined before.
+    primary_pks = [primary_pk for primary_pk, duplicate_pairs in groups]
+    declined_containers = {}
+    for container_pk, primary_pk, question_pk in models.Duplicate.objects\
+                                                      .filter(container__status="DECLINED",
+                                                              container__primary_question__in=primary_pks)\
+                                                      .values_list('container',
+                                                                   'container__primary_question',
+                                                                   'question'):
+        declined_containers.setdefault(primary_pk, {})\
+                           .setdefault(container_pk, set())\
+                           .add(question_pk)
+
+    declined_pks = []
+    groups_to_add = []
+    for primary_pk, duplicate_pairs in groups:
+        question_pks = {question_pk for question_pk, ratio in duplicate_pairs}
+        if any(question_pks <= container_question_pks
+               for container_question_pks in declined_containers.get(primary_pk, {}).values()):
+            declined_pks.append(primary_pk)
+        else:
+            groups_to_add.append((primary_pk, duplicate_pairs))
+    if not groups_to_add:
+        return declined_pks
+
+    # If previous containers are pending, we add to them.
+    primary_pks = [primary_pk for primary_pk, duplicate_pairs in groups_to_add]
+    pending_containers = models.DuplicateContainer.objects.filter(status="PENDING",
+                                                                  primary_question__in=primary_pks)\
+                                                          .order_by('-pk')
+    container_pks = dict(pending_containers.values_list('primary_question', 'pk'))
+    new_containers = [models.DuplicateContainer(status="PENDING",
+                                                primary_question_id=primary_pk)
+                      for primary_pk in primary_pks
+                      if not primary_pk in container_pks]
+    if new_containers:
+        models.DuplicateContainer.objects.bulk_create(new_containers)
+        container_pks = dict(pending_containers.values_list('primary_question', 'pk'))
+
+    existing_duplicates = set(models.Duplicate.objects\
+                                    .filter(container__in=container_pks.values())\
+                                    .values_list('container', 'question'))
+    new_duplicates = []
+    for primary_pk, duplicate_pairs in groups_to_add:
+        container_pk = container_pks[primary_pk]
+        for question_pk, ratio in duplicate_pairs:
+            if not (container_pk, question_pk) in existing_duplicates:
+                new_duplicates.append(models.Duplicate(container_id=container_pk,
+                                                       question_id=question_pk,
+                                                       ratio=ratio))
+    models.Duplicate.objects.bulk_create(new_duplicates)
+    return declined_pks
+
+def add_suggested_changes_in_bulk(revision_rules):
+    # revision_rules is a list of (revision primary key, [rule primary
+    # keys]) tuples.  Add the rules to the pending suggested changes
+    # of the revisions, unless an identical suggestion has been
+    # declined before, in a fixed number of queries.  Return the
+    # primary keys of the revisions whose suggestions were declined.
+    SuggestionRule = models.SuggestedChange.rules.through
+    revision_pks = [revision_pk for revision_pk, rule_pks in revision_rules]
+    declined_suggestions = {}
+    for suggestion_pk, revision_pk, rule_pk in SuggestionRule.objects\
+                                                             .filter(suggestedchange__status="DECLINED",
+                                                                     suggestedchange__revision__in=revision_pks)\
+                                                             .values_list('suggestedchange',
+                                                                          'suggestedchange__revision',
+                                                                          'rule'):
+        declined_suggestions.setdefault(revision_pk, {})\
+                            .setdefault(suggestion_pk, set())\
+                            .add(rule_pk)
+
+    declined_pks = []
+    rules_to_add = []
+    for revision_pk, rule_pks in revision_rules:
+        rule_pks = set(rule_pks)
+        if any(rule_pks <= suggestion_rule_pks
+               for suggestion_rule_pks in declined_suggestions.get(revision_pk, {}).values()):
+            declined_pks.append(revision_pk)
+        else:
+            rules_to_add.append((revision_pk, rule_pks))
+    if not rules_to_add:
+        return declined_pks
+
+    # If previous suggestions are pending, we add to them.
+    revision_pks = [revision_pk for revision_pk, rule_pks in rules_to_add]
+    pending_suggestions = models.SuggestedChange.objects.filter(status="PENDING",
+                                                                revision__in=revision_pks)\
+                                                        .order_by('-pk')
+    suggestion_pks = dict(pending_suggestions.values_list('revision', 'pk'))
+    new_suggestions = [models.SuggestedChange(status="PENDING",
+                                              revision_id=revision_pk)
+                       for revision_pk in revision_pks
+                       if not revision_pk in suggestion_pks]
+    if new_suggestions:
+        models.SuggestedChange.objects.bulk_create(new_suggestions)
+        suggestion_pks = dict(pending_suggestions.values_list('revision', 'pk'))
 
+    existing_rules = set(SuggestionRule.objects\
+                                       .filter(suggestedchange__in=suggestion_pks.values())\
+                                       .values_list('suggestedchange', 'rule'))
+    new_rules = []
+    for revision_pk, rule_pks in rules_to_add:
+        suggestion_pk = suggestion_pks[revision_pk]
+        for rule_pk in rule_pks:
+            if not (suggestion_pk, rule_pk) in existing_rules:
+                new_rules.append(SuggestionRule(suggestedchange_id=suggestion_pk,
+                                                rule_id=rule_pk))
+    SuggestionRule.objects.bulk_create(new_rules)
+    return declined_pks
 
 def get_correct_percentage():
     # How many questions are considered "recent"?
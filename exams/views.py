@@ -4,14 +4,14 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
-from django.db.models import Prefetch, Q
+from django.core.paginator import Paginator
+from django.db.models import Case, IntegerField, Prefetch, Q, When, prefetch_related_objects
 from django.http import HttpResponseRedirect, Http404, HttpResponseBadRequest
 from django.shortcuts import get_object_or_404, render
 from django.template.loader import get_template
 from django.urls import reverse
 from django.utils import timezone
 from django.views.decorators import csrf
-from django.views.decorators.cache import cache_page
 from django.views.decorators.http import require_POST, require_safe
 from htmlmin.minify import html_minify
 from notifications.models import Notification
@@ -22,7 +22,7 @@ import json
 from core import decorators
 from teams.models import *
 from .models import *
-from . import forms, utils, app_rules
+from . import api, forms, text_search, utils, app_rules
 import core.utils
 import teams.utils
 
@@ -109,12 +109,31 @@ class QuestionAutocomplete(autocomplete.Select2QuerySetView):
             try:
                 q = int(self.q)
             except ValueError:
-                # If self.q is not an integer
-                qs = qs.none()
+                # If self.q is not an integer, search the text of the
+                # latest revisions.
+                qs = self.search_text(exam, qs)
             else:
                 qs = qs.filter(pk=q)
         return qs
 
+    def search_text(self, exam, qs):
+        if not text_search.is_supported():
+            term_filter = Q(revision__is_last=True,
+                            revision__is_deleted=False)
+            for term in text_search.get_terms(self.q):
+                term_filter &= Q(revision__text__icontains=term)
+            return qs.filter(term_filter).distinct()
+
+        # Keep the ranking of the search index.
+        question_pks = text_search.search_autocomplete(exam.pk, self.q)
+        if not question_pks:
+            return qs.none()
+        ranking = Case(*[When(pk=pk, then=position)
+                         for position, pk in enumerate(question_pks)],
+                       output_field=IntegerField())
+        return qs.filter(pk__in=question_pks)\
+                 .order_by(ranking)
+
     def get_result_label(self, item):
         text_preview = str(item)
         return "<strong>{}</strong>: {}".format(item.pk, text_preview)
@@ -188,25 +207,26 @@ def handle_question(request, exam_pk, question_pk=None):
        revision_figure_formset.is_valid() and \
        explanation_figure_formset.is_valid():
         question = question_form.save()
-        revision = revision_form.save(commit=False)
-        revision.question = question
-        revision.is_contribution = not teams.utils.is_editor(request.user)
-        revision.save()
-        revision_form.save_m2m()
-
-        choices = revision_choice_formset.save()
-        for choice in choices:
-            choice.question = question
-            choice.save()
-        revision.choices.add(*choices)
-
-        revision_figures = revision_figure_formset.save()
-        revision.figures.add(*revision_figures)
-
-        # This test relies on choices, so the choices have to be saved
-        # before
-        revision.is_approved = utils.test_revision_approval(revision)
-        revision.save()
+        with utils.defer_revision_updates():
+            revision = revision_form.save(commit=False)
+            revision.question = question
+            revision.is_contribution = not teams.utils.is_editor(request.user)
+            revision.save()
+            revision_form.save_m2m()
+
+            choices = revision_choice_formset.save()
+            for choice in choices:
+                choice.question = question
+                choice.save()
+            revision.choices.add(*choices)
+
+            revision_figures = revision_figure_formset.save()
+            revision.figures.add(*revision_figures)
+
+            # This test relies on choices, so the choices have to be saved
+            # before
+            revision.is_approved = utils.test_revision_approval(revision)
+            revision.save()
 
         explanation = explanation_form.save(commit=False)
         if explanation:
@@ -549,10 +569,37 @@ def create_session_automatically(request, slugs, exam_pk):
 
     return {'url': session.get_absolute_url()}
 
+def get_session_question_fragments(question_pks):
+    # Question HTML is user-independent (marks, answers, highlights
+    # and corrections are loaded separately), so it is cached per
+    # question, under the version of its question bundle.  The
+    # version changes with the best revision, the explanation and
+    # anything else shown in the question.  Returns a dictionary of
+    # PK: (exam PK, HTML).
+    versions = utils.get_question_bundle_versions(question_pks)
+    fragment_keys = {pk: f'question_{pk}_session_fragment_{version}'
+                     for pk, version in versions.items()}
+    cached_fragments = cache.get_many(fragment_keys.values())
+    fragments = {pk: cached_fragments[fragment_key]
+                 for pk, fragment_key in fragment_keys.items()
+                 if fragment_key in cached_fragments}
+
+    missing_pks = [pk for pk in fragment_keys if not pk in fragments]
+    if missing_pks:
+        template = get_template("exams/partials/session_question.html")
+        bundles = utils.get_question_bundles(missing_pks, versions)
+        new_fragments = {}
+        for pk, question in bundles.items():
+            html = template.render({'question': question, 'session': True})
+            fragments[pk] = (question.exam_id, html)
+            new_fragments[fragment_keys[pk]] = fragments[pk]
+        cache.set_many(new_fragments, settings.CACHE_PERIODS['EXPENSIVE_UNCHANGEABLE'])
+
+    return fragments
+
 @login_required
 @require_safe
 @permission_required('exams.access_exam', fn=objectgetter(Exam, 'exam_pk'), raise_exception=True)
-@cache_page(settings.CACHE_PERIODS['EXPENSIVE_UNCHANGEABLE'])
 @decorators.ajax_only
 def list_partial_session_questions(request, slugs, exam_pk):
     try:
@@ -560,21 +607,74 @@ def list_partial_session_questions(request, slugs, exam_pk):
     except ValueError:
         return HttpResponseBadRequest('No valid "pks" parameter was provided')
 
-    questions = Question.objects.select_for_show_session()\
-                                .filter(exam__pk=exam_pk, pk__in=pks)
-    template = get_template("exams/partials/partial_session_question_list.html")
-    context = {'questions': questions, 'user': request.user}
-    html = template.render(context)
-    #minified_html = html_minify(html)
+    fragments = get_session_question_fragments(pks)
+    exam_fragments = [fragments[pk][1] for pk in dict.fromkeys(pks)
+                      if pk in fragments and fragments[pk][0] == int(exam_pk)]
+    html = "".join(exam_fragments)
 
     return {'html': html}
 
+@login_required
+@require_safe
+@decorators.ajax_only
+def prefetch_session_questions(request, session_pk):
+    # Return everything needed to show the next questions of a
+    # session in one response, so that the client can prefetch them
+    # while the user is reading the current one: question HTML, answer
+    # corrections, highlights, the user's answers and marks.
+    # `cursor` is the sequence of the current question.
+    session = get_object_or_404(Session.objects.select_related('exam',
+                                                               'submitter')\
+                                               .undeleted(),
+                                pk=session_pk)
+
+    # PERMISSION CHECK
+    if not session.can_user_access(request.user):
+        raise PermissionDenied
+
+    try:
+        cursor = int(request.GET.get('cursor', 0))
+        count = min(int(request.GET.get('count', 5)), 50)
+    except ValueError:
+        return HttpResponseBadRequest()
+
+    cursor = max(cursor, 0)
+    question_pks = session.get_question_order()[cursor:cursor + max(count, 0)]
+    question_positions = session.get_question_positions()
+    fragments = get_session_question_fragments(question_pks)
+    questions = [{'pk': pk,
+                  'sequence': question_positions[pk],
+                  'html': fragments[pk][1]}
+                 for pk in question_pks if pk in fragments]
+
+    choices_with_corrections = api.get_choices_with_corrections()\
+                                  .filter(question__pk__in=question_pks)
+    corrections = api.get_correction_data(choices_with_corrections,
+                                          session.exam, request.user)
+
+    highlights = Highlight.objects.filter(session=session,
+                                          question__pk__in=question_pks)\
+                                  .select_related('revision')\
+                                  .prefetch_related('stricken_choices')
+    answers = Answer.objects.select_related('choice')\
+                            .filter(session=session,
+                                    question__pk__in=question_pks)
+    marked_question_pks = request.user.marked_questions\
+                                      .filter(pk__in=question_pks)\
+                                      .values_list('pk', flat=True)
+
+    return {'questions': questions,
+            'corrections': corrections,
+            'highlights': api.HighlightSerializer(highlights, many=True).data,
+            'answers': api.AnswerSerializer(answers, many=True).data,
+            'marked_question_pks': list(marked_question_pks)}
+
 @require_safe
 def show_single_question(request, slugs, exam_pk, question_pk):
     category = Category.objects.get_from_slugs_or_404(slugs)
-    current_question = get_object_or_404(Question.objects.select_for_show_session()\
-                                                         .undeleted(),
-                                         pk=question_pk)
+    current_question = utils.get_question_bundle(int(question_pk))
+    if not current_question or current_question.is_deleted:
+        raise Http404
     context = {'category_slugs': slugs,
               'default_session_theme': SessionTheme.objects.get(name="Ocean"),
                'current_question': current_question}
@@ -603,10 +703,9 @@ def show_session(request, slugs, exam_pk, session_pk, question_pk=None):
             raise PermissionDenied
 
     current_question = session.get_current_question(question_pk)
-    session_questions = session.get_questions().values_list('pk', 'global_sequence')
     # This produces a dictionary of keys being question_pks and values
-    # being global_sequences
-    session_question_pks = json.dumps(dict(session_questions))
+    # being their sequence within the session.
+    session_question_pks = json.dumps(session.get_question_positions())
 
     shared_sessions = Session.objects.get_shared(session)
     context = {'session': session,
@@ -638,8 +737,12 @@ def show_session_results(request, slugs, exam_pk, session_pk):
             answer = Answer(session=session, question=question)
             answers.append(answer)
         Answer.objects.bulk_create(answers)
+        session.skipped_answer_count += len(answers)
         session.unused_question_count = 0
         session.save()
+        # bulk_create() does not fire the Answer signals.
+        utils.update_user_question_states(user=request.user,
+                                          question_pks=[answer.question_id for answer in answers])
 
     # We don't use the standard QuerySets as they don't filter per a
     # specific session.
@@ -741,6 +844,87 @@ def submit_answer(request):
 
     return {}
 
+@login_required
+@require_POST
+@csrf.csrf_exempt
+@decorators.ajax_only
+def submit_answers(request):
+    # A batch version of submit_answer, for sessions where the client
+    # already has all the answers (e.g. timed and unexplained
+    # sessions).  `answers` is a JSON list of {"question_pk": ...,
+    # "choice_pk": ...} objects, where a missing or null choice_pk
+    # means a skipped question.  Questions that were already answered
+    # in the session are ignored, so retrying a batch is safe.
+    session_pk = request.POST.get('session_pk')
+    session = get_object_or_404(Session.objects.select_related('submitter').undeleted(), pk=session_pk)
+
+    # PERMISSION CHECKS
+    if not session.submitter == request.user:
+        raise Exception("You cannot submit answers in this session")
+    # This is what Question.was_solved_in_session() checks first in
+    # submit_answer.
+    if not session.is_examinable():
+        raise Exception("Answers cannot be submitted in this session.")
+
+    try:
+        submitted_answers = json.loads(request.POST.get('answers', '[]'))
+        pairs = {}
+        for submitted_answer in submitted_answers:
+            question_pk = int(submitted_answer['question_pk'])
+            choice_pk = submitted_answer.get('choice_pk')
+            if choice_pk is not None:
+                choice_pk = int(choice_pk)
+            # The first answer of a question within the batch wins.
+            pairs.setdefault(question_pk, choice_pk)
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return HttpResponseBadRequest()
+
+    # Validate all questions and choices in two queries: a choice is
+    # valid if it belongs to one of the undeleted revisions of its
+    # question.
+    valid_question_pks = set(session.get_questions()\
+                                    .filter(pk__in=pairs)\
+                                    .values_list('pk', flat=True))
+    valid_pairs = set(Revision.choices.through.objects\
+                                      .filter(revision__question__in=valid_question_pks,
+                                              revision__is_deleted=False)\
+                                      .values_list('revision__question', 'choice'))
+    invalid_question_pks = [question_pk for question_pk, choice_pk in pairs.items()
+                            if not question_pk in valid_question_pks or
+                            (choice_pk and not (question_pk, choice_pk) in valid_pairs)]
+    if invalid_question_pks:
+        return HttpResponseBadRequest()
+
+    answered_question_pks = set(Answer.objects.filter(session=session,
+                                                      question__in=pairs)\
+                                              .values_list('question', flat=True))
+    answers = [Answer(session=session, question_id=question_pk,
+                      choice_id=choice_pk)
+               for question_pk, choice_pk in pairs.items()
+               if not question_pk in answered_question_pks]
+    # ignore_conflicts covers concurrent retries of the same batch.
+    Answer.objects.bulk_create(answers, ignore_conflicts=True)
+
+    # bulk_create() does not fire the Answer signals.
+    new_question_pks = [answer.question_id for answer in answers]
+    if new_question_pks:
+        utils.update_session_counters([session.pk])
+        utils.update_user_question_states(user=request.user,
+                                          question_pks=new_question_pks)
+        utils.update_first_answers(user=request.user,
+                                   question_pks=new_question_pks)
+
+    # With ignore_conflicts, we cannot tell which of our rows were
+    # inserted, so the counts come from what exists after the insert.
+    # If a retry of the same batch runs concurrently, both requests
+    # may count the same answers as submitted.
+    answered_count = Answer.objects.filter(session=session,
+                                           question__in=pairs)\
+                                   .count()
+    submitted_count = answered_count - len(answered_question_pks)
+    return {'submitted_count': submitted_count,
+            'ignored_count': len(pairs) - submitted_count}
+
 @require_safe
 @login_required
 def list_previous_sessions(request):
@@ -866,7 +1050,28 @@ def show_revision_comparison(request, pk, review=False):
     if not revision.question.exam.can_user_access(request.user):
         raise PermissionDenied
 
+    # Diffs are computed for all revisions of the question at once,
+    # so that browsing its revision history is served from the
+    # cache.
+    revision_pairs = utils.get_question_revision_pairs(revision.question_id)
+    previous_revision = revision_pairs[revision.pk][1]
+    diffs = utils.get_revision_diffs([pair for pair in revision_pairs.values()
+                                      if pair[1]])
+    if previous_revision:
+        diff = diffs[(revision.pk, previous_revision.pk)]
+        revisions_to_show = [revision, previous_revision]
+    else:
+        diff = None
+        revisions_to_show = [revision]
+    prefetch_related_objects(revisions_to_show,
+                             Prefetch('choices',
+                                      Choice.objects.order_by_alphabet(),
+                                      to_attr='choice_list'),
+                             'figures')
+
     context = {'revision': revision,
+               'previous_revision': previous_revision,
+               'diff': diff,
                'review': bool(review)}
     return render(request, 'exams/partials/show_revision_comparison.html', context)
 
@@ -990,12 +1195,10 @@ def approve_question(request, slugs, exam_pk, pk):
 @require_safe
 @login_required
 def show_my_performance(request):
-    user_question_pks = Answer.objects.filter(session__submitter=request.user,
-                                              session__is_deleted=False)\
-                                      .values('question')
-    user_questions = Question.objects.undeleted()\
-                                     .filter(pk__in=user_question_pks)
-    total_questions = user_questions.count()
+    total_questions = Question.objects.undeleted()\
+                                      .used_by_user(request.user,
+                                                    exclude_skipped=False)\
+                                      .count()
     correct_count = Question.objects.correct_by_user(request.user)\
                                     .count()
     incorrect_count = Question.objects.incorrect_by_user(request.user)\
@@ -1078,23 +1281,53 @@ def list_contributions(request,user_pk=None):
 @login_required
 def search(request):
     q = request.GET.get('q')
-    categories= utils.get_user_allowed_categories(request.user)
-    #TODO:try to add choices to search
-    if q:
-        search_fields =['pk','best_revision__text','best_revision__choice__text']
-        if teams.utils.is_editor(request.user):
-            qs = Question.objects.filter(exam__category__in=categories,
-                                         best_revision__is_last=True)\
-                                 .distinct()
-        else:
-            qs = Question.objects.undeleted()\
-                                 .filter(exam__category__in=categories,
-                                         best_revision__is_last=True,
-                                         best_revision__is_approved=True)\
-                                 .distinct()
-        questions = core.utils.get_search_queryset(qs, search_fields, q)
-        return render(request, 'exams/search_results.html', {'questions': questions, 'query': q})
-    return render(request, 'exams/search_results.html', {'search': True})
+    if not q:
+        return render(request, 'exams/search_results.html', {'search': True})
+
+    # Only editors can see unapproved (and deleted) questions.
+    approved_only = not teams.utils.is_editor(request.user)
+    category_pks = utils.get_accessible_category_pks(request.user)
+    if category_pks is None:
+        exam_pks = None
+    else:
+        exam_pks = list(Exam.objects.filter(category__in=category_pks)\
+                                    .values_list('pk', flat=True))
+
+    qs = Question.objects.filter(best_revision__isnull=False)
+    if approved_only:
+        qs = qs.undeleted().filter(is_approved=True)
+    if exam_pks is not None:
+        qs = qs.filter(exam__in=exam_pks)
+
+    if text_search.is_supported():
+        # As in the fallback below, a number also matches the question
+        # with that primary key, which is listed first.
+        first_pks = []
+        if q.strip().isdigit():
+            first_pks = list(qs.filter(pk=int(q)).values_list('pk', flat=True))
+        results = text_search.QuestionSearch(q, exam_pks, approved_only,
+                                             first_pks)
+    else:
+        search_fields = ['pk', 'best_revision__text', 'best_revision__choices__text']
+        results = core.utils.get_search_queryset(qs, search_fields, q)\
+                            .order_by_submission()\
+                            .distinct()\
+                            .values_list('pk', flat=True)
+
+    page = Paginator(results, 20).get_page(request.GET.get('page'))
+    question_pks = list(page.object_list)
+    questions = Question.objects.filter(pk__in=question_pks)\
+                                .select_related('exam', 'best_revision',
+                                                'latest_explanation_revision')\
+                                .prefetch_related(Prefetch('best_revision__choices',
+                                                           Choice.objects.order_by_alphabet(),
+                                                           to_attr='choice_list'),
+                                                  'best_revision__figures')
+    questions = sorted(questions, key=lambda question: question_pks.index(question.pk))
+    context = {'questions': questions,
+               'page': page,
+               'query': q}
+    return render(request, 'exams/search_results.html', context)
 
 
 @login_required
@@ -1193,13 +1426,34 @@ def get_selected_question_count(request, exam_pk):
     if not exam.can_user_access(request.user):
         raise PermissionDenied
 
-    form = forms.SessionForm(request.POST,
-                             user=request.user,
-                             exam=exam)
-    form.full_clean()
-    question_pool = form.get_question_pool()
-
-    return {'count': question_pool.count()}
+    # Without a persistent cache, the facet index would be rebuilt on
+    # every request, which costs more than counting the pool.
+    if not utils.is_cache_persistent():
+        form = forms.SessionForm(request.POST,
+                                 user=request.user,
+                                 exam=exam)
+        form.full_clean()
+        question_pool = form.get_question_pool()
+        return {'count': question_pool.count()}
+
+    # Rather than building a whole SessionForm (and running all of
+    # its pool counts), the selection is counted against the cached
+    # facet index of the exam.
+    question_filter = request.POST.get('question_filter', 'ALL')
+    if not question_filter in dict(questions_choices):
+        question_filter = 'ALL'
+
+    selections = {}
+    for facet in utils.FACET_FIELDS:
+        if request.POST.get('all_' + facet):
+            continue
+        selections[facet] = [int(pk) for pk in request.POST.getlist(facet)
+                             if pk.isdigit()]
+
+    count = utils.count_selected_questions(exam, request.user,
+                                           question_filter, selections)
+
+    return {'count': count}
 
 @login_required
 @require_POST
@@ -1213,6 +1467,7 @@ def delete_session(request):
     if deletion_type == 'all':
         request.user.session_set.update(is_deleted=True)
         request.user.marked_questions.clear()
+        utils.update_user_question_states(user=request.user)
     elif deletion_type == 'exam':
         exam_pk = request.POST.get('pk')
         exam = Exam.objects.get(pk=exam_pk)
@@ -1220,6 +1475,8 @@ def delete_session(request):
         questions_to_unmark = request.user.marked_questions\
                                           .filter(exam=exam)
         request.user.marked_questions.remove(*questions_to_unmark)
+        utils.update_user_question_states(user=request.user,
+                                          question_pks=exam.question_set.values('pk'))
     elif deletion_type == 'session':
         session_pk = request.POST.get('pk')
         session = Session.objects.select_related('submitter')\
@@ -1231,6 +1488,8 @@ def delete_session(request):
 
         session.is_deleted = True
         session.save()
+        utils.update_user_question_states(user=request.user,
+                                          question_pks=session.questions.values('pk'))
 
         # Unmark questions that are only in this session.
         other_user_sessions = Session.objects.filter(submitter=request.user)\
@@ -1265,9 +1524,12 @@ def get_correct_percentage(request):
 def contribute_mnemonics(request):
     action = request.POST.get('action')
     question_pk = request.GET.get('question_pk')
-    question = get_object_or_404(Question.objects.select_for_show_session(),
-                                 pk=question_pk,
-                                 is_deleted=False)
+    try:
+        question = utils.get_question_bundle(int(question_pk))
+    except (TypeError, ValueError):
+        return HttpResponseBadRequest()
+    if not question or question.is_deleted:
+        raise Http404
 
     if request.method == 'GET':
         form = forms.ContributeMnemonic()
@@ -1304,9 +1566,9 @@ def contribute_mnemonics(request):
         else:
             return HttpResponseBadRequest()
 
-        # Get the question instance again to update
-        # prefetch_related after adding the new mnemonic.
-        question = Question.objects.select_for_show_session().get(pk=question_pk)
+        # Get the question bundle again, as the mnemonic signals have
+        # invalidated it.
+        question = utils.get_question_bundle(question.pk)
         template = get_template('exams/partials/show_mnemonics.html')
         context = {'question': question}
         mnemonic_html = template.render(context)
@@ -1511,9 +1773,9 @@ def get_shared_session_stats(request):
 
     if question_pk:
         stats['choices'] = []
-        question = get_object_or_404(Question.objects.select_for_show_session(),
-                             pk=question_pk,
-                             is_deleted=False)
+        question = utils.get_question_bundle(int(question_pk))
+        if not question or question.is_deleted:
+            raise Http404
         for choice in question.best_revision.choice_list:
             answer_count = Answer.objects.filter(Q(session__parent_session_id=session_pk) | \
                                                  Q(session_id=session_pk),
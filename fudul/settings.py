@@ -320,7 +320,10 @@ CONSTANCE_DATABASE_CACHE_BACKEND = getattr(secrets, "CONSTANCE_DATABASE_CACHE_BA
 # Haystack settings
 DEFAULT_HAYSTACK_CONNECTIONS = {
     'default': {
-        'ENGINE': 'haystack.backends.simple_backend.SimpleEngine',
+        'ENGINE': 'exams.search_backends.InvertedIndexEngine',
+        'PATH': os.path.join(BASE_DIR, 'search_index'),
     },
 }
 HAYSTACK_CONNECTIONS = getattr(secrets, "HAYSTACK_CONNECTIONS", DEFAULT_HAYSTACK_CONNECTIONS)
+HAYSTACK_SIGNAL_PROCESSOR = getattr(secrets, "HAYSTACK_SIGNAL_PROCESSOR",
+                                    'exams.search_backends.QueuedSignalProcessor')